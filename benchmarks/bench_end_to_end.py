@@ -0,0 +1,187 @@
+"""
+bench_end_to_end.py
+-------------------
+End-to-end benchmarks of the reporting and tagging hot paths against a synthetic fleet
+served by tests/fake_fusion.py. Every scenario and size runs in its own process, so the
+peak RSS reported is that of the scenario alone. For each run the throughput, peak RSS
+and number of requests per end-point are printed, and optionally appended as JSON lines
+to a results file that later runs can be compared against.
+
+Usage:
+    python benchmarks/bench_end_to_end.py --sizes 10000,100000,1000000 --output results.jsonl
+    python benchmarks/bench_end_to_end.py --scenarios process_volumes --latency 0.002
+"""
+
+import argparse
+import atexit
+import importlib.util
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from tests.fake_fusion import FakeFusionClient
+
+SCENARIOS = ('report_volumes', 'report_directories', 'report_arrays', 'save_report_to_excel', 'process_volumes')
+NAMESPACE = 'default'
+TAG_KEY = 'chargeback'
+
+
+def load_script(filename):
+    """
+    Import one of the hyphenated top-level scripts as a module, without running its main block.
+    """
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace('-', '_'), os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.NAMESPACE = NAMESPACE
+    module.TAG_KEY = TAG_KEY
+    return module
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def tagging_rules(client):
+    """
+    TAGGING_RULES tagging every other realm, pod, host group and host of the synthetic fleet.
+    """
+    return {
+        "realm": {realm: f"R-{realm}" for realm in client.realms[::2]},
+        "pod": {pod: f"P-{pod}" for pod in client.pods[::2]},
+        "workload": {},
+        "host_group": {host_group: f"HG-{host_group}" for host_group in client.host_groups[::2]},
+        "host": {host: f"H-{host}" for host in client.hosts[::2]},
+        "default": {"default": "DEFAULT"},
+    }
+
+
+def run_scenario(scenario, args):
+    """
+    Run one scenario in this process.
+    Returns:
+        dict with the scenario, size, items processed, elapsed seconds, throughput,
+        peak RSS in MB and requests per end-point
+    """
+    volumes_per_array = max(1, args.volumes // args.arrays)
+    client = FakeFusionClient(arrays=args.arrays, volumes_per_array=volumes_per_array,
+                              directories_per_array=max(1, volumes_per_array // 10),
+                              latency=args.latency, namespace=NAMESPACE, tag_key=TAG_KEY)
+    members = client.array_names
+
+    if scenario == 'process_volumes':
+        from staas_common import TaggingRuleEngine, WriteRateLimiter
+        tagging = load_script('staas-tag_vols.py')
+        tagging.TAGGING_RULES = tagging_rules(client)
+        tagging.RULE_ENGINE = TaggingRuleEngine(tagging.TAGGING_RULES)
+        tagging.WRITE_LIMITER = WriteRateLimiter(0, 0)
+        start = time.perf_counter()
+        for fleet_member in members:
+            tagging.process_volumes(client, fleet_member, reconcile=args.reconcile)
+        items = volumes_per_array * len(members)
+    else:
+        from staas_common import ColumnarRows, FleetTopology
+        reporting = load_script('staas-reporting.py')
+        reporting.NOW = time.strftime("%Y-%m-%d %H:%M")
+        if scenario == 'save_report_to_excel':
+            report = ColumnarRows('Volume')
+            for fleet_member in members:
+                report.extend(reporting.report_volumes(client, fleet_member, NAMESPACE, TAG_KEY,
+                                                       args.page_size, args.fetch_concurrency))
+            client.requests.clear()
+            workdir = tempfile.mkdtemp(prefix='staas-bench-')
+            atexit.register(shutil.rmtree, workdir, True)
+            start = time.perf_counter()
+            reporting.save_report_to_excel(report, reporting.VOLUME_HEADER_ROWS[0],
+                                           os.path.join(workdir, 'Space-Report-Volumes.xlsx'), 'Tag',
+                                           engine=args.excel_engine)
+            items = len(report)
+        elif scenario == 'report_volumes':
+            start = time.perf_counter()
+            items = 0
+            for fleet_member in members:
+                report = reporting.report_volumes(client, fleet_member, NAMESPACE, TAG_KEY,
+                                                  args.page_size, args.fetch_concurrency)
+                items += len(report)
+        elif scenario == 'report_directories':
+            start = time.perf_counter()
+            items = sum(len(reporting.report_directories(client, fleet_member)) for fleet_member in members)
+        else:
+            topology = FleetTopology.fetch(client)
+            client.requests.clear()
+            start = time.perf_counter()
+            reporting.report_arrays(client, client.fleet, members, topology)
+            items = len(members)
+
+    elapsed = time.perf_counter() - start
+    return {
+        'scenario': scenario,
+        'volumes': args.volumes,
+        'arrays': args.arrays,
+        'latency': args.latency,
+        'items': items,
+        'elapsed': round(elapsed, 3),
+        'items_per_second': round(items / elapsed, 1) if elapsed else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'requests': dict(client.requests),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks against a synthetic Fusion fleet')
+    parser.add_argument('--sizes', type=str, default='10000,100000,1000000',
+                        help='Comma separated total volume counts (default: 10000,100000,1000000)')
+    parser.add_argument('--scenarios', type=str, default=','.join(SCENARIOS),
+                        help=f"Comma separated scenarios out of {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--arrays', type=int, default=4, help='Number of fleet members the volumes are spread over')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--page-size', type=int, default=500, help='Volumes per page')
+    parser.add_argument('--fetch-concurrency', type=int, default=4, help='Concurrent tag and space requests per array')
+    parser.add_argument('--excel-engine', choices=['openpyxl', 'streaming'], default='openpyxl',
+                        help='Engine used by the save_report_to_excel scenario')
+    parser.add_argument('--reconcile', action='store_true', help='Run process_volumes in reconcile mode')
+    parser.add_argument('--output', type=str, default=None, help='JSON lines file the results are appended to')
+    parser.add_argument('--scenario', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--volumes', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Child process: run a single scenario and report it as the last line of output
+    if args.scenario:
+        logging.getLogger().setLevel(logging.WARNING)
+        print(json.dumps(run_scenario(args.scenario, args)))
+        return
+
+    for volumes in (int(size) for size in args.sizes.split(',')):
+        for scenario in args.scenarios.split(','):
+            command = [sys.executable, os.path.abspath(__file__), '--scenario', scenario, '--volumes', str(volumes),
+                       '--arrays', str(args.arrays), '--latency', str(args.latency),
+                       '--page-size', str(args.page_size), '--fetch-concurrency', str(args.fetch_concurrency),
+                       '--excel-engine', args.excel_engine]
+            if args.reconcile:
+                command.append('--reconcile')
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(f"{scenario} volumes={volumes} failed:\n{completed.stderr}")
+                continue
+            result = json.loads(completed.stdout.strip().splitlines()[-1])
+            print(f"{scenario:<22} volumes={volumes:<9} {result['elapsed']:>9.3f}s "
+                  f"{result['items_per_second'] or 0:>12,.0f} items/s  peak RSS {result['peak_rss_mb']:>8.1f} MB  "
+                  f"requests {sum(result['requests'].values())}")
+            if args.output:
+                with open(args.output, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+bench_import_time.py
+--------------------
+Cold-start benchmark of the entry points. The scripts are launched from schedulers and
+monitoring checks many times a day, so the time to reach argument parsing matters. Each
+target is started repeatedly in a fresh interpreter and the best and median wall times are
+printed, with the modules that took longest to import and any heavy module (pandas,
+openpyxl, pypureclient, ...) that was loaded although the path does not use it. Results
+can be appended as JSON lines to a file that later runs are compared against.
+
+Usage:
+    python benchmarks/bench_import_time.py
+    python benchmarks/bench_import_time.py --runs 20 --output import-times.jsonl --max-ms 500
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# What each target runs; --help stops right after argument parsing
+TARGETS = {
+    'staas_common': ['-c', 'import staas_common'],
+    'reporting --help': [os.path.join(ROOT, 'staas-reporting.py'), '--help'],
+    'tag_vols --help': [os.path.join(ROOT, 'staas-tag_vols.py'), '--help'],
+}
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl', 'pypureclient', 'urllib3', 'asyncio', 'pyarrow', 'yaml')
+
+
+def run_once(arguments, importtime=False):
+    """
+    Start a fresh interpreter.
+    Returns:
+        (elapsed seconds, stderr)
+    """
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + arguments
+    start = time.perf_counter()
+    completed = subprocess.run(command, cwd=ROOT, capture_output=True, text=True,
+                               env=dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')]))))
+    return time.perf_counter() - start, completed.stderr
+
+
+def parse_importtime(stderr):
+    """
+    Returns:
+        dict mapping each imported module to its cumulative import time in microseconds
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def measure(name, arguments, runs, top):
+    # The first start also refreshes any stale bytecode, so it is not counted
+    run_once(arguments)
+    times = [run_once(arguments)[0] for _ in range(runs)]
+    modules = parse_importtime(run_once(arguments, importtime=True)[1])
+    slowest = sorted(modules.items(), key=lambda item: item[1], reverse=True)
+    return {
+        'target': name,
+        'runs': runs,
+        'best_ms': round(min(times) * 1000, 1),
+        'median_ms': round(statistics.median(times) * 1000, 1),
+        'heavy_modules': sorted({module.split('.')[0] for module in modules} & set(HEAVY_MODULES)),
+        'slowest_imports': [[module, round(us / 1000, 1)] for module, us in slowest[:top]],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark of the entry points')
+    parser.add_argument('--runs', type=int, default=10, help='Starts measured per target (default: 10)')
+    parser.add_argument('--targets', type=str, default=','.join(TARGETS),
+                        help=f"Comma separated targets out of {', '.join(TARGETS)} (default: all)")
+    parser.add_argument('--top', type=int, default=5, help='Slowest imports listed per target (default: 5)')
+    parser.add_argument('--output', type=str, default=None, help='JSON lines file the results are appended to')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Exit with status 1 when a median start time exceeds this many milliseconds')
+    args = parser.parse_args()
+
+    exceeded = False
+    for name in args.targets.split(','):
+        result = measure(name, TARGETS[name], max(1, args.runs), args.top)
+        print(f"{name:<18} best {result['best_ms']:>8.1f} ms  median {result['median_ms']:>8.1f} ms  "
+              f"heavy modules: {', '.join(result['heavy_modules']) or 'none'}")
+        for module, ms in result['slowest_imports']:
+            print(f"{'':<20}{module:<40} {ms:>8.1f} ms")
+        if args.output:
+            with open(args.output, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(dict(result, timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'))) + '\n')
+        if args.max_ms is not None and result['median_ms'] > args.max_ms:
+            exceeded = True
+    if exceeded:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+bench_tagging_rules.py
+----------------------
+Microbenchmark for TaggingRuleEngine: resolves synthetic volumes against a synthetic
+rule set and reports throughput for the memoized batch path and the unmemoized path.
+
+Usage:
+    python benchmarks/bench_tagging_rules.py --volumes 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from staas_common import TaggingRuleEngine
+
+
+def synthetic_rules(containers):
+    """
+    Build TAGGING_RULES with `containers` realms, pods, host groups and hosts, half of them tagged.
+    """
+    rules = {"realm": {}, "pod": {}, "workload": {}, "host_group": {}, "host": {}, "default": {"default": "DEFAULT"}}
+    for i in range(0, containers, 2):
+        rules["realm"][f"realm{i}"] = f"R{i}"
+        rules["pod"][f"pod{i}"] = f"P{i}"
+        rules["host_group"][f"hg{i}"] = f"HG{i}"
+        rules["host"][f"host{i}"] = f"H{i}"
+    return rules
+
+
+def synthetic_keys(volumes, containers, seed=1):
+    """
+    Build (realm, pod, host_group, host) keys for `volumes` synthetic volumes.
+    As on a real array, each pod lives in one realm and each host in one host group,
+    and volumes outside a realm, pod or host group are common.
+    """
+    rng = random.Random(seed)
+    keys = []
+    for _ in range(volumes):
+        realm = pod = host_group = host = None
+        if rng.random() < 0.6:
+            pod_index = rng.randrange(containers)
+            pod = f"pod{pod_index}"
+            if rng.random() < 0.5:
+                realm = f"realm{pod_index % max(1, containers // 5)}"
+        if rng.random() < 0.7:
+            host_index = rng.randrange(containers)
+            host = f"host{host_index}"
+            host_group = f"hg{host_index // 4}"
+        keys.append((realm, pod, host_group, host))
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TaggingRuleEngine microbenchmark')
+    parser.add_argument('--volumes', type=int, default=1_000_000, help='Number of synthetic volumes')
+    parser.add_argument('--containers', type=int, default=50, help='Number of containers of each rule type')
+    parser.add_argument('--page-size', type=int, default=500, help='Volumes resolved per batch call')
+    args = parser.parse_args()
+
+    rules = synthetic_rules(args.containers)
+    keys = synthetic_keys(args.volumes, args.containers)
+
+    engine = TaggingRuleEngine(rules)
+    start = time.perf_counter()
+    for i in range(0, len(keys), args.page_size):
+        engine.resolve_batch(keys[i:i + args.page_size])
+    batch_elapsed = time.perf_counter() - start
+
+    engine = TaggingRuleEngine(rules)
+    start = time.perf_counter()
+    for key in keys:
+        engine._resolve(*key)
+    plain_elapsed = time.perf_counter() - start
+
+    print(f"volumes={args.volumes} containers={args.containers} page_size={args.page_size}")
+    print(f"resolve_batch (memoized): {batch_elapsed:.3f}s, {args.volumes / batch_elapsed:,.0f} volumes/s")
+    print(f"_resolve (unmemoized):    {plain_elapsed:.3f}s, {args.volumes / plain_elapsed:,.0f} volumes/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -42,27 +42,66 @@ Usage:
 See README.md for more details.
 """
 
+import functools
+import logging
 import os
-import pandas as pd
-import urllib3
-import pprint as pp
+import queue
+import time
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from openpyxl import load_workbook
-from packaging.version import Version
 from staas_common import (
     parse_arguments,
     initialise_client,
+    ResilientClient,
+    CachingClient,
+    InstrumentedClient,
+    Telemetry,
+    RetryPolicy,
+    CircuitBreaker,
     check_purity_role,
     check_api_version,
-    list_fleets,
-    list_members,
-    pypureclient
+    FleetTopology,
+    paginate,
+    list_query,
+    prefetch,
+    BatchSizeStore,
+    ReportHistory,
+    ColumnarRows,
+    CancellableClient,
+    AsyncFusionClient,
+    WorkAbandoned,
+    CheckpointJournal,
+    StreamingExcelWriter,
+    set_aside_workbook,
+    checkpoint_path,
+    workbook_errors,
+    DEFAULT_PAGE_SIZE,
+    DEFAULT_DIRECTORY_PAGE_SIZE,
+    DEFAULT_FETCH_CONCURRENCY,
+    TRACE,
+    setup_logging,
+    load_config,
+    ConfigError,
+    log_level
 )
 
 
-debug = 3
+logger = logging.getLogger('staas.reporting')
 REALMS_VERSION = "1.66"
 
+# Starting and largest batch sizes; the actual sizes adapt per array (see BatchSizeStore)
+VOLUME_DETAIL_BATCH_SIZE = 500   # volume names per tags/space request (bounded by URL length)
+MAX_VOLUME_DETAIL_BATCH_SIZE = 2000
+MAX_VOLUME_PAGE_SIZE = 2000
+MAX_DIRECTORY_PAGE_SIZE = 1000
+BATCH_SIZES = BatchSizeStore()
+
+# API call and phase timings of this run
+TELEMETRY = Telemetry('reporting')
+
 # Header rows for the reporting spreadsheet are defined here
 VOLUME_HEADER_ROWS = [
     ['Date/Time', 'Array', 'Volume']
@@ -80,8 +119,9 @@ DIRECTORY_HEADER_ROWS = [
     ['Date/Time', 'Array', 'Directory']
 ]
 
-# Disable certificate warnings
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+# Guards the dynamic header updates when fleet members are collected concurrently
+HEADER_LOCK = threading.Lock()
+
 
 def get_volume_space(client, fleet_member_name, volumes):
     """
@@ -94,18 +134,19 @@ def get_volume_space(client, fleet_member_name, volumes):
         dict mapping volume name to space usage attributes
     """
     space_values = {}
-    chunk_size = 500
+    batcher = BATCH_SIZES.batcher(fleet_member_name, 'get_volumes_space', VOLUME_DETAIL_BATCH_SIZE,
+                                  maximum=MAX_VOLUME_DETAIL_BATCH_SIZE)
 
-    for i in range(0, len(volumes), chunk_size):
-        volume_chunk = volumes[i:i + chunk_size]
-        response = client.get_volumes_space(context_names=fleet_member_name, names=volume_chunk)
+    for volume_chunk, response in TELEMETRY.iterate('space', fleet_member_name, batcher.batches(
+            volumes, lambda chunk: client.get_volumes_space(context_names=fleet_member_name, names=chunk))):
         if response.status_code == 200:
-            if debug >= 4:
-                print(f"Space values for volumes in array {fleet_member_name}")
+            logger.log(TRACE, "Space values for %d volumes in array %s", len(volume_chunk), fleet_member_name)
             for volume in response.items:
                 space_values[volume.name] = volume.space.__dict__
         else:
-            print(f"Failed to retrieve volume space. Status code: {response.status_code}, Error: {response.errors}")
+            logger.error("Failed to retrieve volume space from %s. Status code: %s, Error: %s", fleet_member_name,
+                         response.status_code, response.errors,
+                         extra={'array': fleet_member_name, 'endpoint': 'get_volumes_space', 'status': response.status_code})
             break
 
     return space_values
@@ -121,28 +162,187 @@ def read_volume_tags(client, fleet_member, volumes):
         dict mapping volume name to tag value
     """
     tags = {}
-    chunk_size = 500
+    batcher = BATCH_SIZES.batcher(fleet_member, 'get_volumes_tags', VOLUME_DETAIL_BATCH_SIZE,
+                                  maximum=MAX_VOLUME_DETAIL_BATCH_SIZE)
 
-    for i in range(0, len(volumes), chunk_size):
-        volume_chunk = volumes[i:i + chunk_size]
-        response = client.get_volumes_tags(context_names=[fleet_member], resource_names=volume_chunk, namespaces=NAMESPACE)
+    for volume_chunk, response in TELEMETRY.iterate('tags', fleet_member, batcher.batches(
+            volumes, lambda chunk: client.get_volumes_tags(context_names=[fleet_member], resource_names=chunk, namespaces=NAMESPACE))):
         # Check the response
         if response.status_code == 200:
-            if debug >= 4:
-                print(f"Tags from {fleet_member} in namespace {NAMESPACE}:")
-                pp.pprint(response.items)
+            logger.log(TRACE, "%d tags from %s in namespace %s", len(response.items), fleet_member, NAMESPACE)
             # Process each tag, which has a context, key, value, namespace, and resource (of a volume)
             for tag in response.items:
                 if tag.namespace == NAMESPACE and tag.key == TAG_KEY:
                     volume = tag.resource.name
                     tags[volume] = tag.value
         else:
-            print(f"Failed to get tags from {fleet_member}. Status code: {response.status_code}, Error: {response.errors}")
+            logger.error("Failed to get tags from %s. Status code: %s, Error: %s", fleet_member, response.status_code,
+                         response.errors, extra={'array': fleet_member, 'endpoint': 'get_volumes_tags', 'status': response.status_code})
             break
 
     return tags
 
-def report_volumes(client, fleet_member, namespace, tag_key):
+async def fetch_volume_details(async_client, fleet_member, volumes):
+    """
+    Retrieve the chargeback tags and space usage of a list of volumes through an AsyncFusionClient.
+    Every tag and space batch is requested at once, at the array's current batch sizes, and the
+    facade's semaphores bound the requests in flight per fleet member and across the fleet.
+    Args:
+        async_client: AsyncFusionClient
+        fleet_member: Name of the array
+        volumes: List of volume names
+    Returns:
+        (tags, space_values): dicts mapping volume name to tag value and to space usage attributes,
+        as returned by read_volume_tags and get_volume_space
+    """
+    import asyncio
+
+    def chunks(endpoint):
+        size = BATCH_SIZES.batcher(fleet_member, endpoint, VOLUME_DETAIL_BATCH_SIZE, maximum=MAX_VOLUME_DETAIL_BATCH_SIZE).size
+        return [volumes[i:i + size] for i in range(0, len(volumes), size)]
+
+    tag_calls = [async_client.get_volumes_tags(context_names=[fleet_member], resource_names=chunk, namespaces=NAMESPACE)
+                 for chunk in chunks('get_volumes_tags')]
+    space_calls = [async_client.get_volumes_space(context_names=fleet_member, names=chunk)
+                   for chunk in chunks('get_volumes_space')]
+    with TELEMETRY.phase('details', fleet_member):
+        responses = await asyncio.gather(*tag_calls, *space_calls)
+
+    tags = {}
+    for response in responses[:len(tag_calls)]:
+        if response.status_code != 200:
+            logger.error("Failed to get tags from %s. Status code: %s, Error: %s", fleet_member, response.status_code,
+                         response.errors, extra={'array': fleet_member, 'endpoint': 'get_volumes_tags', 'status': response.status_code})
+            break
+        for tag in response.items:
+            if tag.namespace == NAMESPACE and tag.key == TAG_KEY:
+                tags[tag.resource.name] = tag.value
+
+    space_values = {}
+    for response in responses[len(tag_calls):]:
+        if response.status_code != 200:
+            logger.error("Failed to retrieve volume space from %s. Status code: %s, Error: %s", fleet_member,
+                         response.status_code, response.errors,
+                         extra={'array': fleet_member, 'endpoint': 'get_volumes_space', 'status': response.status_code})
+            break
+        for volume in response.items:
+            space_values[volume.name] = volume.space.__dict__
+
+    return tags, space_values
+
+def iter_volume_pages(client, fleet_member, page_size=DEFAULT_PAGE_SIZE, continuation_token=None):
+    """
+    Lists the regular volumes on a fleet member one page at a time.
+    Args:
+        client: Fusion API client
+        fleet_member: Name of the array
+        page_size: Number of volumes requested per page, adapted per array between 1 and MAX_VOLUME_PAGE_SIZE
+        continuation_token: Token to resume a previous listing from
+    Yields:
+        (volume names, continuation token for the next page or None after the last page)
+    """
+    batcher = BATCH_SIZES.batcher(fleet_member, 'get_volumes', page_size, maximum=max(page_size, MAX_VOLUME_PAGE_SIZE))
+    # Have the array drop non-regular volumes; the subtype is still checked when it cannot
+    query = list_query(client, 'get_volumes', fields=['name', 'subtype'], subtype='regular')
+    filtered = 'filter' in query
+    for response in TELEMETRY.iterate('listing', fleet_member, paginate(
+            client.get_volumes, batcher=batcher, continuation_token=continuation_token, context_names=[fleet_member],
+            **query)):
+        if response.status_code != 200:
+            logger.error("Failed to retrieve volumes from %s. Status code: %s, Error: %s", fleet_member, response.status_code,
+                         response.errors, extra={'array': fleet_member, 'endpoint': 'get_volumes', 'status': response.status_code})
+            return
+        logger.debug("Finding volumes for array %s (Batch with continuation token: %s)", fleet_member, response.continuation_token)
+        volume_set = []
+        for volume in response.items:
+            if filtered or volume.subtype == 'regular':
+                volume_set.append(volume.name)
+            else:
+                logger.log(TRACE, "Non-regular volume %s found - not reporting it.", volume.name)
+        yield volume_set, response.continuation_token
+
+def group_volume_rows(fleet_member, volume_set, tags, space_values):
+    """
+    Builds the report rows for a page of volumes and groups them by chargeback tag.
+    Args:
+        fleet_member: Name of the array
+        volume_set: List of volume names
+        tags: dict mapping volume name to tag value
+        space_values: dict mapping volume name to space usage attributes
+    Returns:
+        ColumnarRows grouped by tag value
+    """
+    # Dynamically update headers from the first space values seen
+    if space_values and len(VOLUME_HEADER_ROWS[0]) == 3:
+        with HEADER_LOCK:
+            if len(VOLUME_HEADER_ROWS[0]) == 3:
+                first_space = next(iter(space_values.values()))
+                VOLUME_HEADER_ROWS[0] = ['Date/Time', 'Array', 'Volume'] + list(first_space.keys())
+
+    volumes_by_tag = ColumnarRows('Volume', VOLUME_HEADER_ROWS[0][3:])
+    metrics = volumes_by_tag.metrics
+
+    # Process each volume
+    for volume in volume_set:
+        tag = tags.get(volume, 'NoChargebackTag')  # Default to 'NoChargebackTag' if no tag is found
+        space = space_values.get(volume, {})
+        volumes_by_tag.append(tag, NOW, fleet_member, volume, [space.get(key) for key in metrics])
+
+    return volumes_by_tag
+
+def iter_volume_reports(client, fleet_member, namespace, tag_key, page_size=DEFAULT_PAGE_SIZE,
+                        fetch_concurrency=DEFAULT_FETCH_CONCURRENCY, continuation_token=None, async_client=None):
+    """
+    Streams the volume space report for a fleet member, one page of volumes at a time.
+    The tag and space requests for each page run concurrently, and up to fetch_concurrency
+    pages are kept in flight while the next pages are listed. Pages are yielded in listing
+    order, so memory is bounded by page_size * fetch_concurrency.
+    Args:
+        client: Fusion API client
+        fleet_member: Name of the array
+        namespace: Tag namespace
+        tag_key: Tag key (e.g., 'chargeback')
+        page_size: Number of volumes per page
+        fetch_concurrency: Maximum number of concurrent tag and space requests
+        continuation_token: Token to resume a previous listing from
+        async_client: Optional AsyncFusionClient the tags and space values are fetched through,
+                      instead of a thread pool per fleet member
+    Yields:
+        (ColumnarRows grouped by tag value, continuation token to resume
+        after this page or None after the last page), for each page
+    """
+    fetch_concurrency = max(1, fetch_concurrency)
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=fetch_concurrency, thread_name_prefix=f'staas-fetch-{fleet_member}') as executor:
+        for volume_set, next_token in iter_volume_pages(client, fleet_member, page_size, continuation_token):
+            if not volume_set:
+                in_flight.append((volume_set, None, next_token))
+            elif async_client is not None:
+                # Pages already submitted finish on the facade's loop even if the member is abandoned
+                details = async_client.submit(fetch_volume_details(async_client, fleet_member, volume_set))
+                in_flight.append((volume_set, details.result, next_token))
+            else:
+                # Retrieve tags and space values for the volumes in this page at the same time
+                tags_future = executor.submit(read_volume_tags, client, fleet_member, volume_set)
+                space_future = executor.submit(get_volume_space, client, fleet_member, volume_set)
+                in_flight.append((volume_set, functools.partial(_page_details, tags_future, space_future), next_token))
+
+            while len(in_flight) >= fetch_concurrency:
+                yield _volume_page_rows(fleet_member, *in_flight.popleft())
+
+        while in_flight:
+            yield _volume_page_rows(fleet_member, *in_flight.popleft())
+
+def _page_details(tags_future, space_future):
+    return tags_future.result(), space_future.result()
+
+def _volume_page_rows(fleet_member, volume_set, details, next_token):
+    if not volume_set:
+        return ColumnarRows('Volume'), next_token
+    return group_volume_rows(fleet_member, volume_set, *details()), next_token
+
+def report_volumes(client, fleet_member, namespace, tag_key, page_size=DEFAULT_PAGE_SIZE,
+                   fetch_concurrency=DEFAULT_FETCH_CONCURRENCY):
     """
     Collects and groups volume space usage by chargeback tag for a fleet member.
     Args:
@@ -150,77 +350,41 @@ def report_volumes(client, fleet_member, namespace, tag_key):
         fleet_member: Name of the array
         namespace: Tag namespace
         tag_key: Tag key (e.g., 'chargeback')
+        page_size: Number of volumes per page
+        fetch_concurrency: Maximum number of concurrent tag and space requests
     Returns:
-        dict mapping tag value to list of volume info dicts
+        ColumnarRows grouped by tag value
     """
-    volume_set = []
-    response = client.get_volumes(context_names=[fleet_member])
-    if response.status_code == 200:
-        if debug >= 2:
-            print(f"Finding volumes for array {fleet_member}")
-        for volume in response.items:
-            if volume.subtype == 'regular':
-                volume_set.append(volume.name)
-            else:
-                if debug >= 4:
-                    print(f'Non-regular volume {volume.name} found - not reporting it.')
-
-        # Retrieve tags and space values for the volumes
-        tags = read_volume_tags(client, fleet_member, volume_set)
-        space_values = get_volume_space(client, fleet_member, volume_set)
-
-        # Initialize the volumes_by_tag dictionary
-        volumes_by_tag = {}
-
-        # Dynamically update headers if space values exist
-        if space_values:
-            first_space = next(iter(space_values.values()))
-            headers = ['Date/Time', 'Array', 'Volume'] + list(first_space.keys())
-            VOLUME_HEADER_ROWS[0] = headers
-
-        # Process each volume
-        for volume in volume_set:
-            tag = tags.get(volume, 'NoChargebackTag')  # Default to 'NoChargebackTag' if no tag is found
-            space = space_values.get(volume, {})
-            volume_info = {
-                'Date/Time': NOW,
-                'Array': fleet_member,
-                'Volume': volume
-            }
-
-            # Add space attributes dynamically
-            for key in VOLUME_HEADER_ROWS[0][3:]:
-                volume_info[key] = space.get(key, '')
-
-            # Add the volume to the appropriate tag group
-            if tag not in volumes_by_tag:
-                volumes_by_tag[tag] = []
-            volumes_by_tag[tag].append(volume_info)
-
-        return volumes_by_tag
-    else:
-        print(f"Failed to retrieve volumes. Status code: {response.status_code}, Error: {response.errors}")
-        return {}
+    volumes_by_tag = ColumnarRows('Volume')
+    for page, _ in iter_volume_reports(client, fleet_member, namespace, tag_key, page_size, fetch_concurrency):
+        volumes_by_tag.extend(page)
+    return volumes_by_tag
 
-def report_arrays(client, fleet, fleet_members):
+def report_arrays(client, fleet, fleet_members, topology=None):
     """
     Collects space usage for arrays and realms in the fleet.
     Args:
         client: Fusion API client
         fleet: Fleet name
         fleet_members: List of array names
+        topology: FleetTopology for the fleet, fetched once here if not supplied
     Returns:
         (fleet_space_report, realm_space_report): dicts of space usage
     """
+    import pypureclient
+    from packaging.version import Version
+
     fleet_space_report = {}
     realm_space_report = {}
+    realms_supported = Version(pypureclient.__version__) >= Version(REALMS_VERSION)
+    if topology is None and realms_supported:
+        topology = FleetTopology.fetch(client)
 
     for fleet_member in fleet_members:
         # Report array space usage
         response = client.get_arrays_space(context_names=[fleet_member])
         if response.status_code == 200:
-            if debug >= 2:
-                print(f"Space usage for array {fleet_member}")
+            logger.debug("Space usage for array %s", fleet_member)
             for item in response.items:
                 if hasattr(item, 'space'):
                     space = item.space.__dict__
@@ -230,108 +394,414 @@ def report_arrays(client, fleet, fleet_members):
                         fleet_space_report[fleet_member] = []
                     fleet_space_report[fleet_member].append(space_report)
                 else:
-                    print(f"No space information available for array {fleet_member}")
+                    logger.warning("No space information available for array %s", fleet_member)
         else:
-            print(f"Failed to retrieve space usage. Status code: {response.status_code}, Error: {response.errors}")
+            logger.error("Failed to retrieve space usage for %s. Status code: %s, Error: %s", fleet_member,
+                         response.status_code, response.errors,
+                         extra={'array': fleet_member, 'endpoint': 'get_arrays_space', 'status': response.status_code})
 
         # Check API version before reporting realm space usage
-        if Version(pypureclient.__version__) >= Version(REALMS_VERSION):
-            connection_type_response = client.get_fleets_members()
-            if connection_type_response.status_code == 200:
-                for member in connection_type_response.items:
-                    if member.member.name == fleet_member:  # and member.member.is_local == 'true':
-                        # Report realm space usage
-                        response = client.get_realms_space(context_names=[fleet_member])
-                        if response.status_code == 200:
-                            if debug >= 2:
-                                print(f"Space usage for realms in array {fleet_member}")
-                            for item in response.items:
-                                if hasattr(item, 'space'):
-                                    space = item.space.__dict__
-                                    space_report = {'Date/Time': NOW, 'Array': fleet_member, 'Realm': item.name}
-                                    space_report.update(space)
-                                    if item.name not in realm_space_report:
-                                        realm_space_report[item.name] = []
-                                    realm_space_report[item.name].append(space_report)
-                                else:
-                                    print(f"No space information available for realms in array {fleet_member}")
+        if realms_supported:
+            member = topology.member(fleet_member)
+            if member is not None:  # and member.is_local:
+                # Report realm space usage
+                response = client.get_realms_space(context_names=[fleet_member])
+                if response.status_code == 200:
+                    logger.debug("Space usage for realms in array %s", fleet_member)
+                    for item in response.items:
+                        if hasattr(item, 'space'):
+                            space = item.space.__dict__
+                            space_report = {'Date/Time': NOW, 'Array': fleet_member, 'Realm': item.name}
+                            space_report.update(space)
+                            if item.name not in realm_space_report:
+                                realm_space_report[item.name] = []
+                            realm_space_report[item.name].append(space_report)
                         else:
-                            print(f"Failed to retrieve realm space usage. Status code: {response.status_code}, Error: {response.errors}")
+                            logger.warning("No space information available for realms in array %s", fleet_member)
+                else:
+                    logger.error("Failed to retrieve realm space usage for %s. Status code: %s, Error: %s", fleet_member,
+                                 response.status_code, response.errors,
+                                 extra={'array': fleet_member, 'endpoint': 'get_realms_space', 'status': response.status_code})
             else:
-                print(f"Failed to retrieve connection type. Status code: {connection_type_response.status_code}, Error: {connection_type_response.errors}")
+                logger.warning("Array %s is not a member of the fleet topology", fleet_member)
         else:
-            if debug >=2:
-                print("Skipping realm space report as pypureclient version is too low")
+            logger.debug("Skipping realm space report as pypureclient version is too low")
 
     return fleet_space_report, realm_space_report
 
-def report_directories(client, fleet_member):
+def iter_directory_pages(client, fleet_member, page_size=DEFAULT_DIRECTORY_PAGE_SIZE, continuation_token=None,
+                         prefetch_pages=1):
+    """
+    Lists the directories on a fleet member one page at a time. The next pages are requested
+    in the background while the current one is turned into rows.
+    Args:
+        client: Fusion API client
+        fleet_member: Name of the array
+        page_size: Number of directories requested per page, adapted per array between 1 and MAX_DIRECTORY_PAGE_SIZE
+        continuation_token: Token to resume a previous listing from
+        prefetch_pages: Number of pages requested ahead of the one being processed
+    Yields:
+        (ColumnarRows of the page grouped by array, continuation token for the next page or
+        None after the last page)
+    """
+    batcher = BATCH_SIZES.batcher(fleet_member, 'get_directories', page_size,
+                                  maximum=max(page_size, MAX_DIRECTORY_PAGE_SIZE))
+    responses = prefetch(paginate(client.get_directories, batcher=batcher, continuation_token=continuation_token,
+                                  context_names=[fleet_member]),
+                         prefetch_pages, name=f'staas-directories-{fleet_member}')
+    metrics = DIRECTORY_HEADER_ROWS[0][3:]
+    for response in TELEMETRY.iterate('directories', fleet_member, responses):
+        if response.status_code != 200:
+            logger.error("Failed to retrieve directories from %s. Status code: %s, Error: %s", fleet_member,
+                         response.status_code, response.errors,
+                         extra={'array': fleet_member, 'endpoint': 'get_directories', 'status': response.status_code})
+            return
+        logger.debug("Finding directories for array %s (Batch with continuation token: %s)", fleet_member,
+                     response.continuation_token)
+        rows = ColumnarRows('Directory', metrics)
+        known = set(rows.metrics)
+        no_space = 0
+        for directory in response.items:
+            # Dynamically add all attributes from the space object
+            space = directory.space.__dict__ if getattr(directory, 'space', None) else {}
+            if not space:
+                no_space += 1
+            for key in space:
+                if key not in known:
+                    rows.add_metric(key)
+                    known.add(key)
+            rows.append(fleet_member, NOW, fleet_member, directory.name, [space.get(key) for key in rows.metrics])
+        if no_space:
+            logger.warning("No space information available for %d directories on %s", no_space, fleet_member,
+                           extra={'array': fleet_member})
+        metrics = rows.metrics
+
+        # Dynamically update DIRECTORY_HEADER_ROWS from the first page with space information
+        if metrics and len(DIRECTORY_HEADER_ROWS[0]) == 3:
+            with HEADER_LOCK:
+                if len(DIRECTORY_HEADER_ROWS[0]) == 3:
+                    DIRECTORY_HEADER_ROWS[0].extend(metrics)
+        yield rows, response.continuation_token
+
+def report_directories(client, fleet_member, page_size=DEFAULT_DIRECTORY_PAGE_SIZE):
     """
     Collects directory space usage for a fleet member.
     Args:
         client: Fusion API client
         fleet_member: Name of the array
+        page_size: Number of directories requested per page
     Returns:
-        List of directory info dicts
+        ColumnarRows of the directories, grouped by array
     """
-    directory_set = []
-    limit = 200  # Number of directories to process per request
-    continuation_token = None  # Token for paginated requests
+    directory_set = ColumnarRows('Directory')
+    for page, _ in iter_directory_pages(client, fleet_member, page_size):
+        directory_set.extend(page)
+    return directory_set
 
-    while True:
-        # Retrieve directories in chunks of 200
-        response = client.get_directories(context_names=[fleet_member], limit=limit, continuation_token=continuation_token)
-        if response.status_code == 200:
-            if debug >= 2:
-                print(f"Finding directories for array {fleet_member} (Batch with continuation token: {continuation_token})")
-            for directory in response.items:
-                directory_info = {
-                    'Date/Time': NOW,
-                    'Array': fleet_member,
-                    'Directory': directory.name
-                }
-                # Dynamically add all attributes from the space object
-                if hasattr(directory, 'space') and directory.space:
-                    directory_info.update(directory.space.__dict__)
-                else:
-                    print(f"No space information available for directory {directory.name}")
-                directory_set.append(directory_info)
-
-                # Dynamically update DIRECTORY_HEADER_ROWS based on the first directory
-                if len(DIRECTORY_HEADER_ROWS[0]) == 3:  # Only update if headers are not already updated
-                    additional_headers = [key for key in directory_info.keys() if key not in DIRECTORY_HEADER_ROWS[0]]
-                    DIRECTORY_HEADER_ROWS[0].extend(additional_headers)
-
-            # Check if there are more directories to process
-            continuation_token = response.continuation_token
-            if not continuation_token:
-                break  # Exit the loop if there are no more directories
+def restore_headers(progress):
+    """
+    Restores the dynamic header rows from journaled rows, for resumed runs whose
+    journaled pages are never fetched again.
+    Args:
+        progress: Iterable of per-array resume states
+    """
+    with HEADER_LOCK:
+        for state in progress:
+            for page in state['pages']:
+                if page.metrics and len(VOLUME_HEADER_ROWS[0]) == 3:
+                    VOLUME_HEADER_ROWS[0] = page.headers
+            for page in state['directories']:
+                if page.metrics and len(DIRECTORY_HEADER_ROWS[0]) == 3:
+                    DIRECTORY_HEADER_ROWS[0].extend(page.metrics)
+
+def iter_fleet_pages(client, fleet_members, incomplete, workers=1, array_timeout=None,
+                     page_size=DEFAULT_PAGE_SIZE, fetch_concurrency=DEFAULT_FETCH_CONCURRENCY, journal=None,
+                     replay=True, directory_page_size=DEFAULT_DIRECTORY_PAGE_SIZE, async_client=None):
+    """
+    Streams the volume and directory reports of all fleet members, collecting up to
+    `workers` members concurrently. Pages are yielded grouped by fleet member, in fleet
+    member order, so the output does not depend on completion order. Members that are
+    ahead of the consumer buffer at most fetch_concurrency pages, which bounds memory.
+    A member that times out is abandoned: its worker sends no further API calls, and the
+    workers are daemon threads, so an abandoned member does not hold up interpreter exit.
+    Args:
+        client: Fusion API client
+        fleet_members: List of array names
+        incomplete: List that failed or timed out fleet members are appended to
+        workers: Number of fleet members collected concurrently
+        array_timeout: Seconds allowed per fleet member (None for no limit)
+        page_size: Number of volumes per page
+        fetch_concurrency: Maximum number of concurrent tag and space requests per fleet member
+        journal: Optional CheckpointJournal; pages are recorded once the consumer has handled
+                 them and a resumed run continues collecting where it stopped
+        replay: Whether journaled pages are yielded again on resume, for consumers that do not
+                keep their own copy of the pages handled before the interruption
+        directory_page_size: Number of directories requested per page
+        async_client: Optional AsyncFusionClient the volume tags and space values of all members are fetched through
+    Yields:
+        (fleet_member, 'volumes', volumes_by_tag) for each page of volumes and
+        (fleet_member, 'directories', directories) for each page of directories, as ColumnarRows
+    """
+    done = object()
+    started = {}
+    progress = {fleet_member: {'pages': [], 'token': None, 'volumes_done': False, 'directories': [],
+                               'directories_token': None, 'directories_done': False, 'done': False}
+                for fleet_member in fleet_members}
+    if journal is not None:
+        for entry in journal.records:
+            state = progress.get(entry.get('array'))
+            if state is None:
+                continue
+            if entry['type'] == 'page':
+                state['pages'].append(ColumnarRows.from_dict(entry['rows'], 'Volume'))
+                state['token'] = entry['token']
+            elif entry['type'] == 'volumes_done':
+                state['volumes_done'] = True
+            elif entry['type'] == 'directories':
+                state['directories'].append(ColumnarRows.from_dict(entry['rows'], 'Directory'))
+                state['directories_token'] = entry.get('token')
+            elif entry['type'] == 'directories_done':
+                state['directories_done'] = True
+            elif entry['type'] == 'array_done':
+                state['done'] = True
+        for state in progress.values():
+            # The last page was journaled but the end of the listing was not
+            if state['pages'] and state['token'] is None:
+                state['volumes_done'] = True
+            if state['directories'] and state['directories_token'] is None:
+                state['directories_done'] = True
+        restore_headers(progress.values())
+
+    queues = {fleet_member: queue.Queue(maxsize=max(1, fetch_concurrency)) for fleet_member in fleet_members}
+    abandoned = {fleet_member: threading.Event() for fleet_member in fleet_members}
+    # Time members spent blocked on a full queue, waiting for the consumer, which is not held against their timeout
+    paused = {fleet_member: 0.0 for fleet_member in fleet_members}
+    blocked_since = {}
+
+    def collecting_time(fleet_member, waiting_since):
+        now = time.monotonic()
+        blocked = blocked_since.get(fleet_member)
+        return (now - started.get(fleet_member, waiting_since) - paused[fleet_member]
+                - (now - blocked if blocked is not None else 0.0))
+
+    def produce(fleet_member):
+        if abandoned[fleet_member].is_set():
+            return
+        started[fleet_member] = time.monotonic()
+        pages = queues[fleet_member]
+
+        def put(item):
+            try:
+                pages.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            blocked_since[fleet_member] = time.monotonic()
+            try:
+                while not abandoned[fleet_member].is_set():
+                    try:
+                        pages.put(item, timeout=1.0)
+                        return
+                    except queue.Full:
+                        continue
+            finally:
+                # Added before the block is cleared, so the consumer never sees the time in neither
+                paused[fleet_member] += time.monotonic() - blocked_since[fleet_member]
+                del blocked_since[fleet_member]
+
+        state = progress[fleet_member]
+        # Every API call of this member checks whether it was abandoned first
+        member_client = CancellableClient(client, abandoned[fleet_member])
+        try:
+            if not state['volumes_done']:
+                for page in iter_volume_reports(member_client, fleet_member, NAMESPACE, TAG_KEY, page_size, fetch_concurrency,
+                                                continuation_token=state['token'], async_client=async_client):
+                    put(('volumes', page))
+                    if abandoned[fleet_member].is_set():
+                        return
+                put(('volumes_done', None))
+            # Generate directory space report, when supported in fusion
+            if not state['directories_done']:
+                for page in iter_directory_pages(member_client, fleet_member, directory_page_size,
+                                                 continuation_token=state['directories_token']):
+                    put(('directories', page))
+                    if abandoned[fleet_member].is_set():
+                        return
+                put(('directories_done', None))
+        except WorkAbandoned:
+            return
+        except Exception as e:
+            put(('error', e))
+        finally:
+            put((done, None))
+
+    # Members are scheduled in the order they are consumed, so the member being consumed is always running
+    scheduled = queue.Queue()
+    for fleet_member in fleet_members:
+        if not progress[fleet_member]['done']:
+            scheduled.put(fleet_member)
+
+    def work():
+        while True:
+            try:
+                fleet_member = scheduled.get_nowait()
+            except queue.Empty:
+                return
+            produce(fleet_member)
+
+    # Daemon threads rather than an executor, whose threads are joined at exit even when abandoned
+    for n in range(max(1, workers)):
+        threading.Thread(target=work, name=f'staas-collect-{n}', daemon=True).start()
+    try:
+        for fleet_member in fleet_members:
+            state = progress[fleet_member]
+            if state['pages'] or state['directories']:
+                logger.info("Resuming array %s from %d journaled pages", fleet_member,
+                            len(state['pages']) + len(state['directories']))
+            if replay:
+                for page in state['pages']:
+                    yield fleet_member, 'volumes', page
+                for page in state['directories']:
+                    yield fleet_member, 'directories', page
+            if state['done']:
+                continue
+
+            failed = False
+            waiting_since = time.monotonic()
+            while True:
+                try:
+                    kind, page = queues[fleet_member].get(timeout=min(1.0, array_timeout) if array_timeout else None)
+                except queue.Empty:
+                    kind = None
+                # A member that never started is timed out too, its worker is stuck on an abandoned member
+                if kind is not done and array_timeout and collecting_time(fleet_member, waiting_since) > array_timeout:
+                    # The worker thread cannot be interrupted, it is told to stop before its next API call instead
+                    logger.error("Timed out after %ss collecting reports for array %s", array_timeout, fleet_member,
+                                 extra={'array': fleet_member})
+                    abandoned[fleet_member].set()
+                    incomplete.append(fleet_member)
+                    break
+                if kind is None:
+                    continue
+                if kind is done:
+                    # Arrays the client gave up on are collected again when the run is resumed
+                    if journal is not None and not failed and fleet_member not in getattr(client, 'incomplete_arrays', ()):
+                        journal.record({'type': 'array_done', 'array': fleet_member})
+                    break
+                if kind == 'error':
+                    logger.error("Failed to collect reports for array %s: %s", fleet_member, page, extra={'array': fleet_member})
+                    incomplete.append(fleet_member)
+                    failed = True
+                    continue
+                if kind in ('volumes_done', 'directories_done'):
+                    # A listing that stopped on a failed request is continued from its last page on resume
+                    if journal is not None and fleet_member not in getattr(client, 'incomplete_arrays', ()):
+                        journal.record({'type': kind, 'array': fleet_member})
+                    continue
+                page, next_token = page
+                yield fleet_member, kind, page
+                entry = {'type': 'page' if kind == 'volumes' else 'directories', 'array': fleet_member,
+                         'token': next_token}
+                if journal is not None:
+                    entry['rows'] = page.to_dict() if replay else {}
+                    journal.record(entry)
+    finally:
+        # Members not collected yet are skipped and the running ones stop before their next call
+        for event in abandoned.values():
+            event.set()
+
+def collect_fleet(client, fleet_members, workers=1, array_timeout=None, page_size=DEFAULT_PAGE_SIZE,
+                  fetch_concurrency=DEFAULT_FETCH_CONCURRENCY, directory_page_size=DEFAULT_DIRECTORY_PAGE_SIZE):
+    """
+    Collects volume and directory space reports for all fleet members, optionally in parallel.
+    Results are merged in fleet member order, so the reports do not depend on completion order.
+    Args:
+        client: Fusion API client
+        fleet_members: List of array names
+        workers: Number of fleet members collected concurrently
+        array_timeout: Seconds allowed per fleet member (None for no limit)
+        page_size: Number of volumes per page
+        fetch_concurrency: Maximum number of concurrent tag and space requests per fleet member
+        directory_page_size: Number of directories requested per page
+    Returns:
+        (volume_space_report, directory_space_report, incomplete): merged reports and the
+        list of fleet members that failed or timed out
+    """
+    incomplete = []
+    pages = iter_fleet_pages(client, fleet_members, incomplete, workers, array_timeout, page_size, fetch_concurrency,
+                             directory_page_size=directory_page_size)
+    volume_space_report, directory_space_report = merge_fleet_pages(pages)
+    return volume_space_report, directory_space_report, incomplete
+
+def merge_fleet_pages(pages):
+    """
+    Merges the pages streamed by iter_fleet_pages into grouped reports.
+    Args:
+        pages: Iterable of (fleet_member, kind, page) as yielded by iter_fleet_pages
+    Returns:
+        (volume_space_report, directory_space_report): ColumnarRows grouped by tag and by array
+    """
+    volume_space_report = ColumnarRows('Volume')
+    directory_space_report = ColumnarRows('Directory')
+    for fleet_member, kind, page in pages:
+        if kind == 'volumes':
+            volume_space_report.extend(page)
         else:
-            print(f"Failed to retrieve directories. Status code: {response.status_code}, Error: {response.errors}")
-            break
+            directory_space_report.extend(page)
+    return volume_space_report, directory_space_report
 
-    return directory_set
+def group_frame(report_data, group, data):
+    """
+    Builds the DataFrame of one group of a report, straight from the columns for ColumnarRows.
+    """
+    if isinstance(report_data, ColumnarRows):
+        return report_data.to_dataframe(group)
+    import pandas as pd
+
+    return pd.DataFrame(data)
 
-def save_report_to_excel(report_data, headers, report_path, sheet_prefix):
+def save_report_to_excel(report_data, headers, report_path, sheet_prefix, engine='openpyxl'):
     """
     Writes grouped report data to an Excel file, appending or creating sheets as needed.
     Args:
-        report_data: dict mapping group (tag/array) to list of dicts
+        report_data: ColumnarRows, or dict mapping group (tag/array) to list of dicts
         headers: list of column headers
         report_path: output Excel file path
         sheet_prefix: prefix for worksheet names
+        engine: 'openpyxl' or 'streaming' (constant-memory StreamingExcelWriter)
     """
+    if engine == 'streaming':
+        try:
+            with StreamingExcelWriter(report_path, sheet_prefix, headers) as writer:
+                writer.write_pages([report_data])
+        except PermissionError as e:
+            logger.error("PermissionError: %s. Please ensure the file is not open in another application.", e)
+        return
+
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    # The workbook is written next to the target and moved into place, so an interrupted
+    # write leaves the previous file intact for a resumed run (pandas needs the .xlsx extension)
+    base, extension = os.path.splitext(report_path)
+    tmp_path = f"{base}.tmp{extension}"
     try:
         # Check if the file exists
+        book = None
         if os.path.exists(report_path):
             try:
                 book = load_workbook(report_path)
-                with pd.ExcelWriter(report_path, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
+            except workbook_errors() as e:
+                set_aside_workbook(report_path, e)
+        if book is not None:
+            try:
+                shutil.copyfile(report_path, tmp_path)
+                with pd.ExcelWriter(tmp_path, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
                     for group, data in report_data.items():
                         if not data:
-                            print(f"Warning: No data for group '{group}'. Skipping.")
+                            logger.warning("No data for group '%s'. Skipping.", group)
                             continue
-                        df = pd.DataFrame(data)
+                        df = group_frame(report_data, group, data)
                         sheet_name = f"{sheet_prefix} {group}"
                         if sheet_name in book.sheetnames:
                             startrow = book[sheet_name].max_row
@@ -340,45 +810,200 @@ def save_report_to_excel(report_data, headers, report_path, sheet_prefix):
                             # Write headers when creating a new sheet
                             df.to_excel(writer, sheet_name=sheet_name, index=False, header=headers)
             except (KeyError, ValueError) as e:
-                print(f"Error processing workbook: {e}. Creating a new file.")
-                with pd.ExcelWriter(report_path, engine='openpyxl') as writer:
-                    for group, data in report_data.items():
-                        if not data:
-                            continue
-                        df = pd.DataFrame(data)
-                        # Write headers when creating a new file
-                        df.to_excel(writer, sheet_name=f"{sheet_prefix} {group}", index=False, header=headers)
-        else:
-            with pd.ExcelWriter(report_path, engine='openpyxl') as writer:
+                logger.warning("Error processing workbook: %s. Creating a new file.", e)
+                book = None
+        if book is None:
+            with pd.ExcelWriter(tmp_path, engine='openpyxl') as writer:
                 for group, data in report_data.items():
                     if not data:
                         continue
-                    df = pd.DataFrame(data)
+                    df = group_frame(report_data, group, data)
                     # Write headers when creating a new file
                     df.to_excel(writer, sheet_name=f"{sheet_prefix} {group}", index=False, header=headers)
+        os.replace(tmp_path, report_path)
     except PermissionError as e:
-        print(f"PermissionError: {e}. Please ensure the file is not open in another application.")
+        logger.error("PermissionError: %s. Please ensure the file is not open in another application.", e)
     except ValueError as e:
-        print(f"ValueError: {e}. Please check the structure of report_data.")
+        logger.error("ValueError: %s. Please check the structure of report_data.", e)
+    finally:
+        # A failed write leaves the previous workbook as it was, and no partial copy next to it
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def render_report_from_history(history, report, name_header, month, report_path, sheet_prefix):
+    """
+    Renders one month of a report from the history store into a new Excel file,
+    one worksheet per group (tag or array). The workbook is streamed to disk, never re-read.
+    Args:
+        history: ReportHistory store
+        report: Report name in the store ('volumes' or 'directories')
+        name_header: Header of the item name column ('Volume' or 'Directory')
+        month: Month to render (YYYY-MM)
+        report_path: output Excel file path
+        sheet_prefix: prefix for worksheet names
+    """
+    headers = history.headers(report, name_header)
+    groups = history.groups(report, month)
+    if not groups:
+        logger.warning("No %s history for %s. Skipping %s.", report, month, report_path)
+        return
+    try:
+        with StreamingExcelWriter(report_path, sheet_prefix, headers, keep_existing=False) as writer:
+            for group in groups:
+                writer.write_rows(group, history.iter_rows(report, month, group))
+    except PermissionError as e:
+        logger.error("PermissionError: %s. Please ensure the file is not open in another application.", e)
+
+def import_workbooks_into_history(history, report_dir, month):
+    """
+    Imports the month's existing workbooks into the history store, the first time the store
+    is used in that month, so that the rows collected before it existed are kept when the
+    workbooks are rendered from the store.
+    Args:
+        history: ReportHistory store
+        report_dir: Directory for the reporting files
+        month: Month of the workbooks (YYYY-MM)
+    """
+    for report, name_header, sheet_prefix, filename in (
+            ('volumes', 'Volume', 'Tag', f"Space-Report-Volumes-{month}.xlsx"),
+            ('directories', 'Directory', 'Directory', f"Space-Report-Directories-{month}.xlsx")):
+        report_path = os.path.join(report_dir, filename)
+        if not os.path.exists(report_path) or history.count(report, month):
+            continue
+        try:
+            count = history.import_workbook(report, report_path, name_header, sheet_prefix)
+        except workbook_errors() as e:
+            set_aside_workbook(report_path, e)
+            continue
+        except OSError as e:
+            logger.error("Could not import %s into the history store: %s. It will be replaced by the store's rows.",
+                         report_path, e)
+            continue
+        logger.info("Imported %d existing %s rows from %s into the history store", count, report, report_path)
+
+def render_reports_from_history(history, report_dir, month):
+    """
+    Renders the volume and directory workbooks for a month from the history store.
+    Args:
+        history: ReportHistory store
+        report_dir: Directory for the reporting files
+        month: Month to render (YYYY-MM)
+    """
+    volumes_report_path = os.path.join(report_dir, f"Space-Report-Volumes-{month}.xlsx")
+    render_report_from_history(history, 'volumes', 'Volume', month, volumes_report_path, 'Tag')
+
+    directories_report_path = os.path.join(report_dir, f"Space-Report-Directories-{month}.xlsx")
+    render_report_from_history(history, 'directories', 'Directory', month, directories_report_path, 'Directory')
+
+def run_reports(client, topology, args, journal=None, history=None):
+    """
+    Collects the volume and directory reports of every fleet and saves them to the history
+    store or the workbooks selected by args, for the run stamped NOW in month MNTH.
+    Args:
+        client: Fusion API client
+        topology: FleetTopology of the fleets reported on
+        args: Parsed 'report' arguments
+        journal: Optional CheckpointJournal the collected pages are recorded in
+        history: Optional ReportHistory the pages are appended to instead of the workbooks
+    Returns:
+        List of fleet members whose reports are incomplete
+    """
+    # Keep the rows of workbooks written before the history store was used this month
+    if history is not None:
+        import_workbooks_into_history(history, args.reportdir, MNTH)
+
+    # Fetch the volume details of all members through one event loop, limited per member and in total
+    async_client = None
+    if args.async_fetch:
+        async_client = AsyncFusionClient(client, max_concurrency=max(1, args.workers) * max(1, args.fetch_concurrency),
+                                         per_array_concurrency=args.fetch_concurrency)
+
+    # At some point, there may be multiple fleets visible from a single fusion end-point
+    all_incomplete = []
+    for fleet in topology.fleets:
+        fleet_members = topology.members_of(fleet)
+
+        incomplete = []
+        pages = iter_fleet_pages(client, fleet_members, incomplete, workers=args.workers,
+                                 array_timeout=args.array_timeout, page_size=args.page_size,
+                                 fetch_concurrency=args.fetch_concurrency, journal=journal,
+                                 replay=history is None, directory_page_size=args.directory_page_size,
+                                 async_client=async_client)
+        volumes_report_path = os.path.join(args.reportdir, f"Space-Report-Volumes-{MNTH}.xlsx")
+        directories_report_path = os.path.join(args.reportdir, f"Space-Report-Directories-{MNTH}.xlsx")
+
+        # Save the reports
+        if history is not None:
+            # Pages are appended to the history store as they are collected
+            for fleet_member, kind, page in pages:
+                with TELEMETRY.phase('history', fleet_member):
+                    if kind == 'volumes':
+                        history.append('volumes', page, 'Volume')
+                    else:
+                        history.append('directories', page, 'Directory')
+        elif args.excel_engine == 'streaming':
+            # Pages are streamed straight into the workbooks as they are collected
+            try:
+                with StreamingExcelWriter(volumes_report_path, 'Tag', lambda: VOLUME_HEADER_ROWS[0]) as volume_writer, \
+                        StreamingExcelWriter(directories_report_path, 'Directory', lambda: DIRECTORY_HEADER_ROWS[0]) as directory_writer:
+                    for fleet_member, kind, page in pages:
+                        with TELEMETRY.phase('excel', fleet_member):
+                            if kind == 'volumes':
+                                volume_writer.write_pages([page])
+                            else:
+                                directory_writer.write_pages([page])
+            except PermissionError as e:
+                logger.error("PermissionError: %s. Please ensure the file is not open in another application.", e)
+        else:
+            volume_space_report, directory_space_report = merge_fleet_pages(pages)
+            with TELEMETRY.phase('excel'):
+                save_report_to_excel(volume_space_report, VOLUME_HEADER_ROWS[0], volumes_report_path, 'Tag')
+
+                # Generate directory space report, when supported in fusion
+                save_report_to_excel(directory_space_report, DIRECTORY_HEADER_ROWS[0], directories_report_path, 'Directory')
+
+        incomplete.extend(fleet_member for fleet_member in client.incomplete_arrays
+                          if fleet_member in fleet_members and fleet_member not in incomplete)
+        if incomplete:
+            logger.warning("Reports are incomplete for arrays: %s", ', '.join(incomplete))
+            all_incomplete.extend(incomplete)
+    if async_client is not None:
+        async_client.close()
+
+    # Render this month's workbooks from the history store
+    if history is not None and not args.skip_excel:
+        with TELEMETRY.phase('excel'):
+            render_reports_from_history(history, args.reportdir, MNTH)
+    return all_incomplete
 
 # Main script
 if __name__ == "__main__":
     # Parse command-line arguments
     args = parse_arguments("report")
+    setup_logging(args.log_level or 'info', args.log_format, args.log_file, args.trace_sample)
 
-    # Read the configuration file
-    config_path = os.path.join(args.config)
-    if not os.path.exists(config_path):
-        print(f"Configuration file not found: {config_path}")
-        exit(1)
-
-    config_spreadsheet = pd.ExcelFile(config_path)
+    history = ReportHistory(args.history_db) if args.history_db else None
+    if args.render_only:
+        if history is None:
+            logger.error("--render-only requires --history-db")
+            exit(1)
+        render_reports_from_history(history, args.reportdir, args.month or datetime.now().strftime("%Y-%m"))
+        history.close()
+        exit(0)
 
-    # Read the Excel file
-    fleet_df = config_spreadsheet.parse('Fleet')
+    # Read the configuration file, or its compiled form when the file has not changed
+    try:
+        config = load_config(args.config, args.config_cache)
+    except ConfigError as e:
+        logger.error("%s", e)
+        exit(1)
+    for warning in config.warnings:
+        logger.warning("%s", warning)
 
     # Extract global variables from the Fleet sheet
-    global_variables = fleet_df.iloc[0].to_dict()
+    global_variables = config.settings
+    if args.log_level is None and isinstance(global_variables.get('LOG_LEVEL'), str):
+        logging.getLogger().setLevel(log_level(global_variables['LOG_LEVEL']))
 
     # Assign global variables
     USER_NAME = os.getenv('PURE_USER_NAME')
@@ -390,11 +1015,39 @@ if __name__ == "__main__":
     MNTH = datetime.now().strftime("%Y-%m")
     NOW = datetime.now().strftime("%Y-%m-%d %H:%M")
 
-    print(f"Connecting to Fusion server: {FUSION_SERVER} with user: {USER_NAME}")
+    # Journal the collected pages so an interrupted run can be resumed with --resume
+    journal = None
+    if args.checkpoint or args.resume:
+        journal_path = args.checkpoint or checkpoint_path(args.config, 'reporting')
+        journal = CheckpointJournal(journal_path, resume=args.resume)
+        runs = journal.of_type('run')
+        if runs:
+            # A resumed run keeps the timestamp of the run it continues
+            NOW, MNTH = runs[0]['now'], runs[0]['month']
+            logger.info("Resuming the run started at %s from %s", NOW, journal_path)
+        else:
+            journal.record({'type': 'run', 'now': NOW, 'month': MNTH})
 
-    client = initialise_client(FUSION_SERVER, USER_NAME, API_TOKEN)
-    if not client:
+    if args.cache_mode == 'replay' and not args.response_cache:
+        logger.error("--cache-mode replay requires --response-cache")
         exit(1)
+
+    if args.cache_mode == 'replay':
+        logger.info("Replaying recorded responses from %s, Fusion is not contacted", args.response_cache)
+        client = None
+    else:
+        logger.info("Connecting to Fusion server: %s with user: %s", FUSION_SERVER, USER_NAME)
+
+        client = initialise_client(FUSION_SERVER, USER_NAME, API_TOKEN, timeout=args.request_timeout)
+        if not client:
+            exit(1)
+        # Retry transient failures and stop sending to arrays that keep failing
+        client = ResilientClient(client, RetryPolicy(args.retries), CircuitBreaker(args.breaker_threshold, args.breaker_reset))
+    # Serve repeated reads from the response cache
+    if args.response_cache:
+        client = CachingClient(client, args.response_cache, ttls=dict(args.cache_ttl), mode=args.cache_mode)
+    # Record every API call in the run metrics
+    client = InstrumentedClient(client, TELEMETRY, measure_size=args.metrics_bytes)
     # Check to see minimum version of 2.41 & array admin privileges for this user
     role = check_purity_role(client, USER_NAME) 
     if not (role == "array_admin" or role == "read_only)"):
@@ -402,40 +1055,30 @@ if __name__ == "__main__":
     if not check_api_version(client, 2.42):
         exit(2)
 
-    # Get the arrays for reporting contexts for the nominated fleet
-    fleets = list_fleets(client)
+    BATCH_SIZES = BatchSizeStore(args.batch_state)
 
-    # At some point, there may be multiple fleets visible from a single fusion end-point
-    for fleet in fleets:
-        volume_space_report = {}
-        directory_space_report = {}
-        fleet_members = list_members(client, [fleet])
-
-        for fleet_member in fleet_members:
+    # Get the arrays for reporting contexts for the nominated fleet
+    topology = FleetTopology.load(client, cache_path=args.topology_cache, ttl=args.topology_ttl)
 
-            # Generate volume space report
-            volumes_by_tag = report_volumes(client, fleet_member, NAMESPACE, TAG_KEY)
-            for tag, volumes in volumes_by_tag.items():
-                if tag not in volume_space_report:
-                    volume_space_report[tag] = []
-                volume_space_report[tag].extend(volumes)
+    all_incomplete = run_reports(client, topology, args, journal, history)
+    if history is not None:
+        history.close()
 
-            
-            # Generate directory space report, when supported in fusion
-            #if not fleet[fleet_member].is_local:
-            #    if debug >= 2:
-            #        print(f"Skipping non-local fleet member: {fleet_member.name}")
-            #    continue
-            directories = report_directories(client, fleet_member)
-            if fleet_member not in directory_space_report:
-                directory_space_report[fleet_member] = []
-            directory_space_report[fleet_member].extend(directories)
-            
+    # Remember the tuned batch sizes for the next run
+    BATCH_SIZES.save()
+    if args.response_cache:
+        client.close()
 
-        # Save the reports
-        volumes_report_path = os.path.join(args.reportdir, f"Space-Report-Volumes-{MNTH}.xlsx")
-        save_report_to_excel(volume_space_report, VOLUME_HEADER_ROWS[0], volumes_report_path, 'Tag')
+    # Export the run metrics
+    if args.metrics_json:
+        TELEMETRY.write_json(args.metrics_json)
+    if args.metrics_prom:
+        TELEMETRY.write_prometheus(args.metrics_prom)
+    for fleet_member, seconds in TELEMETRY.slowest_arrays():
+        logger.info("Array %s: %.1fs in API calls", fleet_member, seconds)
 
-        # Generate directory space report, when supported in fusion
-        directories_report_path = os.path.join(args.reportdir, f"Space-Report-Directories-{MNTH}.xlsx")
-        save_report_to_excel(directory_space_report, DIRECTORY_HEADER_ROWS[0], directories_report_path, 'Directory')
\ No newline at end of file
+    # Keep the journal while arrays are incomplete so they can be collected with --resume
+    if journal is not None and not all_incomplete:
+        journal.remove()
+    elif journal is not None:
+        journal.close()
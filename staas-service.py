@@ -0,0 +1,379 @@
+# This file is part of STAAS-Reporting-Fusion.
+#
+# STAAS-Reporting-Fusion is licensed under the BSD 2-Clause License.
+# You may obtain a copy of the License at
+#
+#     https://opensource.org/licenses/BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+staas-service.py
+----------------
+Runs the reporting and tagging jobs from one long-running process, so that frequent space
+samples do not pay the start-up, authentication and fleet discovery of a new run each time.
+- Keeps one Fusion session, renewed before it expires, and the fleet topology in memory
+- Samples space usage every --report-interval seconds and reconciles tags daily at --tag-at
+- Accepts 'run report', 'run tag', 'status' and 'stop' on a local control socket
+
+Usage:
+    python staas-service.py --config config/STAAS_Config.xlsx --reportdir reports/ --history-db reports/history.db
+    python staas-service.py --config config/STAAS_Config.xlsx --reportdir reports/ --send "run report"
+
+See README.md for more details.
+"""
+
+import importlib.util
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime
+from staas_common import (
+    parse_arguments,
+    initialise_client,
+    check_api_version,
+    load_config,
+    ConfigError,
+    setup_logging,
+    log_level,
+    ResilientClient,
+    SessionClient,
+    InstrumentedClient,
+    RetryPolicy,
+    CircuitBreaker,
+    FleetTopology,
+    BatchSizeStore,
+    ReportHistory,
+    TaggingRuleEngine,
+    WriteRateLimiter,
+    JobSchedule,
+    Telemetry,
+)
+
+logger = logging.getLogger('staas.service')
+JOBS = ('report', 'tag')
+
+# Jobs requested on the control socket, and the state reported by 'status'
+TRIGGERS = queue.Queue()
+STOP = threading.Event()
+STATUS = {'started': None, 'session_renewals': 0, 'jobs': {job: {'runs': 0} for job in JOBS}}
+STATUS_LOCK = threading.Lock()
+
+# API call and phase timings of all jobs run by this process
+TELEMETRY = Telemetry('service')
+
+
+def load_script(filename):
+    """
+    Imports one of the hyphenated top-level scripts as a module, without running its main block.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    spec = importlib.util.spec_from_file_location(filename[:-3].replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def send_command(socket_path, command):
+    """
+    Sends a command to a running service and returns its reply.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(30)
+        connection.connect(socket_path)
+        connection.sendall(command.encode('utf-8') + b'\n')
+        connection.shutdown(socket.SHUT_WR)
+        reply = b''
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                return reply.decode('utf-8')
+            reply += data
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """
+    One command per connection: 'run report', 'run tag', 'status' or 'stop'.
+    """
+
+    def handle(self):
+        command = self.rfile.readline().decode('utf-8', errors='replace').strip().lower()
+        words = command.split()
+        if len(words) == 2 and words[0] == 'run' and words[1] in JOBS:
+            TRIGGERS.put(words[1])
+            reply = f"queued {words[1]}"
+        elif command == 'status':
+            with STATUS_LOCK:
+                reply = json.dumps(STATUS, indent=2, default=str)
+        elif command == 'stop':
+            STOP.set()
+            TRIGGERS.put(None)
+            reply = "stopping"
+        else:
+            reply = f"unknown command '{command}', expected 'run report', 'run tag', 'status' or 'stop'"
+        logger.info("Control command '%s': %s", command, reply.splitlines()[0] if reply else '')
+        self.wfile.write(reply.encode('utf-8') + b'\n')
+
+
+def start_control_server(socket_path):
+    """
+    Listens for commands on a Unix socket only the service user can use, in a daemon thread.
+    """
+    if os.path.exists(socket_path):
+        try:
+            send_command(socket_path, 'status')
+        except OSError:
+            os.remove(socket_path)  # Left behind by a service that did not shut down cleanly
+        else:
+            raise RuntimeError(f"A service is already listening on {socket_path}")
+    server = socketserver.ThreadingUnixStreamServer(socket_path, ControlHandler)
+    os.chmod(socket_path, 0o600)
+    threading.Thread(target=server.serve_forever, name='staas-control', daemon=True).start()
+    return server
+
+
+class Service:
+    """
+    The jobs of the service and what they share between runs: the client session, the
+    configuration, the fleet topology and the history store.
+    """
+
+    def __init__(self, args, config, client):
+        self.args = args
+        self.config = config
+        self.client = client
+        self.topology = None
+        self.history = None
+        self.reporting = load_script('staas-reporting.py')
+        self.tagging = load_script('staas-tag_vols.py')
+        for script in (self.reporting, self.tagging):
+            script.TELEMETRY = TELEMETRY
+            script.BATCH_SIZES = BatchSizeStore(args.batch_state)
+        self.tagging.WRITES_IN_FLIGHT = args.writes_in_flight
+        self.tagging.WRITE_LIMITER = WriteRateLimiter(args.write_rate, args.endpoint_write_rate)
+
+    def refresh(self):
+        """
+        Picks up configuration changes and refreshes the topology once it is older than --topology-ttl.
+        """
+        try:
+            config = load_config(self.args.config, self.args.config_cache)
+        except ConfigError as e:
+            logger.error("Keeping the previous configuration: %s", e)
+        else:
+            if config.settings.get('FUSION_SERVER') != self.config.settings.get('FUSION_SERVER'):
+                logger.warning("FUSION_SERVER changed in %s, restart the service to use it", self.args.config)
+            self.config = config
+        namespace = self.config.settings.get('NAMESPACE', '')
+        self.reporting.NAMESPACE = self.tagging.NAMESPACE = namespace
+        self.reporting.TAG_KEY = self.tagging.TAG_KEY = "chargeback"
+        self.tagging.TAGGING_RULES = self.config.tagging_rules
+        self.tagging.RULE_ENGINE = TaggingRuleEngine(self.config.tagging_rules)
+
+        if self.topology is None or time.time() - self.topology.fetched_at > self.args.topology_ttl:
+            topology = FleetTopology.load(self.client, cache_path=self.args.topology_cache, ttl=self.args.topology_ttl)
+            if topology.members() or self.topology is None:
+                self.topology = topology
+            else:
+                logger.warning("Fleet discovery returned no members, keeping the previous topology")
+
+    def run_report(self):
+        """
+        Collects one space sample of all fleet members.
+        Returns:
+            List of fleet members whose reports are incomplete
+        """
+        # The store is opened by the thread running the jobs, SQLite connections stay in their thread
+        if self.history is None and self.args.history_db:
+            self.history = ReportHistory(self.args.history_db)
+        now = datetime.now()
+        self.reporting.NOW = now.strftime("%Y-%m-%d %H:%M")
+        self.reporting.MNTH = now.strftime("%Y-%m")
+        return self.reporting.run_reports(self.client, self.topology, self.args, history=self.history)
+
+    def run_tag(self):
+        """
+        Reconciles the chargeback tags of all fleet members with the tagging rules.
+        Returns:
+            List of fleet members that were not completely tagged
+        """
+        self.tagging.APPLIED_TAGS, self.tagging.DONE_ARRAYS = {}, set()
+        incomplete = self.tagging.tag_fleet(self.client, self.topology, self.args.workers, reconcile=True)
+        return incomplete + [fleet_member for fleet_member in self.client.incomplete_arrays if fleet_member not in incomplete]
+
+    def run(self, job):
+        """
+        Runs a job, recording its outcome in STATUS. A failed job is logged and does not stop the service.
+        """
+        logger.info("Starting %s job", job)
+        started = time.time()
+        with STATUS_LOCK:
+            STATUS['jobs'][job]['running_since'] = datetime.fromtimestamp(started).isoformat(timespec='seconds')
+        self.client.reset_incomplete()
+        try:
+            self.refresh()
+            incomplete = self.run_report() if job == 'report' else self.run_tag()
+            result = f"incomplete: {', '.join(incomplete)}" if incomplete else 'ok'
+        except Exception as e:
+            logger.error("%s job failed: %s\n%s", job, e, traceback.format_exc())
+            result = f"failed: {e}"
+        for script in (self.reporting, self.tagging):
+            script.BATCH_SIZES.save()
+        if self.args.metrics_json:
+            TELEMETRY.write_json(self.args.metrics_json)
+        if self.args.metrics_prom:
+            TELEMETRY.write_prometheus(self.args.metrics_prom)
+        seconds = time.time() - started
+        logger.info("Finished %s job in %.1fs: %s", job, seconds, result)
+        with STATUS_LOCK:
+            status = STATUS['jobs'][job]
+            status.pop('running_since', None)
+            status.update(runs=status['runs'] + 1, last_run=datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+                          last_duration=round(seconds, 1), last_result=result)
+            STATUS['session_renewals'] = self.client.renewals
+
+    def close(self):
+        if self.history is not None:
+            self.history.close()
+
+
+def serve(service, schedules):
+    """
+    Runs the scheduled jobs and the jobs requested on the control socket, one at a time,
+    until STOP is set, then closes the service.
+    """
+    try:
+        _serve(service, schedules)
+    finally:
+        service.close()
+
+
+def _serve(service, schedules):
+    due = {job: schedule.first_run(time.time()) for job, schedule in schedules.items() if schedule.enabled}
+    while not STOP.is_set():
+        with STATUS_LOCK:
+            for job in JOBS:
+                STATUS['jobs'][job]['next_run'] = (datetime.fromtimestamp(due[job]).isoformat(timespec='seconds')
+                                                   if job in due else None)
+        job = min(due, key=due.get) if due else None
+        timeout = max(0.0, due[job] - time.time()) if job else None
+        try:
+            # Wake up at least once a minute, so a clock change cannot delay a job for long
+            requested = TRIGGERS.get(timeout=min(timeout, 60.0) if timeout is not None else None)
+        except queue.Empty:
+            if time.time() < due[job]:
+                continue
+            due[job] = schedules[job].next_run(time.time())
+            service.run(job)
+            continue
+        if requested is not None:
+            service.run(requested)
+
+
+def main():
+    """
+    Main entry point for the service: connects once, then runs jobs until stopped.
+    """
+    args = parse_arguments("service")
+    if args.send:
+        if not args.control_socket and not args.reportdir:
+            print("--send needs --control-socket, or the --reportdir the service was started with", file=sys.stderr)
+            exit(2)
+        socket_path = args.control_socket or os.path.join(args.reportdir, ".staas-service.sock")
+        try:
+            print(send_command(socket_path, args.send), end='')
+        except OSError as e:
+            print(f"No service is listening on {socket_path}: {e}", file=sys.stderr)
+            exit(1)
+        return
+
+    setup_logging(args.log_level or 'info', args.log_format, args.log_file, args.trace_sample)
+    # Only optional on the command line for --send
+    missing = [option for option, value in (('--config', args.config), ('--reportdir', args.reportdir)) if not value]
+    if missing:
+        logger.error("Starting the service requires %s", ' and '.join(missing))
+        exit(2)
+    socket_path = args.control_socket or os.path.join(args.reportdir, ".staas-service.sock")
+    try:
+        config = load_config(args.config, args.config_cache)
+    except ConfigError as e:
+        logger.error("%s", e)
+        exit(1)
+    for warning in config.warnings:
+        logger.warning("%s", warning)
+    if args.log_level is None and isinstance(config.settings.get('LOG_LEVEL'), str):
+        logging.getLogger().setLevel(log_level(config.settings['LOG_LEVEL']))
+
+    user_name = os.getenv('PURE_USER_NAME')
+    api_token = os.getenv('PURE_API_TOKEN')
+    fusion_server = config.settings.get('FUSION_SERVER', '')
+    logger.info("Connecting to Fusion server: %s with user: %s", fusion_server, user_name)
+    try:
+        session = SessionClient(lambda: initialise_client(fusion_server, user_name, api_token, timeout=args.request_timeout),
+                                max_age=args.session_max_age)
+    except ConnectionError as e:
+        logger.error("%s", e)
+        exit(1)
+    # Retry transient failures, stop sending to arrays that keep failing and record every call
+    client = InstrumentedClient(ResilientClient(session, RetryPolicy(args.retries),
+                                                CircuitBreaker(args.breaker_threshold, args.breaker_reset)), TELEMETRY,
+                                measure_size=args.metrics_bytes)
+    if not check_api_version(client, 2.42):
+        exit(2)
+
+    service = Service(args, config, client)
+    try:
+        server = start_control_server(socket_path)
+    except (OSError, RuntimeError) as e:
+        logger.error("Cannot listen on %s: %s", socket_path, e)
+        exit(1)
+
+    def stop(signum, frame):
+        STOP.set()
+        TRIGGERS.put(None)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    with STATUS_LOCK:
+        STATUS['started'] = datetime.now().isoformat(timespec='seconds')
+    schedules = {'report': JobSchedule(interval=args.report_interval), 'tag': JobSchedule(at=args.tag_at)}
+    logger.info("Service started, control socket %s", socket_path)
+    try:
+        serve(service, schedules)
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        logger.info("Service stopped")
+
+if __name__ == "__main__":
+    main()
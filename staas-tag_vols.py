@@ -25,12 +25,10 @@
 # CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 
+import logging
 import os
-import pandas as pd
-import pypureclient
-import urllib3
-import re
-import pprint as pp
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 """
 staas-tag_vols.py
@@ -44,15 +42,32 @@ Usage:
 See README.md for more details.
 """
 
-from pypureclient import flasharray
-from pypureclient.flasharray import Client, PureError
 from staas_common import (
     parse_arguments,
     check_purity_role,
     check_api_version,
     initialise_client,
-    list_fleets,
-    list_members
+    ResilientClient,
+    CachingClient,
+    InstrumentedClient,
+    Telemetry,
+    RetryPolicy,
+    CircuitBreaker,
+    FleetTopology,
+    BatchSizeStore,
+    TaggingRuleEngine,
+    paginate,
+    list_query,
+    parse_volume_names,
+    WriteRateLimiter,
+    CheckpointJournal,
+    checkpoint_path,
+    DEFAULT_WRITES_IN_FLIGHT,
+    TRACE,
+    setup_logging,
+    load_config,
+    ConfigError,
+    log_level
 )
 
 USER_NAME=""
@@ -61,294 +76,342 @@ FUSION_SERVER=""
 NAMESPACE=""
 TAG_KEY = "chargeback"
 TAGGING_RULES = {}
-host_group_volumes_by_volume = {}
-host_volumes_by_volume = {}
-debug=7
-
-# If the volume is in a realm or pod, grab those names
-def match_volume_name(volume_name):
+RULE_ENGINE = TaggingRuleEngine(TAGGING_RULES)
+logger = logging.getLogger('staas.tag_vols')
+
+# Starting and largest number of volumes per tag write; the actual size adapts per array
+TAG_BATCH_SIZE = 100
+MAX_TAG_BATCH_SIZE = 500
+BATCH_SIZES = BatchSizeStore()
+
+# Tag writes in flight per fleet member, and the write rate limits per array and end-point
+WRITES_IN_FLIGHT = DEFAULT_WRITES_IN_FLIGHT
+WRITE_LIMITER = WriteRateLimiter()
+# API call and phase timings of this run
+TELEMETRY = Telemetry('tag_vols')
+# Journal of the tag batches written so far, and what a resumed run has already applied per array
+JOURNAL = None
+APPLIED_TAGS = {}
+DONE_ARRAYS = set()
+
+def tag_batch_writer(client, fleet_member, value):
     """
-    Parse a volume name to extract realm, pod, and volume components.
+    Build the writer that applies a chargeback tag to lists of volumes on a fleet member,
+    in batches at the adaptive batch size, each write waiting for WRITE_LIMITER.
     Args:
-        volume_name: The name of the volume
+        client: Fusion API client
+        fleet_member: Name of the array
+        value: Tag value
     Returns:
-        dict with keys 'realm', 'pod', 'volume'
-    """
-    realmpattern = r'^([\w.-]+)::([\w.-]+)::([\w.-]+)$'
-    podpattern = r'^([\w.-]+)::([\w.-]+)$'
-    volpattern = r'^[\w-]+(?:/[\w-]+)*$'
-    
-    match = re.match(realmpattern, volume_name)
-    if match:
-        groups = match.groups()
-        return {
-            'realm': groups[0],
-            'pod': groups[1],
-            'volume': groups[2]
-        }
-
-    match = re.match(podpattern, volume_name)
-    if match:
-        groups = match.groups()
-        return {
-            'realm': None,
-            'pod': groups[0],
-            'volume': groups[1]
-        }
-
-    match = re.match(volpattern, volume_name)
-    if match:
-        return {
-            'realm': None,
-            'pod': None,
-            'volume': volume_name
-        }
-    
-# get the tag value for any tagging_rule
-def get_tag_value(tag_by, container_name):
-    """
-    Get the tag value for a given tag type and container name from TAGGING_RULES.
-    """
-    if tag_by in TAGGING_RULES and container_name in TAGGING_RULES[tag_by]:
-        return TAGGING_RULES[tag_by][container_name]
-    return None
-
-def tag_volume(client,fleet_member, volume_list, value):
-    """
-    Apply a chargeback tag to a list of volumes on a fleet member.
+        (write, batcher): write(volumes) returns True if every batch was written and False at
+        the first failed batch; batcher is the array's AdaptiveBatcher for tag writes
     """
     tags = [
         {"namespace": NAMESPACE, "key": TAG_KEY, "value": value}
     ]
-    chunk_size = 100  # Adjust the chunk size as needed
+    batcher = BATCH_SIZES.batcher(fleet_member, 'put_volumes_tags_batch', TAG_BATCH_SIZE, maximum=MAX_TAG_BATCH_SIZE)
+
+    def put_tags(chunk):
+        WRITE_LIMITER.acquire(fleet_member)
+        return client.put_volumes_tags_batch(context_names=[fleet_member], resource_names=chunk, tag=tags)
 
-    for i in range(0, len(volume_list), chunk_size):
-        volume_chunk = volume_list[i:i + chunk_size]
+    def write(volumes):
         # Add the chargeback tag
-        response = client.put_volumes_tags_batch(context_names=[fleet_member], resource_names=volume_chunk, tag=tags)
-        # Check the response
-        if response.status_code == 200:
-            if debug >= 4:
-                print(f"Tags added successfully to volume {fleet_member},{volume_chunk},{tags}.")
-        else:
-            print(f"Failed to add tags to {fleet_member},{volume_chunk},{tags}. Status code: {response.status_code}, Error: {response.errors}")
-            break
+        for volume_chunk, response in TELEMETRY.iterate('tag_writes', fleet_member, batcher.batches(volumes, put_tags)):
+            # Check the response
+            if response.status_code == 200:
+                logger.log(TRACE, "Tags added successfully to %d volumes on %s: %s", len(volume_chunk), fleet_member, tags)
+                if JOURNAL is not None:
+                    JOURNAL.record({'type': 'batch', 'array': fleet_member, 'value': value, 'volumes': list(volume_chunk)})
+            else:
+                logger.error("Failed to add tags to %d volumes on %s: %s. Status code: %s, Error: %s", len(volume_chunk),
+                             fleet_member, tags, response.status_code, response.errors,
+                             extra={'array': fleet_member, 'endpoint': 'put_volumes_tags_batch', 'status': response.status_code})
+                return False
+        return True
 
-def get_host_group_volumes_by_volume(client, fleet_member):
+    return write, batcher
+
+def tag_volume(client, fleet_member, volume_list, value):
     """
-    Retrieve volumes for each host group in TAGGING_RULES and index them by volume name.
-    Args:
-        client: Fusion API client
-        fleet_member: Name of the array
+    Apply a chargeback tag to a list of volumes on a fleet member, writing the batches one after another.
     Returns:
-        dict mapping volume name to host group name
+        True if every batch was written, False once a batch failed
     """
-    """
-    Retrieve volumes for each host group in TAGGING_RULES and index them by volume name.
+    write, _ = tag_batch_writer(client, fleet_member, value)
+    return write(volume_list)
 
+def submit_tag_volume(client, fleet_member, volume_list, value, executor):
+    """
+    Apply a chargeback tag to a list of volumes on a fleet member with concurrent writers.
+    Up to WRITES_IN_FLIGHT writers are submitted to the executor, each taking the next batch
+    at the current adaptive batch size until the list is exhausted.
+    Returns:
+        list of Futures, one per writer, each resolving to a (batches written, batches failed) tuple
+    """
+    write, batcher = tag_batch_writer(client, fleet_member, value)
+
+    # Batches are cut when a writer takes them, not up front, so that they follow the batch size
+    # as it adapts to the write latency
+    lock = threading.Lock()
+    offset = 0
+
+    def next_batch():
+        nonlocal offset
+        with lock:
+            batch = volume_list[offset:offset + batcher.size]
+            offset += len(batch)
+            return batch
+
+    def writer():
+        batches = failed = 0
+        while True:
+            volumes = next_batch()
+            if not volumes:
+                return batches, failed
+            batches += 1
+            if not write(volumes):
+                failed += 1
+
+    writers = min(max(1, WRITES_IN_FLIGHT), -(-len(volume_list) // batcher.size))
+    return [executor.submit(writer) for _ in range(writers)]
+
+def build_connection_index(client, fleet_member):
+    """
+    Index the volumes connected to the host groups and hosts named in TAGGING_RULES,
+    using a single paginated sweep of the array's connections.
     Args:
-        client (Client): The Pure Storage FlashArray client.
-        fleet_member (str): The name of the fleet member.
-
+        client: Fusion API client
+        fleet_member: Name of the array
     Returns:
-        dict: A dictionary where the keys are volume names and the values are host group names.
+        (host_group_volumes_by_volume, host_volumes_by_volume): dicts mapping volume name
+        to host group name and to host name, or None if the connections could not be read
     """
     host_group_volumes_by_volume = {}
+    host_volumes_by_volume = {}
     host_groups_for_tagging = TAGGING_RULES.get("host_group", {})
-
-    response_host_groups = client.get_host_groups(context_names=[fleet_member])
-    if response_host_groups.status_code == 200:
-        host_groups = response_host_groups.items
-        host_group_names = [host_group.name for host_group in host_groups]  # Extract the names
-        if debug >= 3:
-            print(f"Host group names: {host_group_names}")
-    else:
-        print(f"Failed to retrieve host groups. Status code: {response_host_groups.status_code}, Error: {response_host_groups.errors}")
-        return
-    
-    # Retrieve volumes for each host group
-    for host_group_name in host_group_names:
-        if host_group_name in host_groups_for_tagging.keys():
-            response_connections = client.get_connections(context_names=[fleet_member], host_group_names=[host_group_name])
-            if response_connections.status_code == 200:
-                volumes = response_connections.items
-                for volume in volumes:
-                    host_group_volumes_by_volume[volume.volume.name] = host_group_name
-            else:
-                print(f"Failed to retrieve connections. Status code: {response_connections.status_code}, Error: {response_connections.errors}")
-                return
-    return host_group_volumes_by_volume
-
-def match_host_group(volume_name):
-    """
-    Return the host group name for a given volume, if present.
-    """
-    if volume_name in host_group_volumes_by_volume:
-        return host_group_volumes_by_volume[volume_name]
-    return None
-
-def get_host_volumes_by_volume(client, fleet_member):
+    hosts_for_tagging = TAGGING_RULES.get("host", {})
+    if not host_groups_for_tagging and not hosts_for_tagging:
+        return host_group_volumes_by_volume, host_volumes_by_volume
+
+    for response in TELEMETRY.iterate('connections', fleet_member,
+                                      paginate(client.get_connections, context_names=[fleet_member])):
+        if response.status_code != 200:
+            logger.error("Failed to retrieve connections from %s. Status code: %s, Error: %s", fleet_member,
+                         response.status_code, response.errors,
+                         extra={'array': fleet_member, 'endpoint': 'get_connections', 'status': response.status_code})
+            return None
+        for connection in response.items:
+            volume_name = connection.volume.name
+            host_group_name = getattr(getattr(connection, 'host_group', None), 'name', None)
+            host_name = getattr(getattr(connection, 'host', None), 'name', None)
+            if host_group_name in host_groups_for_tagging:
+                host_group_volumes_by_volume[volume_name] = host_group_name
+            if host_name in hosts_for_tagging:
+                host_volumes_by_volume[volume_name] = host_name
+
+    logger.debug("Connections on %s: %d volumes by host group, %d volumes by host", fleet_member,
+                 len(host_group_volumes_by_volume), len(host_volumes_by_volume))
+    return host_group_volumes_by_volume, host_volumes_by_volume
+
+def read_existing_tags(client, fleet_member):
     """
-    Retrieve volumes for each host in TAGGING_RULES and index them by volume name.
+    Read the existing chargeback tags in NAMESPACE for all volumes on a fleet member, in bulk.
     Args:
         client: Fusion API client
         fleet_member: Name of the array
     Returns:
-        dict mapping volume name to host name
+        dict mapping volume name to its current tag value, or None if the tags could not be read
     """
+    existing = {}
+    for response in TELEMETRY.iterate('tags', fleet_member, paginate(
+            client.get_volumes_tags, context_names=[fleet_member], namespaces=[NAMESPACE],
+            **list_query(client, 'get_volumes_tags', fields=['key', 'value', 'namespace', 'resource'], key=TAG_KEY))):
+        if response.status_code != 200:
+            logger.error("Failed to read existing tags from %s. Status code: %s, Error: %s", fleet_member,
+                         response.status_code, response.errors,
+                         extra={'array': fleet_member, 'endpoint': 'get_volumes_tags', 'status': response.status_code})
+            return None
+        for tag in response.items:
+            if tag.namespace == NAMESPACE and tag.key == TAG_KEY:
+                existing[tag.resource.name] = tag.value
+    return existing
+
+def reconcile_tag_set(tag_set, existing):
     """
-    Retrieve volumes for each host in TAGGING_RULES and index them by volume name.
-
+    Remove the volumes whose current tag already matches the desired value from a tag set.
     Args:
-        client (Client): The Pure Storage FlashArray client.
-        fleet_member (str): The name of the fleet member.
-
+        tag_set: dict mapping tag value to {rule: [volume names]}, updated in place
+        existing: dict mapping volume name to its current tag value
     Returns:
-        dict: A dictionary where the keys are volume names and the values are host names.
+        dict with counts of 'unchanged', 'added' and 'changed' volumes
     """
-    host_volumes_by_volume = {}
-    hosts_for_tagging = TAGGING_RULES.get("host", {})
-
-    response_hosts = client.get_hosts(context_names=[fleet_member])
-    if response_hosts.status_code == 200:
-        hosts = response_hosts.items
-        host_names = [host.name for host in hosts]  # Extract the names
-        if debug >= 3:
-            print(f"Host names: {host_names}")
-    else:
-        print(f"Failed to retrieve hosts. Status code: {response_hosts.status_code}, Error: {response_hosts.errors}")
-        return
-    
-    # Retrieve volumes for each host
-    for host_name in host_names:
-        if host_name in hosts_for_tagging.keys():
-            response_connections = client.get_connections(context_names=[fleet_member], host_names=[host_name])
-            if response_connections.status_code == 200:
-                connections = response_connections.items
-                for connection in connections:
-                    host_volumes_by_volume[connection.volume.name] = host_name
-            else:
-                print(f"Failed to retrieve connections. Status code: {response_connections.status_code}, Error: {response_connections.errors}")
-                return
-    return host_volumes_by_volume
-
-def match_host(volume_name):
-    """
-    Return the host name for a given volume, if present.
-    """
-    if volume_name in host_volumes_by_volume:
-        return host_volumes_by_volume[volume_name]
-    return None
+    counts = {'unchanged': 0, 'added': 0, 'changed': 0}
+    for tag_value, bucket in tag_set.items():
+        for bucket_name, volume_names in bucket.items():
+            to_write = []
+            for volume_name in volume_names:
+                current = existing.get(volume_name)
+                if current == tag_value:
+                    counts['unchanged'] += 1
+                    continue
+                counts['added' if current is None else 'changed'] += 1
+                to_write.append(volume_name)
+            bucket[bucket_name] = to_write
+    return counts
 
 # Go through all volumes on this host and create an array of tags with volume names according to the tagging plan
-def process_volumes(client, fleet_member):
+def process_volumes(client, fleet_member, reconcile=False):
     """
     For all regular volumes on a fleet member, determine the correct chargeback tag
     based on the tagging rules and apply the tag using the Fusion API.
+    In reconcile mode only volumes whose tag is missing or different are written.
+    Returns:
+        dict with counts of 'unchanged', 'added' and 'changed' volumes (all volumes
+        count as added when not reconciling), or None if the volumes or their connections
+        could not be listed, in which case nothing is written to the array
     """
     tag_set = {}
-    continuation_token = None  # Initialize the continuation token
+    trace = logger.isEnabledFor(TRACE)
 
-    # Retrieve host group volumes indexed by volume name
-    host_group_volumes_by_volume = get_host_group_volumes_by_volume(client, fleet_member)
-    host_volumes_by_volume = get_host_volumes_by_volume(client, fleet_member)
+    # Retrieve host group and host volumes indexed by volume name, without which the tags would be wrong
+    connection_index = build_connection_index(client, fleet_member)
+    if connection_index is None:
+        logger.error("Not tagging array %s, its host connections could not be read", fleet_member,
+                     extra={'array': fleet_member})
+        return
+    host_group_volumes_by_volume, host_volumes_by_volume = connection_index
 
-    while True:
-        # Retrieve volumes with pagination
-        response = client.get_volumes(context_names=[fleet_member], continuation_token=continuation_token)
+    # Retrieve regular volumes with pagination, filtered by the array where it can
+    query = list_query(client, 'get_volumes', fields=['name', 'subtype'], subtype='regular')
+    filtered = 'filter' in query
+    for response in TELEMETRY.iterate('listing', fleet_member, paginate(client.get_volumes, context_names=[fleet_member],
+                                                                        **query)):
         if response.status_code == 200:
-            if debug >= 2:
-                print(f"Finding volumes for array {fleet_member} (Batch with continuation token: {continuation_token})")
+            logger.debug("Finding volumes for array %s (Batch with continuation token: %s)", fleet_member,
+                         response.continuation_token)
             volumes = response.items
         else:
-            print(f"Failed to retrieve volumes. Status code: {response.status_code}, Error: {response.errors}")
+            logger.error("Failed to retrieve volumes from %s. Status code: %s, Error: %s", fleet_member,
+                         response.status_code, response.errors,
+                         extra={'array': fleet_member, 'endpoint': 'get_volumes', 'status': response.status_code})
             return
 
+        volume_names = []
         for volume in volumes:
-            if volume.subtype != 'regular':
-                if debug >= 4:
-                    print(f"Non-regular volume {volume.name} found - not tagging it.")
+            if not filtered and volume.subtype != 'regular':
+                if trace:
+                    logger.log(TRACE, "Non-regular volume %s found - not tagging it.", volume.name)
                 continue
-
-            # Match volume name to realm, pod, or other keys in TAGGING_RULES
-            result = match_volume_name(volume.name)
-            realm = result.get("realm")
-            pod = result.get("pod")
-            host_group_name = match_host_group(volume.name)
-            host_name = match_host(volume.name)
-
-            # Define the order of keys to check
-            tagging_order = ["realm", "pod", "workload", "host_group", "host", "default"]
-
-            # Loop through the keys in the defined order
-            for key in tagging_order:
-                if key == "realm" and realm in TAGGING_RULES["realm"]:
-                    tag_value = get_tag_value("realm", realm)
-                elif key == "pod" and pod in TAGGING_RULES["pod"]:
-                    tag_value = get_tag_value("pod", pod)
-                elif key == "workload":
-                    # Add workload-specific logic here if needed
-                    tag_value = None
-                elif key == "host_group" and host_group_name:
-                    # Add host_group-specific logic here if needed
-                    tag_value = get_tag_value("host_group", host_group_name)
-                elif key == "host":
-                    # Add host-specific logic here if needed
-                    tag_value = get_tag_value("host", host_name)
-                elif key == "default":
-                    tag_value = get_tag_value("default", "default")
-                else:
+            volume_names.append(volume.name)
+
+        # Match volume names to realm, pod, or other keys in TAGGING_RULES
+        parsed = parse_volume_names(volume_names)
+        if parsed.unparsed:
+            logger.warning("%d volume names on %s have no realm/pod form, tagging by host group, host or default only: %s",
+                           len(parsed.unparsed), fleet_member, parsed.unparsed[:10], extra={'array': fleet_member})
+        keys = [(realm, pod, host_group_volumes_by_volume.get(name), host_volumes_by_volume.get(name))
+                for name, realm, pod in zip(volume_names, parsed.realms, parsed.pods)]
+
+        # Resolve the whole page against the compiled tagging rules
+        for volume_name, (tag_value, rule) in zip(volume_names, RULE_ENGINE.resolve_batch(keys)):
+            if tag_value:
+                if tag_value not in tag_set:
+                    tag_set[tag_value] = {}
+                if rule not in tag_set[tag_value]:
+                    tag_set[tag_value][rule] = []
+                tag_set[tag_value][rule].append(volume_name)
+
+            if trace:
+                logger.log(TRACE, "Tagging volume %s on array %s, in namespace %s with tag %s: %s (%s rule)",
+                           volume_name, fleet_member, NAMESPACE, TAG_KEY, tag_value, rule)
+
+    # Compare with the existing tags and keep only the volumes that need writing
+    existing = read_existing_tags(client, fleet_member) if reconcile else None
+    if existing is not None:
+        counts = reconcile_tag_set(tag_set, existing)
+    else:
+        counts = {'unchanged': 0, 'changed': 0,
+                  'added': sum(len(names) for bucket in tag_set.values() for names in bucket.values())}
+    # Skip the volumes a resumed run has already tagged
+    if fleet_member in APPLIED_TAGS:
+        counts['resumed'] = reconcile_tag_set(tag_set, APPLIED_TAGS[fleet_member])['unchanged']
+        logger.info("Array %s: %d volumes already tagged before the run was interrupted", fleet_member, counts['resumed'])
+    logger.info("Array %s: %d unchanged, %d added, %d changed", fleet_member, counts['unchanged'], counts['added'],
+                counts['changed'], extra={'array': fleet_member, **counts})
+
+    # Tag the volumes by tag value, keeping up to WRITES_IN_FLIGHT batches in flight
+    with ThreadPoolExecutor(max_workers=max(1, WRITES_IN_FLIGHT), thread_name_prefix=f'staas-tag-{fleet_member}') as executor:
+        futures = []
+        for tag_value, bucket in tag_set.items():
+            for bucket_name, volume_names in bucket.items():
+                if not volume_names:
                     continue
+                logger.debug("Tagging %d volumes on %s with %s", len(volume_names), fleet_member, tag_value)
+                futures.extend(submit_tag_volume(client, fleet_member, volume_names, tag_value, executor))
+        results = [future.result() for future in futures]
+    failed = sum(failed for _, failed in results)
+    if failed:
+        logger.error("Array %s: %d of %d tag write batches failed", fleet_member, failed,
+                     sum(batches for batches, _ in results), extra={'array': fleet_member})
+    elif JOURNAL is not None and fleet_member not in getattr(client, 'incomplete_arrays', ()):
+        JOURNAL.record({'type': 'array_done', 'array': fleet_member})
 
-                if tag_value:
-                    if debug >= 5:
-                        print(f"Tag value for {key}: {tag_value}")
-                    if tag_value not in tag_set:
-                        tag_set[tag_value] = {}
-                    if key not in tag_set[tag_value]:
-                        tag_set[tag_value][key] = []
-                    tag_set[tag_value][key].append(volume.name)
-                    break  # Exit the loop once a match is found
-
-            if debug >= 3:
-                print(f"Tagging volume {volume.name} on array {fleet_member}, in namespace {NAMESPACE} with tag {TAG_KEY}: {tag_value}")
-
-        # Check if there are more volumes to process
-        continuation_token = response.continuation_token
-        if not continuation_token:
-            break  # Exit the loop if there are no more volumes
-
-    # Tag the volumes by tag value
-    for tag_value, bucket in tag_set.items():
-        for bucket_name, volume_names in bucket.items():
-            if debug >= 2:
-                print(f"tag_volume({fleet_member}, {volume_names}, {tag_value})")
-            tag_volume(client, fleet_member, volume_names, tag_value)
+    return counts
+
+
+def tag_fleet(client, topology, workers=1, reconcile=False):
+    """
+    Tags the volumes of every fleet member, skipping members a resumed run already finished.
+    Args:
+        client: Fusion API client
+        topology: FleetTopology of the fleets to tag
+        workers: Number of fleet members tagged concurrently
+        reconcile: Only write tags that are missing or differ from the tagging rules
+    Returns:
+        list of fleet members that could not be tagged
+    """
+    incomplete = []
+    for fleet in topology.fleets:
+        fleet_members = [fleet_member for fleet_member in topology.members_of(fleet) if fleet_member not in DONE_ARRAYS]
+
+        # Tag up to workers fleet members at once
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='staas-tag') as executor:
+            futures = {fleet_member: executor.submit(process_volumes, client, fleet_member, reconcile)
+                       for fleet_member in fleet_members}
+            for fleet_member, future in futures.items():
+                try:
+                    if future.result() is None:
+                        incomplete.append(fleet_member)
+                except Exception as e:
+                    logger.error("Failed to tag volumes on array %s: %s", fleet_member, e, extra={'array': fleet_member})
+                    incomplete.append(fleet_member)
+    return incomplete
 
-# Disable certificate warnings
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 def main():
     """
     Main entry point for the tagging script. Loads config, tagging rules, and applies tags to all fleet members.
     """
-    global NAMESPACE, TAGGING_RULES
+    global NAMESPACE, TAGGING_RULES, RULE_ENGINE, BATCH_SIZES, WRITES_IN_FLIGHT, WRITE_LIMITER
+    global JOURNAL, APPLIED_TAGS, DONE_ARRAYS
     # Parse command-line arguments
     args = parse_arguments("tag_vols")
+    setup_logging(args.log_level or 'info', args.log_format, args.log_file, args.trace_sample)
 
-    # Read the configuration file
-    config_path = os.path.join(args.config)
-    if not os.path.exists(config_path):
-        print(f"Configuration file not found: {config_path}")
+    # Read the configuration file, or its compiled form when the file has not changed
+    try:
+        config = load_config(args.config, args.config_cache)
+    except ConfigError as e:
+        logger.error("%s", e)
         exit(1)
-
-    config_spreadsheet = pd.ExcelFile(config_path)
-
-    # Read the Excel file
-    fleet_df = config_spreadsheet.parse('Fleet')
+    for warning in config.warnings:
+        logger.warning("%s", warning)
 
     # Extract global variables from the Fleet sheet
-    global_variables = fleet_df.iloc[0].to_dict()
+    global_variables = config.settings
+    if args.log_level is None and isinstance(global_variables.get('LOG_LEVEL'), str):
+        logging.getLogger().setLevel(log_level(global_variables['LOG_LEVEL']))
 
     # Assign global variables
     USER_NAME = os.getenv('PURE_USER_NAME')
@@ -356,36 +419,75 @@ def main():
     FUSION_SERVER = global_variables.get('FUSION_SERVER', '')
     NAMESPACE = global_variables.get('NAMESPACE', '')
 
-    # Read the Tagging_map worksheet
-    tagging_map_df = config_spreadsheet.parse('Tagging_map')
+    # Tagging rules from the Tagging_map worksheet, validated by load_config
+    TAGGING_RULES = config.tagging_rules
+    logger.info("Loaded tagging rules: %s", TAGGING_RULES)
+    RULE_ENGINE = TaggingRuleEngine(TAGGING_RULES)
 
-    # Populate TAGGING_RULES
-    TAGGING_RULES = {"realm": {}, "pod": {}, "workload": {}, "host_group": {}, "host": {}, "default": {}}
-    for _, row in tagging_map_df.iterrows():
-        tag_by = row.get("Tag_By", "").lower()  # e.g., "realm", "pod","host_group","host" or "default"
-        container_name = row.get("Container_Name", "").strip()  # e.g., "realm1", "pod1"
-        tag_value = str(row.get("Tag_Value", "")).strip()  # e.g., "TagValue1"
-
-        if tag_by in TAGGING_RULES:
-            TAGGING_RULES[tag_by][container_name] = tag_value
-        else:
-            print(f"Unknown Tag_By value: {tag_by}. Skipping row.")
-
-    print(f"Loaded tagging rules: {TAGGING_RULES}")
-
-    print(f"Connecting to Fusion server: {FUSION_SERVER} with user: {USER_NAME}")
-
-    client = initialise_client(FUSION_SERVER, USER_NAME, API_TOKEN)
-    if not client:
+    if args.cache_mode == 'replay' and not args.response_cache:
+        logger.error("--cache-mode replay requires --response-cache")
         exit(1)
 
-    # Get the arrays for tagging contexts for the nominated fleet
-    fleets = list_fleets(client)
-    for fleet in fleets:
-        fleet_members = list_members(client, [fleet])
+    if args.cache_mode == 'replay':
+        logger.info("Replaying recorded responses from %s, Fusion is not contacted", args.response_cache)
+        client = None
+    else:
+        logger.info("Connecting to Fusion server: %s with user: %s", FUSION_SERVER, USER_NAME)
+
+        client = initialise_client(FUSION_SERVER, USER_NAME, API_TOKEN, timeout=args.request_timeout)
+        if not client:
+            exit(1)
+        # Retry transient failures and stop sending to arrays that keep failing
+        client = ResilientClient(client, RetryPolicy(args.retries), CircuitBreaker(args.breaker_threshold, args.breaker_reset))
+    # Serve repeated reads from the response cache
+    if args.response_cache:
+        client = CachingClient(client, args.response_cache, ttls=dict(args.cache_ttl), mode=args.cache_mode)
+    # Record every API call in the run metrics
+    client = InstrumentedClient(client, TELEMETRY, measure_size=args.metrics_bytes)
+
+    BATCH_SIZES = BatchSizeStore(args.batch_state)
+    WRITES_IN_FLIGHT = args.writes_in_flight
+    WRITE_LIMITER = WriteRateLimiter(args.write_rate, args.endpoint_write_rate)
+
+    # Journal the tag batches written so an interrupted run can be resumed with --resume
+    if args.checkpoint or args.resume:
+        journal_path = args.checkpoint or checkpoint_path(args.config, 'tag_vols')
+        JOURNAL = CheckpointJournal(journal_path, resume=args.resume)
+        for entry in JOURNAL.of_type('batch'):
+            applied = APPLIED_TAGS.setdefault(entry['array'], {})
+            for volume_name in entry['volumes']:
+                applied[volume_name] = entry['value']
+        DONE_ARRAYS = {entry['array'] for entry in JOURNAL.of_type('array_done')}
+        if JOURNAL.records:
+            logger.info("Resuming from %s: %d arrays done, %d volumes tagged", journal_path, len(DONE_ARRAYS),
+                        sum(len(applied) for applied in APPLIED_TAGS.values()))
 
-        for fleet_member in fleet_members:
-            process_volumes(client, fleet_member)
+    # Get the arrays for tagging contexts for the nominated fleet
+    topology = FleetTopology.load(client, cache_path=args.topology_cache, ttl=args.topology_ttl)
+    incomplete = tag_fleet(client, topology, args.workers, args.reconcile)
+    incomplete += [fleet_member for fleet_member in client.incomplete_arrays if fleet_member not in incomplete]
+
+    if incomplete:
+        logger.warning("Tagging is incomplete for arrays: %s", ', '.join(incomplete))
+
+    # Remember the tuned batch sizes for the next run
+    BATCH_SIZES.save()
+    if args.response_cache:
+        client.close()
+
+    # Export the run metrics
+    if args.metrics_json:
+        TELEMETRY.write_json(args.metrics_json)
+    if args.metrics_prom:
+        TELEMETRY.write_prometheus(args.metrics_prom)
+    for fleet_member, seconds in TELEMETRY.slowest_arrays():
+        logger.info("Array %s: %.1fs in API calls", fleet_member, seconds)
+
+    # The run completed, there is nothing left to resume
+    if JOURNAL is not None and not incomplete:
+        JOURNAL.remove()
+    elif JOURNAL is not None:
+        JOURNAL.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
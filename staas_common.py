@@ -1,9 +1,37 @@
 
 import argparse
+import atexit
+import contextlib
+import functools
+import hashlib
+import inspect
+import json
 import logging
-from typing import List, Optional, Any
-from pypureclient import flasharray
-from pypureclient.flasharray import Client, PureError
+import logging.handlers
+import math
+import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import zipfile
+from array import array
+from datetime import datetime, timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from types import SimpleNamespace
+from typing import (TYPE_CHECKING, Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Sequence, Tuple)
+
+# pypureclient, asyncio, pandas and openpyxl take most of the start-up time, so they are
+# imported where they are used rather than here
+if TYPE_CHECKING:
+    import asyncio
+    from pypureclient.flasharray import Client
 
 DEBUG_LEVEL = 0
 LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
@@ -12,6 +40,13 @@ logger = logging.getLogger(__name__)
 if DEBUG_LEVEL > 0:
     logger.setLevel(logging.DEBUG)
 
+# Per-volume detail, below DEBUG and sampled
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+LOG_LEVELS = {'error': logging.ERROR, 'warning': logging.WARNING, 'info': logging.INFO,
+              'debug': logging.DEBUG, 'trace': TRACE}
+DEFAULT_TRACE_SAMPLE = 100
+
 
 """
 staas_common.py
@@ -20,8 +55,125 @@ Shared utility functions for STAAS-Reporting-Fusion scripts.
 Includes argument parsing, Fusion client setup, API helpers, and fleet/member listing.
 """
 
-from pypureclient import flasharray
-from pypureclient.flasharray import Client, PureError
+
+DEFAULT_TOPOLOGY_TTL = 3600
+DEFAULT_PAGE_SIZE = 500
+DEFAULT_DIRECTORY_PAGE_SIZE = 200
+DEFAULT_FETCH_CONCURRENCY = 4
+DEFAULT_WRITES_IN_FLIGHT = 4
+DEFAULT_REQUEST_TIMEOUT = 60.0
+DEFAULT_RETRIES = 4
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 300.0
+DEFAULT_ARRAY_WRITE_RATE = 10.0
+DEFAULT_ENDPOINT_WRITE_RATE = 50.0
+CACHE_MODES = ('record', 'replay', 'refresh')
+DEFAULT_SESSION_MAX_AGE = 1800.0
+DEFAULT_REPORT_INTERVAL = 3600.0
+DEFAULT_TAG_AT = '02:00'
+# Seconds a recorded response is served for, per end-point; end-points not listed are not cached
+DEFAULT_CACHE_TTLS = {
+    'get_fleets': 6 * 3600,
+    'get_fleets_members': 6 * 3600,
+    'get_hosts': 6 * 3600,
+    'get_host_groups': 6 * 3600,
+    'get_rest_version': 6 * 3600,
+    'get_connections': 3600,
+    'get_volumes': 900,
+    'get_volumes_tags': 0,
+    'get_volumes_space': 0,
+    'get_realms_space': 0,
+    'get_arrays_space': 0,
+    'get_directories': 0,
+}
+
+
+# Attributes every LogRecord has; anything else on a record came from `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as one JSON object, with the fields passed in `extra` as keys.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update({k: v for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TraceSampler(logging.Filter):
+    """
+    Passes one in `every` TRACE records of each message, so per-volume lines show a sample
+    of the volumes instead of all of them. Records at other levels all pass.
+    """
+
+    def __init__(self, every: int = DEFAULT_TRACE_SAMPLE):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts: Dict[Tuple[str, Any], int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != TRACE or self.every == 1:
+            return True
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        if count % self.every:
+            return False
+        record.sampled = self.every
+        return True
+
+
+def log_level(name: str) -> int:
+    """
+    The logging level for a level name, e.g. 'debug'.
+    Args:
+        name: One of error, warning, info, debug or trace
+    Returns:
+        logging level
+    """
+    try:
+        return LOG_LEVELS[str(name).strip().lower()]
+    except KeyError:
+        raise ValueError(f"Unknown log level {name}, expected one of {', '.join(LOG_LEVELS)}")
+
+
+def setup_logging(level: str = 'info', log_format: str = 'text', log_file: Optional[str] = None,
+                  trace_sample: int = DEFAULT_TRACE_SAMPLE) -> logging.handlers.QueueListener:
+    """
+    Route all logging through a queue to a single writer thread, so the threads doing the
+    work never wait on terminal or file I/O.
+    Args:
+        level: Level name, e.g. 'info'
+        log_format: 'text' or 'json' (one structured record per line)
+        log_file: File the records are written to instead of stderr
+        trace_sample: Pass one in this many TRACE records of each message
+    Returns:
+        The running QueueListener; it is stopped and flushed at exit
+    """
+    handler: logging.Handler = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter(LOG_FORMAT))
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(TraceSampler(trace_sample))
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(queue_handler)
+    root.setLevel(log_level(level))
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
 
 
 def parse_arguments(options: str) -> argparse.Namespace:
@@ -33,9 +185,99 @@ def parse_arguments(options: str) -> argparse.Namespace:
         argparse.Namespace with parsed arguments
     """
     parser = argparse.ArgumentParser(description='STAAS Reporting Scripts')
-    parser.add_argument('--config', type=str, required=True, help='Complete path to filename of the configuration file')
-    if options == "report":
-        parser.add_argument('--reportdir', type=str, required=True, help='Directory for the reporting files')
+    # The service only needs its configuration to start; --send talks to one already running
+    parser.add_argument('--config', type=str, required=options != "service",
+                        help='Complete path to the configuration workbook, or an equivalent YAML/TOML/JSON file')
+    parser.add_argument('--config-cache', type=str, default=None,
+                        help="File the validated configuration is compiled to for faster starts "
+                             "(default: .<config name>.compiled.json next to the configuration, '' to disable)")
+    parser.add_argument('--topology-cache', type=str, default=None,
+                        help='Optional file used to cache the fleet topology between runs')
+    parser.add_argument('--batch-state', type=str, default=None,
+                        help='Optional file used to remember the tuned batch sizes per array between runs')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of fleet members processed concurrently (default: 1, sequential)')
+    parser.add_argument('--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT,
+                        help=f'Seconds allowed for each API request (default: {DEFAULT_REQUEST_TIMEOUT})')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                        help=f'Attempts per API call for retryable errors (default: {DEFAULT_RETRIES})')
+    parser.add_argument('--breaker-threshold', type=int, default=DEFAULT_BREAKER_THRESHOLD,
+                        help=f'Consecutive failed calls before an array is skipped (default: {DEFAULT_BREAKER_THRESHOLD})')
+    parser.add_argument('--breaker-reset', type=float, default=DEFAULT_BREAKER_RESET,
+                        help=f'Seconds before a skipped array is tried again (default: {DEFAULT_BREAKER_RESET})')
+    parser.add_argument('--topology-ttl', type=float, default=DEFAULT_TOPOLOGY_TTL,
+                        help=f'Seconds a cached fleet topology remains valid (default: {DEFAULT_TOPOLOGY_TTL})')
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Journal file recording completed work so an interrupted run can be resumed '
+                             '(default with --resume: .<config name>.<script>.journal next to the configuration)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume the run recorded in the checkpoint journal instead of starting over')
+    parser.add_argument('--response-cache', type=str, default=None,
+                        help='SQLite file API responses are recorded to and served from')
+    parser.add_argument('--cache-mode', choices=CACHE_MODES, default='record',
+                        help='record: serve fresh recorded responses and record the rest, '
+                             'replay: serve recorded responses only, without connecting to Fusion, '
+                             'refresh: call the API and re-record every response (default: record)')
+    parser.add_argument('--cache-ttl', type=endpoint_ttl, action='append', default=[], metavar='ENDPOINT=SECONDS',
+                        help='Override the cache TTL of an end-point, e.g. get_volumes=3600; may be repeated')
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default=None,
+                        help='Logging verbosity; overrides LOG_LEVEL in the Fleet sheet (default: info)')
+    parser.add_argument('--log-format', choices=['text', 'json'], default='text',
+                        help='text, or json for one structured record per line (default: text)')
+    parser.add_argument('--log-file', type=str, default=None, help='File log records are written to instead of stderr')
+    parser.add_argument('--trace-sample', type=int, default=DEFAULT_TRACE_SAMPLE,
+                        help=f'Log one in this many per-volume trace lines (default: {DEFAULT_TRACE_SAMPLE})')
+    parser.add_argument('--metrics-json', type=str, default=None,
+                        help='File the run summary (API calls per end-point and array, phase timings) is written to')
+    parser.add_argument('--metrics-prom', type=str, default=None,
+                        help='Prometheus textfile the run metrics are written to')
+    parser.add_argument('--metrics-bytes', action='store_true',
+                        help='Also measure the response size of every API call (serializes each page once more)')
+    if options in ("report", "service"):
+        parser.add_argument('--reportdir', type=str, required=options != "service",
+                            help='Directory for the reporting files')
+        parser.add_argument('--excel-engine', choices=['openpyxl', 'streaming'], default='openpyxl',
+                            help='openpyxl (in-memory workbook) or streaming (constant-memory write-only writer)')
+        parser.add_argument('--history-db', type=str, default=None,
+                            help='SQLite history store the report rows are appended to; workbooks are rendered from it')
+        parser.add_argument('--skip-excel', action='store_true',
+                            help='With --history-db, only append to the store and do not render the workbooks')
+        parser.add_argument('--render-only', action='store_true',
+                            help='With --history-db, render the workbooks for --month from the store without collecting')
+        parser.add_argument('--month', type=str, default=None,
+                            help='Month (YYYY-MM) rendered by --render-only (default: current month)')
+        parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                            help=f'Number of volumes listed and reported per page (default: {DEFAULT_PAGE_SIZE})')
+        parser.add_argument('--directory-page-size', type=int, default=DEFAULT_DIRECTORY_PAGE_SIZE,
+                            help=f'Number of directories requested per page, adapted per array (default: {DEFAULT_DIRECTORY_PAGE_SIZE})')
+        parser.add_argument('--fetch-concurrency', type=int, default=DEFAULT_FETCH_CONCURRENCY,
+                            help=f'Tag and space requests in flight per fleet member (default: {DEFAULT_FETCH_CONCURRENCY})')
+        parser.add_argument('--async-fetch', action='store_true',
+                            help='Fetch volume tags and space through one asyncio event loop for the whole fleet, '
+                                 'with every batch of a page requested at once, instead of a thread pool per member')
+        parser.add_argument('--array-timeout', type=float, default=None,
+                            help='Seconds allowed to collect a single fleet member before it is abandoned')
+    if options == "tag_vols":
+        parser.add_argument('--reconcile', action='store_true',
+                            help='Only write tags that are missing or differ from the tagging rules')
+    if options in ("tag_vols", "service"):
+        parser.add_argument('--writes-in-flight', type=int, default=DEFAULT_WRITES_IN_FLIGHT,
+                            help=f'Tag write batches in flight per fleet member (default: {DEFAULT_WRITES_IN_FLIGHT})')
+        parser.add_argument('--write-rate', type=float, default=DEFAULT_ARRAY_WRITE_RATE,
+                            help=f'Tag write requests per second per fleet member, 0 for no limit (default: {DEFAULT_ARRAY_WRITE_RATE})')
+        parser.add_argument('--endpoint-write-rate', type=float, default=DEFAULT_ENDPOINT_WRITE_RATE,
+                            help=f'Tag write requests per second through the Fusion end-point, 0 for no limit (default: {DEFAULT_ENDPOINT_WRITE_RATE})')
+    if options == "service":
+        parser.add_argument('--report-interval', type=float, default=DEFAULT_REPORT_INTERVAL,
+                            help=f'Seconds between space report runs, 0 to only run on demand (default: {DEFAULT_REPORT_INTERVAL:.0f})')
+        parser.add_argument('--tag-at', type=time_of_day, default=DEFAULT_TAG_AT,
+                            help=f"Local time (HH:MM) of the daily tag reconcile, '' to only run on demand (default: {DEFAULT_TAG_AT})")
+        parser.add_argument('--session-max-age', type=float, default=DEFAULT_SESSION_MAX_AGE,
+                            help=f'Seconds before the Fusion session is authenticated again (default: {DEFAULT_SESSION_MAX_AGE:.0f})')
+        parser.add_argument('--control-socket', type=str, default=None,
+                            help='Unix socket the service accepts commands on (default: .staas-service.sock in --reportdir)')
+        parser.add_argument('--send', type=str, default=None, metavar='COMMAND',
+                            help="Send a command to the running service and exit: 'run report', 'run tag', 'status' or 'stop'")
     try:
         return parser.parse_args()
     except SystemExit as e:
@@ -43,17 +285,56 @@ def parse_arguments(options: str) -> argparse.Namespace:
         raise
 
 
-def initialise_client(fusion_server: str, user_name: str, api_token: str) -> Optional[Client]:
+def endpoint_ttl(value: str) -> Tuple[str, float]:
+    """
+    Parse an ENDPOINT=SECONDS cache TTL override.
+    Args:
+        value: Command-line value, e.g. 'get_volumes=3600'
+    Returns:
+        (end-point name, seconds)
+    """
+    endpoint, sep, seconds = value.partition('=')
+    try:
+        if not sep or not endpoint:
+            raise ValueError(value)
+        return endpoint.strip(), float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected ENDPOINT=SECONDS, got '{value}'")
+
+
+def time_of_day(value: str) -> str:
+    """
+    Validate an HH:MM time of day, or '' to disable a daily job.
+    """
+    if value:
+        try:
+            datetime.strptime(value, '%H:%M')
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Expected HH:MM, got '{value}'")
+    return value
+
+
+def initialise_client(fusion_server: str, user_name: str, api_token: str,
+                      timeout: Optional[float] = None) -> Optional["Client"]:
     """
     Initialize and return a Fusion API client.
     Args:
         fusion_server: Fusion server address
         user_name: Username for authentication
         api_token: API token for authentication
+        timeout: Seconds allowed for each request (None for the client default)
     Returns:
         flasharray.Client instance or None on failure
     """
+    import urllib3
+    from pypureclient import flasharray
+    from pypureclient.flasharray import PureError
+
+    # Fusion end-points commonly present self-signed certificates
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     try:
+        if timeout is not None:
+            return flasharray.Client(target=fusion_server, username=user_name, api_token=api_token, timeout=timeout)
         client = flasharray.Client(target=fusion_server, username=user_name, api_token=api_token)
         return client
     except PureError as e:
@@ -61,7 +342,7 @@ def initialise_client(fusion_server: str, user_name: str, api_token: str) -> Opt
         return None
 
 
-def check_purity_role(client: Client, user_name: str) -> str:
+def check_purity_role(client: "Client", user_name: str) -> str:
     """
     Placeholder for checking the user's role on the array. Returns 'array_admin' by default.
     """
@@ -69,7 +350,16 @@ def check_purity_role(client: Client, user_name: str) -> str:
     return "array_admin"
 
 
-def check_api_version(client: Client, min_version: float) -> bool:
+def pure_errors() -> Tuple[type, ...]:
+    """
+    The exception types raised by pypureclient, for except clauses. pypureclient is not imported
+    for this: when it has not been loaded, no client can have raised its errors.
+    """
+    flasharray = sys.modules.get('pypureclient.flasharray')
+    return (flasharray.PureError,) if flasharray is not None else ()
+
+
+def check_api_version(client: "Client", min_version: float) -> bool:
     """
     Check if the Fusion API version meets the minimum required version.
     Args:
@@ -78,19 +368,500 @@ def check_api_version(client: Client, min_version: float) -> bool:
     Returns:
         True if version is sufficient, False otherwise
     """
+    version = None
     try:
-        version = float(client.get_rest_version())
+        version = client.get_rest_version()
+        # A replay without a recorded version answers with an error response instead
+        if hasattr(version, 'status_code'):
+            logger.error(f"Failed to check API version: status {version.status_code}, {version.errors}")
+            return False
+        version = float(version)
         if version >= min_version:
             return True
         else:
             logger.warning(f"API version {version} is less than the minimum required version {min_version}")
             return False
-    except PureError as e:
+    except pure_errors() as e:
         logger.error(f"Failed to check API version: {e}")
         return False
+    except (TypeError, ValueError) as e:
+        logger.error(f"Failed to check API version, unexpected version {version!r}: {e}")
+        return False
+
+
+def paginate(method: Callable[..., Any], limit: Optional[int] = None,
+             continuation_token: Optional[str] = None, batcher: Optional["AdaptiveBatcher"] = None,
+             **kwargs: Any) -> Iterator[Any]:
+    """
+    Call a paginated list endpoint repeatedly, following continuation tokens.
+    Args:
+        method: Bound client method, e.g. client.get_volumes
+        limit: Maximum number of items per page (None for the API default)
+        continuation_token: Token to resume a previous listing from
+        batcher: Optional AdaptiveBatcher that sets the page size instead of limit
+        **kwargs: Remaining arguments passed to every call, e.g. context_names
+    Yields:
+        Each page response. A failed response is yielded and ends the iteration.
+    """
+    while True:
+        if batcher is None:
+            response = method(limit=limit, continuation_token=continuation_token, **kwargs)
+        else:
+            response = batcher.call(lambda size: method(limit=size, continuation_token=continuation_token, **kwargs))
+        yield response
+        if response.status_code != 200:
+            return
+        continuation_token = getattr(response, 'continuation_token', None)
+        if not continuation_token:
+            return
+
+
+def filter_expression(**conditions: Any) -> str:
+    """
+    Build a REST filter expression that matches every condition,
+    e.g. filter_expression(subtype='regular', destroyed=False) -> "subtype='regular' and destroyed=false".
+    """
+    terms = []
+    for field, value in conditions.items():
+        if isinstance(value, bool):
+            terms.append(f"{field}={str(value).lower()}")
+        elif isinstance(value, (int, float)):
+            terms.append(f"{field}={value}")
+        else:
+            escaped = str(value).replace('\\', '\\\\').replace("'", "\\'")
+            terms.append(f"{field}='{escaped}'")
+    return ' and '.join(terms)
+
+
+@functools.lru_cache(maxsize=None)
+def _method_parameters(client_type: type, endpoint: str) -> frozenset:
+    try:
+        signature = inspect.signature(getattr(client_type, endpoint))
+    except (AttributeError, TypeError, ValueError):
+        return frozenset()
+    return frozenset(name for name, parameter in signature.parameters.items()
+                     if parameter.kind in (parameter.POSITIONAL_OR_KEYWORD, parameter.KEYWORD_ONLY))
+
+
+def api_parameters(client: Any, endpoint: str) -> Optional[frozenset]:
+    """
+    Named parameters an end-point accepts, read from the signature of the innermost client
+    below the wrapping clients (each keeps the client it wraps in _client).
+    Returns:
+        frozenset of parameter names, or None when there is no client to ask (replayed responses)
+    """
+    while hasattr(client, '__dict__') and '_client' in vars(client):
+        client = vars(client)['_client']
+    if client is None:
+        return None
+    return _method_parameters(type(client), endpoint)
+
+
+def list_query(client: Any, endpoint: str, fields: Optional[Sequence[str]] = None, **conditions: Any) -> Dict[str, Any]:
+    """
+    Keyword arguments that have the array, rather than the script, filter and project a list call:
+    a filter expression for the conditions, and the fields to return. Each is only sent when the
+    end-point accepts it; responses replayed without a client are assumed to have been recorded
+    with the filter, as the Fusion list end-points all accept one.
+    Args:
+        client: Fusion API client, possibly wrapped
+        endpoint: List method name, e.g. 'get_volumes'
+        fields: Attributes the items need (only sent to end-points with a fields parameter)
+        **conditions: Field values the items must have, e.g. subtype='regular'
+    Returns:
+        dict of keyword arguments for the call; callers check for 'filter' to know whether
+        the items still need filtering
+    """
+    parameters = api_parameters(client, endpoint)
+    query: Dict[str, Any] = {}
+    if conditions and (parameters is None or 'filter' in parameters):
+        query['filter'] = filter_expression(**conditions)
+    if fields and parameters is not None and 'fields' in parameters:
+        query['fields'] = ','.join(fields)
+    return query
+
+
+def prefetch(iterable: Iterable[Any], depth: int = 1, name: str = 'staas-prefetch') -> Iterator[Any]:
+    """
+    Iterate in a background thread, keeping up to `depth` items ready ahead of the consumer,
+    so that fetching the next page overlaps with processing the current one.
+    Args:
+        iterable: Iterable to consume, e.g. the pages from paginate()
+        depth: Number of items fetched ahead (0 to iterate in the calling thread)
+        name: Name of the background thread
+    Yields:
+        The items of iterable, in order. An exception raised by the iterable is re-raised here.
+    """
+    if depth < 1:
+        yield from iterable
+        return
+    items: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item: Tuple[str, Any]) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterable:
+                if not put(('item', item)):
+                    return
+            put(('end', None))
+        except BaseException as e:
+            put(('error', e))
+
+    threading.Thread(target=produce, name=name, daemon=True).start()
+    try:
+        while True:
+            kind, item = items.get()
+            if kind == 'end':
+                return
+            if kind == 'error':
+                raise item
+            yield item
+    finally:
+        # A consumer that stops early leaves the producer blocked on a full queue until told to stop
+        stopped.set()
+
+
+# Responses that indicate the request was too large or too slow for the array
+SHRINK_STATUS_CODES = (408, 413, 414, 504)
+
+
+def is_timeout_error(error: BaseException) -> bool:
+    """
+    Whether an exception raised by the client was caused by a request timeout.
+    """
+    return isinstance(error, TimeoutError) or 'timeout' in type(error).__name__.lower()
+
+
+def _item_count(response: Any, default: int) -> int:
+    """
+    Number of items in a response, without consuming an item iterator.
+    """
+    try:
+        return len(response.items)
+    except (AttributeError, TypeError):
+        return default
 
 
-def list_fleets(client: Client) -> List[str]:
+class AdaptiveBatcher:
+    """
+    Adapts the batch (or page) size of one endpoint on one array to observed latency and failures.
+    The size shrinks on 408/413/414/504 responses and timeouts, and grows while the call
+    latency stays flat. Instances are thread-safe and usually obtained from a BatchSizeStore.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: Optional[int] = None,
+                 growth: float = 1.5, shrink: float = 0.5, latency_tolerance: float = 1.25,
+                 on_change: Optional[Callable[[int], None]] = None):
+        self.minimum = max(1, minimum)
+        self.maximum = maximum
+        self.growth = growth
+        self.shrink = shrink
+        self.latency_tolerance = latency_tolerance
+        self._size = self._clamp(initial)
+        self._reference_latency: Optional[float] = None
+        self._on_change = on_change
+        self._lock = threading.Lock()
+
+    def _clamp(self, size: float) -> int:
+        size = max(self.minimum, int(size))
+        if self.maximum is not None:
+            size = min(self.maximum, size)
+        return size
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def _set_size(self, size: int) -> None:
+        if size != self._size:
+            self._size = size
+            if self._on_change:
+                self._on_change(size)
+
+    def record_success(self, latency: float, batch_size: int) -> None:
+        """
+        Record a successful call. A full batch whose latency did not grow beyond the
+        tolerance of the running reference latency allows the size to grow.
+        """
+        with self._lock:
+            reference = self._reference_latency
+            self._reference_latency = latency if reference is None else 0.7 * reference + 0.3 * latency
+            if batch_size < self._size:
+                return  # A partial batch says nothing about larger sizes
+            if reference is None or latency <= reference * self.latency_tolerance:
+                self._set_size(self._clamp(self._size * self.growth))
+
+    def record_failure(self) -> bool:
+        """
+        Record a call that failed because it was too large or too slow.
+        Returns:
+            True if the size was reduced and the call is worth retrying, False if already at the minimum
+        """
+        with self._lock:
+            if self._size <= self.minimum:
+                return False
+            self._set_size(self._clamp(self._size * self.shrink))
+            self._reference_latency = None
+            return True
+
+    def call(self, request: Callable[[int], Any]) -> Any:
+        """
+        Issue request(size) with the current size, retrying with smaller sizes while the
+        response (or a timeout) shows the request was too large.
+        Args:
+            request: Callable taking the batch size and returning an API response
+        Returns:
+            The API response of the last attempt
+        """
+        while True:
+            size = self._size
+            start = time.monotonic()
+            try:
+                response = request(size)
+            except Exception as e:
+                if is_timeout_error(e) and self.record_failure():
+                    logger.warning("Request timed out, retrying with batch size %d", self._size)
+                    continue
+                raise
+            if response.status_code in SHRINK_STATUS_CODES and self.record_failure():
+                logger.warning("Request failed with status %s, retrying with batch size %d", response.status_code, self._size,
+                               extra={'status': response.status_code})
+                continue
+            if response.status_code == 200:
+                self.record_success(time.monotonic() - start, _item_count(response, size))
+            return response
+
+    def batches(self, items: Sequence[Any], request: Callable[[Sequence[Any]], Any]) -> Iterator[Tuple[Sequence[Any], Any]]:
+        """
+        Split items into batches of the current size and call request(batch) for each.
+        A batch that fails because it was too large is retried with a smaller size.
+        Args:
+            items: Sequence of items, e.g. volume names
+            request: Callable taking a batch and returning an API response
+        Yields:
+            (batch, response) for every batch issued
+        """
+        offset = 0
+        while offset < len(items):
+            size = self._size
+            batch = items[offset:offset + size]
+            start = time.monotonic()
+            try:
+                response = request(batch)
+            except Exception as e:
+                if is_timeout_error(e) and self.record_failure():
+                    logger.warning("Request timed out, retrying with batch size %d", self._size)
+                    continue
+                raise
+            if response.status_code in SHRINK_STATUS_CODES and self.record_failure():
+                logger.warning("Request failed with status %s, retrying with batch size %d", response.status_code, self._size,
+                               extra={'status': response.status_code})
+                continue
+            if response.status_code == 200:
+                self.record_success(time.monotonic() - start, len(batch))
+            yield batch, response
+            offset += len(batch)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: allows `rate` acquisitions per second on average,
+    with bursts of up to `burst`. A rate of 0 (or less) disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """
+        Block until `tokens` are available and take them.
+        Returns:
+            Seconds spent waiting
+        """
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class WriteRateLimiter:
+    """
+    Write rate limits per fleet member and for the Fusion end-point as a whole.
+    Every write takes a token from the end-point bucket and from its array's bucket.
+    """
+
+    def __init__(self, array_rate: float = DEFAULT_ARRAY_WRITE_RATE, endpoint_rate: float = DEFAULT_ENDPOINT_WRITE_RATE):
+        self.array_rate = array_rate
+        self._endpoint = TokenBucket(endpoint_rate)
+        self._arrays: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, array: str) -> float:
+        """
+        Block until a write to `array` is allowed.
+        Returns:
+            Seconds spent waiting
+        """
+        with self._lock:
+            bucket = self._arrays.get(array)
+            if bucket is None:
+                bucket = self._arrays[array] = TokenBucket(self.array_rate)
+        return bucket.acquire() + self._endpoint.acquire()
+
+
+class BatchSizeStore:
+    """
+    Batch sizes per array and endpoint, shared by all batchers of a run and optionally
+    remembered between runs in a JSON file.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._sizes: Dict[str, Dict[str, int]] = {}
+        self._batchers: Dict[Tuple[str, str], AdaptiveBatcher] = {}
+        self._lock = threading.Lock()
+        if path:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._sizes = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable batch size state {path}: {e}")
+
+    def batcher(self, array: str, endpoint: str, initial: int, minimum: int = 1,
+                maximum: Optional[int] = None) -> AdaptiveBatcher:
+        """
+        Return the shared batcher for an endpoint on an array, starting from the remembered size.
+        Args:
+            array: Fleet member name
+            endpoint: API method name, e.g. 'get_volumes_space'
+            initial: Size used when nothing has been remembered for this array
+            minimum: Smallest size the batcher will shrink to
+            maximum: Largest size the batcher will grow to
+        Returns:
+            AdaptiveBatcher
+        """
+        with self._lock:
+            key = (array, endpoint)
+            if key not in self._batchers:
+                remembered = self._sizes.get(array, {}).get(endpoint, initial)
+
+                def remember(size: int) -> None:
+                    with self._lock:
+                        self._sizes.setdefault(array, {})[endpoint] = size
+
+                self._batchers[key] = AdaptiveBatcher(remembered, minimum=minimum, maximum=maximum, on_change=remember)
+            return self._batchers[key]
+
+    def save(self) -> None:
+        """
+        Write the current sizes to the state file, if one was given.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._sizes, indent=2, sort_keys=True)
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to write batch size state {self.path}: {e}")
+
+
+class CheckpointJournal:
+    """
+    Append-only JSON lines journal of the work a run has completed, so an interrupted
+    run can resume instead of starting over. Each record is flushed and synced before
+    record() returns; a torn last line left by a crash is ignored when resuming.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.records: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        valid_length = 0
+        if resume:
+            try:
+                with open(path, 'rb') as f:
+                    for line in f:
+                        if not line.endswith(b'\n'):
+                            break
+                        try:
+                            self.records.append(json.loads(line))
+                        except ValueError:
+                            break
+                        valid_length += len(line)
+            except FileNotFoundError:
+                pass
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        # Drop a torn last line so new records start on a line of their own
+        self._file.truncate(valid_length)
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        """
+        Durably append a record to the journal.
+        Args:
+            entry: JSON serialisable dict, with a 'type' key by convention
+        """
+        line = json.dumps(entry, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def of_type(self, record_type: str) -> List[Dict[str, Any]]:
+        """
+        Records loaded on resume with the given type, in journal order.
+        Args:
+            record_type: Value of the 'type' key
+        Returns:
+            List of records
+        """
+        return [entry for entry in self.records if entry.get('type') == record_type]
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def remove(self) -> None:
+        """
+        Close and delete the journal once the run has completed.
+        """
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def list_fleets(client: "Client") -> List[str]:
     """
     List all fleets visible to the Fusion client.
     Args:
@@ -107,32 +878,1802 @@ def list_fleets(client: Client) -> List[str]:
         else:
             logger.error(f"Failed to retrieve fleets. Status code: {response.status_code}, Error: {response.errors}")
             return []
-    except PureError as e:
+    except pure_errors() as e:
         logger.error(f"Exception when calling get_fleets: {e}")
         return []
 
 
-def list_members(client: Client, fleets: List[str]) -> List[str]:
+def list_members(client: "Client", fleets: List[str], topology: Optional["FleetTopology"] = None) -> List[str]:
     """
     List all members (arrays) for the given fleets.
     Args:
         client: Fusion API client
         fleets: List of fleet names
+        topology: Previously fetched fleet topology, fetched from the client if not supplied
     Returns:
         List of member (array) names
     """
+    if topology is None:
+        topology = FleetTopology.fetch(client)
     all_members: List[str] = []
     for fleet in fleets:
+        all_members.extend(topology.members_of(fleet))
+    return all_members
+
+
+@dataclass
+class FleetMember:
+    """
+    A single fleet member (array) as seen from the Fusion end-point.
+    """
+    name: str
+    fleet: Optional[str]
+    is_local: Optional[bool] = None
+
+
+class FleetTopology:
+    """
+    Fleets and their members, fetched once and indexed by fleet and by member name.
+    A topology can be shared in memory by both scripts and optionally cached on disk.
+    """
+
+    def __init__(self, fleets: List[str], members: List[FleetMember], fetched_at: Optional[float] = None):
+        self.fleets = list(fleets)
+        self.fetched_at = fetched_at if fetched_at is not None else time.time()
+        self._members: Dict[str, FleetMember] = {}
+        self._members_by_fleet: Dict[str, List[str]] = {fleet: [] for fleet in self.fleets}
+        for member in members:
+            self._members[member.name] = member
+            self._members_by_fleet.setdefault(member.fleet, []).append(member.name)
+
+    @classmethod
+    def fetch(cls, client: "Client") -> "FleetTopology":
+        """
+        Fetch the fleets and fleet members with a single call to each endpoint.
+        Args:
+            client: Fusion API client
+        Returns:
+            FleetTopology (empty if the members could not be retrieved)
+        """
+        fleets = list_fleets(client)
+        members: List[FleetMember] = []
         try:
             response = client.get_fleets_members()
             if response.status_code == 200:
-                members = list(response.items)
-                member_names = [member.member.name for member in members]
-                all_members.extend(member_names)
+                for item in response.items:
+                    # A member without a fleet reference can only belong to the one visible fleet
+                    fleet_name = getattr(getattr(item, 'fleet', None), 'name', None)
+                    if fleet_name is None and len(fleets) == 1:
+                        fleet_name = fleets[0]
+                    members.append(FleetMember(
+                        name=item.member.name,
+                        fleet=fleet_name,
+                        is_local=getattr(item.member, 'is_local', None),
+                    ))
             else:
                 logger.error(f"Failed to list members. Status code: {response.status_code}, Error: {response.errors}")
-                return []
-        except PureError as e:
+        except pure_errors() as e:
             logger.error(f"Failed to list members: {e}")
-            return []
-    return all_members
\ No newline at end of file
+        return cls(fleets, members)
+
+    @classmethod
+    def load(cls, client: "Client", cache_path: Optional[str] = None, ttl: float = DEFAULT_TOPOLOGY_TTL) -> "FleetTopology":
+        """
+        Return the cached topology if it is younger than ttl, otherwise fetch and cache it.
+        Args:
+            client: Fusion API client
+            cache_path: Optional JSON file used as the on-disk cache
+            ttl: Seconds the cached topology remains valid
+        Returns:
+            FleetTopology
+        """
+        if cache_path:
+            cached = cls.read_cache(cache_path, ttl)
+            if cached is not None:
+                return cached
+        topology = cls.fetch(client)
+        if cache_path and topology.members():
+            topology.save(cache_path)
+        return topology
+
+    @classmethod
+    def read_cache(cls, cache_path: str, ttl: float) -> Optional["FleetTopology"]:
+        """
+        Read a cached topology, returning None if it is missing, unreadable or expired.
+        """
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            fetched_at = float(data['fetched_at'])
+            if time.time() - fetched_at > ttl:
+                logger.debug(f"Fleet topology cache {cache_path} has expired")
+                return None
+            members = [FleetMember(**member) for member in data['members']]
+            return cls(data['fleets'], members, fetched_at=fetched_at)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable fleet topology cache {cache_path}: {e}")
+            return None
+
+    def save(self, cache_path: str) -> None:
+        """
+        Write the topology to cache_path, replacing any previous cache atomically.
+        """
+        data = {
+            'fetched_at': self.fetched_at,
+            'fleets': self.fleets,
+            'members': [asdict(member) for member in self._members.values()],
+        }
+        tmp_path = f"{cache_path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Failed to write fleet topology cache {cache_path}: {e}")
+
+    def members(self) -> List[FleetMember]:
+        """
+        All fleet members, in the order returned by the API.
+        """
+        return list(self._members.values())
+
+    def members_of(self, fleet: str) -> List[str]:
+        """
+        Names of the members of a fleet.
+        """
+        return list(self._members_by_fleet.get(fleet, []))
+
+    def member(self, name: str) -> Optional[FleetMember]:
+        """
+        Look up a fleet member by array name.
+        """
+        return self._members.get(name)
+
+    def is_local(self, name: str) -> Optional[bool]:
+        """
+        Whether the member is the local array of the Fusion end-point (None if unknown).
+        """
+        member = self._members.get(name)
+        return member.is_local if member else None
+
+
+class _Categories:
+    """
+    A categorical column: each distinct value is stored once and rows hold int32 codes.
+    """
+
+    def __init__(self) -> None:
+        self.values: List[Any] = []
+        self.codes = array('i')
+        self._index: Dict[Any, int] = {}
+
+    def code(self, value: Any) -> int:
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def append(self, value: Any) -> None:
+        self.codes.append(self.code(value))
+
+
+class _GroupRows:
+    """
+    The rows of one group of a ColumnarRows, as row dicts produced on demand.
+    """
+
+    def __init__(self, rows: "ColumnarRows", row_numbers: List[int]):
+        self._rows = rows
+        self._row_numbers = row_numbers
+
+    def __len__(self) -> int:
+        return len(self._row_numbers)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        headers = self._rows.headers
+        for row in self._rows._iter_tuples(self._row_numbers):
+            yield dict(zip(headers, row))
+
+
+class ColumnarRows:
+    """
+    Report rows stored column-wise: date/time, array and group (tag or array) as categorical
+    codes, item names in a list and each space metric in a float64 array (NaN when missing).
+    A row costs a few machine words instead of a dict with a copy of every key, and the
+    columns convert to a pandas DataFrame or an Arrow table without copying the metrics.
+    Like the dicts it replaces, items() gives the rows of each group as row dicts.
+    """
+
+    def __init__(self, name_header: str, metrics: Sequence[str] = ()):
+        """
+        Args:
+            name_header: Header of the item name column, e.g. 'Volume' or 'Directory'
+            metrics: Space metric names; metrics first seen later are added as they appear
+        """
+        self.name_header = name_header
+        self.metrics: List[str] = []
+        self.date_times = _Categories()
+        self.arrays = _Categories()
+        self.groups_column = _Categories()
+        self.names: List[str] = []
+        self._metric_values: List[Any] = []
+        self._group_index: Optional[Dict[Any, List[int]]] = None
+        for metric in metrics:
+            self.add_metric(metric)
+
+    @property
+    def headers(self) -> List[str]:
+        return ['Date/Time', 'Array', self.name_header] + self.metrics
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add_metric(self, metric: str) -> None:
+        if metric in self.metrics:
+            return
+        self.metrics.append(metric)
+        self._metric_values.append(array('d', [math.nan]) * len(self.names))
+
+    def append(self, group: Any, date_time: Any, array_name: str, name: str, values: Sequence[Any] = ()) -> None:
+        """
+        Append one row.
+        Args:
+            group: Tag or array the row is grouped under
+            date_time: Report date/time
+            array_name: Fleet member name
+            name: Volume or directory name
+            values: Metric values in the order of self.metrics (missing trailing values are NaN)
+        """
+        self._group_index = None
+        self.groups_column.append(group)
+        self.date_times.append(date_time)
+        self.arrays.append(array_name)
+        self.names.append(name)
+        for i, column in enumerate(self._metric_values):
+            value = values[i] if i < len(values) else None
+            if value is None or value == '':
+                value = math.nan
+            if isinstance(column, array):
+                if isinstance(value, (int, float)):
+                    column.append(value)
+                    continue
+                # A value that is not a number keeps the whole column as Python objects
+                column = self._metric_values[i] = [None if math.isnan(v) else v for v in column]
+            column.append(value)
+
+    def extend(self, other: "ColumnarRows") -> None:
+        """
+        Append all rows of another ColumnarRows, adding any metrics it has that this one lacks.
+        """
+        for metric in other.metrics:
+            self.add_metric(metric)
+        other_index = {metric: i for i, metric in enumerate(other.metrics)}
+        positions = [other_index.get(metric) for metric in self.metrics]
+        for row in range(len(other)):
+            self.append(other.groups_column.values[other.groups_column.codes[row]],
+                        other.date_times.values[other.date_times.codes[row]],
+                        other.arrays.values[other.arrays.codes[row]],
+                        other.names[row],
+                        [None if i is None else other._metric_values[i][row] for i in positions])
+
+    def _group_row_numbers(self) -> Dict[Any, List[int]]:
+        # Row numbers of each group, in order of first appearance, from one pass over the codes;
+        # kept until the next append so that per-group lookups do not scan every row again
+        if self._group_index is None:
+            by_code: Dict[int, List[int]] = {}
+            for row, code in enumerate(self.groups_column.codes):
+                by_code.setdefault(code, []).append(row)
+            self._group_index = {self.groups_column.values[code]: rows for code, rows in by_code.items()}
+        return self._group_index
+
+    def _row_numbers(self, group: Any = None) -> Iterable[int]:
+        if group is None:
+            return range(len(self))
+        return self._group_row_numbers().get(group, [])
+
+    def _iter_tuples(self, row_numbers: Iterable[int]) -> Iterator[Tuple[Any, ...]]:
+        for row in row_numbers:
+            values = [column[row] for column in self._metric_values]
+            yield (self.date_times.values[self.date_times.codes[row]], self.arrays.values[self.arrays.codes[row]],
+                   self.names[row], *(None if isinstance(v, float) and math.isnan(v) else v for v in values))
+
+    def groups(self) -> List[Any]:
+        """
+        Groups in order of first appearance.
+        """
+        return list(self._group_row_numbers())
+
+    def iter_rows(self, group: Any = None) -> Iterator[Tuple[Any, ...]]:
+        """
+        Rows as tuples matching headers, for one group or all rows; NaN is returned as None.
+        """
+        return self._iter_tuples(self._row_numbers(group))
+
+    def items(self) -> List[Tuple[Any, _GroupRows]]:
+        return [(group, _GroupRows(self, rows)) for group, rows in self._group_row_numbers().items()]
+
+    def values(self) -> List[_GroupRows]:
+        return [rows for _, rows in self.items()]
+
+    def to_dataframe(self, group: Any = None) -> Any:
+        """
+        The rows as a pandas DataFrame with categorical date/time and array columns. The metric
+        columns share memory with this buffer when all rows are converted.
+        Args:
+            group: Only the rows of this group (the selected rows are copied)
+        """
+        import numpy as np
+        import pandas as pd
+
+        selection = None if group is None else np.fromiter(self._row_numbers(group), dtype=np.int64)
+
+        def column(values: Any, dtype: Any = None) -> Any:
+            data = np.frombuffer(values, dtype=dtype) if isinstance(values, array) else np.asarray(values, dtype=object)
+            return data if selection is None else data[selection]
+
+        def categorical(categories: _Categories) -> Any:
+            return pd.Categorical.from_codes(column(categories.codes, np.int32), categories.values)
+
+        names = self.names if selection is None else [self.names[row] for row in selection]
+        data = {'Date/Time': categorical(self.date_times), 'Array': categorical(self.arrays), self.name_header: names}
+        for metric, values in zip(self.metrics, self._metric_values):
+            data[metric] = column(values, np.float64)
+        return pd.DataFrame(data, copy=False)
+
+    def to_arrow(self) -> Any:
+        """
+        The rows as a pyarrow Table, with dictionary-encoded date/time, array and group columns.
+        Numeric metric columns are not copied. pyarrow is an optional dependency, not in
+        requirements.txt: install it to use this method, which raises ImportError without it.
+        """
+        import numpy as np
+        import pyarrow as pa
+
+        def dictionary(categories: _Categories) -> Any:
+            return pa.DictionaryArray.from_arrays(np.frombuffer(categories.codes, dtype=np.int32),
+                                                  pa.array([str(v) for v in categories.values]))
+
+        columns = {'Date/Time': dictionary(self.date_times), 'Array': dictionary(self.arrays),
+                   'Group': dictionary(self.groups_column), self.name_header: pa.array(self.names)}
+        for metric, values in zip(self.metrics, self._metric_values):
+            columns[metric] = pa.array(np.frombuffer(values, dtype=np.float64) if isinstance(values, array) else values)
+        return pa.table(columns)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        A JSON serialisable form of the rows, read back by from_dict.
+        """
+        return {
+            'name_header': self.name_header,
+            'metrics': self.metrics,
+            'rows': [[self.groups_column.values[self.groups_column.codes[row]], *values]
+                     for row, values in zip(range(len(self)), self.iter_rows())],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], name_header: str = '') -> "ColumnarRows":
+        rows = cls(data.get('name_header', name_header), data.get('metrics', ()))
+        for group, date_time, array_name, name, *values in data.get('rows', ()):
+            rows.append(group, date_time, array_name, name, values)
+        return rows
+
+
+class ReportHistory:
+    """
+    Append-only SQLite store of report rows, one table per report ('volumes', 'directories').
+    Each row keeps its date/time, month, array, group (tag or array) and item name in
+    indexed columns; space metrics get one column each, added as new metrics appear.
+    Appending costs time proportional to the new rows, and workbooks are rendered from here.
+    """
+
+    BASE_COLUMNS = ('date_time', 'month', 'array_name', 'grp', 'item_name')
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._metric_columns: Dict[str, List[str]] = {}
+
+    def close(self) -> None:
+        self._conn.close()
+
+    @staticmethod
+    def _quote(identifier: str) -> str:
+        return '"' + identifier.replace('"', '""') + '"'
+
+    def _ensure_table(self, report: str) -> List[str]:
+        if report in self._metric_columns:
+            return self._metric_columns[report]
+        table = self._quote(report)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, date_time TEXT NOT NULL, "
+            f"month TEXT NOT NULL, array_name TEXT NOT NULL, grp TEXT NOT NULL, item_name TEXT NOT NULL)")
+        for column in ('date_time', 'array_name', 'grp'):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self._quote(f'{report}_{column}')} ON {table} ({column})")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {self._quote(f'{report}_month_grp')} ON {table} (month, grp)")
+        columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+        self._metric_columns[report] = [c for c in columns if c != 'id' and c not in self.BASE_COLUMNS]
+        return self._metric_columns[report]
+
+    def append(self, report: str, report_data: Dict[str, Iterable[Dict[str, Any]]], name_header: str) -> int:
+        """
+        Append grouped report rows in a single transaction.
+        Args:
+            report: Report (table) name, e.g. 'volumes'
+            report_data: ColumnarRows, or dict mapping group (tag/array) to an iterable of row dicts
+            name_header: Row key holding the item name, e.g. 'Volume' or 'Directory'
+        Returns:
+            Number of rows appended
+        """
+        metric_columns = self._ensure_table(report)
+        table = self._quote(report)
+        known = set(metric_columns) | set(self.BASE_COLUMNS) | {'Date/Time', 'Array', name_header}
+        insert_sql = None
+        count = 0
+        with self._conn:
+            for group, rows in report_data.items():
+                for row in rows:
+                    for key in row:
+                        if key not in known:
+                            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {self._quote(key)}")
+                            metric_columns.append(key)
+                            known.add(key)
+                            insert_sql = None
+                    if insert_sql is None:
+                        columns = list(self.BASE_COLUMNS) + metric_columns
+                        insert_sql = (f"INSERT INTO {table} ({', '.join(self._quote(c) for c in columns)}) "
+                                      f"VALUES ({', '.join('?' * len(columns))})")
+                    date_time = row['Date/Time']
+                    values = [date_time, str(date_time)[:7], row['Array'], str(group), row[name_header]]
+                    values.extend(row.get(key) for key in metric_columns)
+                    self._conn.execute(insert_sql, values)
+                    count += 1
+        return count
+
+    def count(self, report: str, month: str) -> int:
+        """
+        Number of rows stored for a report in the given month.
+        """
+        self._ensure_table(report)
+        row = self._conn.execute(f"SELECT COUNT(*) FROM {self._quote(report)} WHERE month = ?", (month,)).fetchone()
+        return row[0]
+
+    def import_workbook(self, report: str, path: str, name_header: str, sheet_prefix: str) -> int:
+        """
+        Append the rows of an existing report workbook, e.g. one written before the store was used.
+        Args:
+            report: Report (table) name, e.g. 'volumes'
+            path: Excel file path
+            name_header: Header of the item name column, e.g. 'Volume'
+            sheet_prefix: Prefix of the worksheet names, followed by a space and the group
+        Returns:
+            Number of rows appended
+        """
+        from openpyxl import load_workbook
+
+        def sheet_rows(worksheet: Any) -> Iterator[Dict[str, Any]]:
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            for row in rows:
+                if row and row[0] is not None:
+                    yield dict(zip(header, row))
+
+        workbook = load_workbook(path, read_only=True)
+        try:
+            prefix = f"{sheet_prefix} "
+            return self.append(report, {worksheet.title[len(prefix):]: sheet_rows(worksheet)
+                                        for worksheet in workbook.worksheets if worksheet.title.startswith(prefix)},
+                               name_header)
+        finally:
+            workbook.close()
+
+    def headers(self, report: str, name_header: str) -> List[str]:
+        """
+        Worksheet headers for a report: date/time, array, item name and every stored metric.
+        """
+        return ['Date/Time', 'Array', name_header] + list(self._ensure_table(report))
+
+    def groups(self, report: str, month: str) -> List[str]:
+        """
+        Groups (tags or arrays) with rows in the given month, in order of first appearance.
+        """
+        self._ensure_table(report)
+        table = self._quote(report)
+        rows = self._conn.execute(
+            f"SELECT grp, MIN(id) AS first FROM {table} WHERE month = ? GROUP BY grp ORDER BY first", (month,))
+        return [row[0] for row in rows]
+
+    def iter_rows(self, report: str, month: str, group: str) -> Iterator[Tuple[Any, ...]]:
+        """
+        Rows of one group in the given month, in insertion order, as tuples matching headers().
+        """
+        metric_columns = self._ensure_table(report)
+        columns = ['date_time', 'array_name', 'item_name'] + metric_columns
+        cursor = self._conn.execute(
+            f"SELECT {', '.join(self._quote(c) for c in columns)} FROM {self._quote(report)} "
+            f"WHERE month = ? AND grp = ? ORDER BY id", (month, group))
+        for row in cursor:
+            yield row
+
+
+def workbook_errors() -> Tuple[type, ...]:
+    """
+    The exception types load_workbook raises for a file that is not a readable workbook:
+    a truncated file or no zip at all, a zip without the workbook parts, or content openpyxl rejects.
+    """
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    return (zipfile.BadZipFile, KeyError, ValueError, InvalidFileException)
+
+
+def set_aside_workbook(path: str, error: Exception) -> str:
+    """
+    Move an unreadable (e.g. truncated) workbook out of the way, so that a new one can be
+    written in its place while the damaged file is kept for inspection.
+    Returns:
+        Path the workbook was moved to
+    """
+    corrupt_path = f"{path}.corrupt"
+    logger.error("%s is not a readable workbook (%s). Moved it to %s and writing a new one; rows of earlier runs "
+                 "can be rendered again from a --history-db store.", path, error, corrupt_path)
+    os.replace(path, corrupt_path)
+    return corrupt_path
+
+
+class StreamingExcelWriter:
+    """
+    Writes report rows straight to an xlsx file with openpyxl's write-only workbook,
+    one worksheet per group (tag or array), so memory stays constant however many rows
+    are written. Rows already in an existing file are streamed across first, which
+    keeps the month-to-date append behaviour. The file is replaced when the writer closes.
+    """
+
+    def __init__(self, path: str, sheet_prefix: str, headers: Any = None, keep_existing: bool = True):
+        """
+        Args:
+            path: Output Excel file path
+            sheet_prefix: Prefix for worksheet names
+            headers: Header list, or a callable returning it when a new sheet is created.
+                If None, the keys of the first row written to a sheet are used.
+            keep_existing: Copy the sheets of an existing file into the new one
+        """
+        from openpyxl import Workbook
+
+        self.path = path
+        self.sheet_prefix = sheet_prefix
+        self._headers = headers
+        self._workbook = Workbook(write_only=True)
+        self._sheets: Dict[str, Any] = {}
+        self._sheet_headers: Dict[str, Optional[List[Any]]] = {}
+        if keep_existing and os.path.exists(path):
+            self._copy_existing(path)
+
+    def _copy_existing(self, path: str) -> None:
+        from openpyxl import load_workbook
+
+        try:
+            source = load_workbook(path, read_only=True)
+        except workbook_errors() as e:
+            set_aside_workbook(path, e)
+            return
+        try:
+            for worksheet in source.worksheets:
+                target = self._workbook.create_sheet(worksheet.title)
+                header = None
+                for row in worksheet.iter_rows(values_only=True):
+                    if header is None:
+                        header = list(row)
+                    target.append(row)
+                self._sheets[worksheet.title] = target
+                self._sheet_headers[worksheet.title] = header
+        finally:
+            source.close()
+
+    def _resolve_headers(self, first_row: Any) -> Optional[List[Any]]:
+        headers = self._headers() if callable(self._headers) else self._headers
+        if headers is None and isinstance(first_row, dict):
+            headers = list(first_row.keys())
+        return list(headers) if headers is not None else None
+
+    def write_rows(self, group: str, rows: Iterable[Any]) -> int:
+        """
+        Append rows to the worksheet of a group, creating it with headers on first use.
+        Args:
+            group: Tag or array name
+            rows: Iterable of row dicts (mapped by header) or row sequences
+        Returns:
+            Number of rows written
+        """
+        sheet_name = f"{self.sheet_prefix} {group}"
+        count = 0
+        for row in rows:
+            sheet = self._sheets.get(sheet_name)
+            if sheet is None:
+                sheet = self._workbook.create_sheet(sheet_name)
+                headers = self._resolve_headers(row)
+                if headers is not None:
+                    sheet.append(headers)
+                self._sheets[sheet_name] = sheet
+                self._sheet_headers[sheet_name] = headers
+            headers = self._sheet_headers[sheet_name]
+            if isinstance(row, dict):
+                sheet.append([row.get(key, '') for key in headers] if headers else list(row.values()))
+            else:
+                sheet.append(list(row))
+            count += 1
+        return count
+
+    def write_pages(self, pages: Iterable[Dict[str, Iterable[Any]]]) -> int:
+        """
+        Write a stream of pages, each a dict mapping group to rows, as produced by the collectors.
+        Returns:
+            Number of rows written
+        """
+        count = 0
+        for page in pages:
+            for group, rows in page.items():
+                count += self.write_rows(group, rows)
+        return count
+
+    def close(self) -> None:
+        """
+        Save the workbook next to the target and move it into place.
+        """
+        if not self._sheets:
+            logger.warning(f"No data to write to {self.path}. Skipping.")
+            return
+        tmp_path = f"{self.path}.tmp"
+        self._workbook.save(tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def __enter__(self) -> "StreamingExcelWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        if exc_type is None:
+            self.close()
+
+
+# realm::pod::volume, pod::volume or a plain volume name, matched in one pass
+VOLUME_NAME_PATTERN = re.compile(
+    r'^(?:(?:(?P<realm>[\w.-]+)::)?(?P<pod>[\w.-]+)::(?P<pod_volume>[\w.-]+)|(?P<volume>[\w-]+(?:/[\w-]+)*))$')
+
+
+class ParsedVolumeNames(NamedTuple):
+    """
+    Columns of realm, pod and volume names for a page of volume names.
+    Names that match no pattern have no realm or pod, keep their full name as the
+    volume, and are listed in unparsed.
+    """
+    realms: List[Optional[str]]
+    pods: List[Optional[str]]
+    volumes: List[str]
+    unparsed: List[str]
+
+
+def parse_volume_names(names: Sequence[str]) -> ParsedVolumeNames:
+    """
+    Split a page of volume names into realm, pod and volume columns with a single
+    precompiled pattern.
+    Args:
+        names: Volume names, e.g. 'realm1::pod1::vol1', 'pod1::vol1' or 'vol1'
+    Returns:
+        ParsedVolumeNames with one entry per name in each column
+    """
+    realms: List[Optional[str]] = []
+    pods: List[Optional[str]] = []
+    volumes: List[str] = []
+    unparsed: List[str] = []
+    for name, match in zip(names, map(VOLUME_NAME_PATTERN.match, names)):
+        if match is None:
+            realms.append(None)
+            pods.append(None)
+            volumes.append(name)
+            unparsed.append(name)
+            continue
+        realm, pod, pod_volume, volume = match.groups()
+        realms.append(realm)
+        pods.append(pod)
+        volumes.append(pod_volume if pod is not None else volume)
+    return ParsedVolumeNames(realms, pods, volumes, unparsed)
+
+
+# Tagging rule types, in decreasing order of precedence
+TAGGING_ORDER = ("realm", "pod", "workload", "host_group", "host", "default")
+
+
+class TaggingRuleEngine:
+    """
+    TAGGING_RULES compiled once into a precedence-ordered resolver.
+    Resolution is memoized on the (realm, pod, host_group, host) key, of which there are
+    only as many as there are container combinations, however many volumes share them.
+    """
+
+    def __init__(self, rules: Dict[str, Dict[str, str]], max_cache: int = 100000):
+        """
+        Args:
+            rules: dict mapping rule type (see TAGGING_ORDER) to {container name: tag value}
+            max_cache: Number of memoized keys kept before the memo is reset
+        """
+        self.max_cache = max_cache
+        # Rules without a tag value can never match, so they are dropped here
+        self._rules = {key: {name: value for name, value in rules.get(key, {}).items() if value}
+                       for key in TAGGING_ORDER}
+        default = self._rules["default"].get("default")
+        self._default = (default, "default") if default else (None, None)
+        self._cache: Dict[Tuple[Any, ...], Tuple[Optional[str], Optional[str]]] = {}
+
+    def _resolve(self, realm: Optional[str], pod: Optional[str], host_group: Optional[str],
+                 host: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        # Workload rules have no container on the volume yet, so they never match
+        for rule, container in (("realm", realm), ("pod", pod), ("host_group", host_group), ("host", host)):
+            if container is not None:
+                value = self._rules[rule].get(container)
+                if value:
+                    return value, rule
+        return self._default
+
+    def resolve(self, realm: Optional[str], pod: Optional[str], host_group: Optional[str],
+                host: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Resolve the tag for one volume's containers.
+        Returns:
+            (tag value, rule type that matched), or (None, None) if no rule and no default applies
+        """
+        return self.resolve_batch([(realm, pod, host_group, host)])[0]
+
+    def resolve_batch(self, keys: Iterable[Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]]
+                      ) -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        Resolve a whole page of volumes in one call.
+        Args:
+            keys: (realm, pod, host_group, host) for each volume
+        Returns:
+            List of (tag value, rule type) in the same order as keys
+        """
+        cache = self._cache
+        resolve = self._resolve
+        results = []
+        append = results.append
+        for key in keys:
+            result = cache.get(key)
+            if result is None:
+                if len(cache) >= self.max_cache:
+                    cache.clear()
+                result = cache[key] = resolve(*key)
+            append(result)
+        return results
+
+
+CONFIG_CACHE_VERSION = 1
+TAGGING_MAP_COLUMNS = ('Tag_By', 'Container_Name', 'Tag_Value')
+
+
+class ConfigError(ValueError):
+    """
+    The configuration file is missing, unreadable or fails validation.
+    """
+
+
+@dataclass
+class StaasConfig:
+    """
+    The validated contents of a configuration file.
+    """
+    settings: Dict[str, Any]
+    tagging_rules: Dict[str, Dict[str, str]]
+    warnings: List[str]
+
+
+def _config_value(value: Any) -> Any:
+    # Spreadsheet numbers such as tag values come back as floats when written as 100000.0
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    return value
+
+
+def _read_config_workbook(path: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    Read the Fleet settings and Tagging_map rows of a configuration workbook with a read-only openpyxl
+    workbook, which avoids loading pandas for a few dozen cells.
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        def sheet_rows(name: str) -> Optional[List[Dict[str, Any]]]:
+            if name not in workbook.sheetnames:
+                return None
+            rows = workbook[name].iter_rows(values_only=True)
+            header = [_config_value(cell) for cell in next(rows, ())]
+            return [{key: _config_value(cell) for key, cell in zip(header, row) if key is not None}
+                    for row in rows if any(cell is not None for cell in row)]
+
+        fleet = sheet_rows('Fleet')
+        if fleet is None:
+            raise ConfigError(f"{path} has no Fleet worksheet")
+        return (fleet[0] if fleet else {}), sheet_rows('Tagging_map') or []
+    finally:
+        workbook.close()
+
+
+def _read_config_document(path: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """
+    Read a YAML, TOML or JSON configuration. The document holds a `fleet` table of settings and either a
+    `tagging_rules` table of {Tag_By: {Container_Name: Tag_Value}} or a `tagging_map` list of rows with
+    the Tagging_map worksheet columns.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ConfigError(f"Reading {path} requires PyYAML (pip install pyyaml)")
+        with open(path, encoding='utf-8') as f:
+            document = yaml.safe_load(f) or {}
+    elif extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ConfigError(f"Reading {path} requires Python 3.11 or tomli (pip install tomli)")
+        with open(path, 'rb') as f:
+            document = tomllib.load(f)
+    else:
+        with open(path, encoding='utf-8') as f:
+            document = json.load(f)
+    if not isinstance(document, dict):
+        raise ConfigError(f"{path} must hold a table with fleet and tagging_rules entries")
+    settings = {key: _config_value(value) for key, value in (document.get('fleet') or {}).items()}
+    rows = [{key: _config_value(value) for key, value in row.items()} for row in document.get('tagging_map') or []]
+    for tag_by, containers in (document.get('tagging_rules') or {}).items():
+        for container_name, tag_value in (containers or {}).items():
+            rows.append({'Tag_By': tag_by, 'Container_Name': _config_value(container_name),
+                         'Tag_Value': _config_value(tag_value)})
+    return settings, rows
+
+
+def compile_config(settings: Dict[str, Any], rows: Iterable[Dict[str, Any]], source: str = 'config') -> StaasConfig:
+    """
+    Validate the Fleet settings and Tagging_map rows and build the tagging rules.
+    Args:
+        settings: Fleet settings, e.g. FUSION_SERVER and NAMESPACE
+        rows: Tagging_map rows with the TAGGING_MAP_COLUMNS keys
+        source: Name of the configuration, used in messages
+    Returns:
+        StaasConfig; rules with an unknown Tag_By are skipped and reported in warnings
+    Raises:
+        ConfigError: listing every problem found
+    """
+    errors = []
+    warnings = []
+    settings = {key: value for key, value in settings.items() if value is not None}
+    for key in ('FUSION_SERVER', 'NAMESPACE'):
+        if not isinstance(settings.get(key), str):
+            errors.append(f"Fleet setting {key} is missing")
+    if 'LOG_LEVEL' in settings and str(settings['LOG_LEVEL']).lower() not in LOG_LEVELS:
+        errors.append(f"Fleet setting LOG_LEVEL must be one of {', '.join(LOG_LEVELS)}")
+
+    tagging_rules: Dict[str, Dict[str, str]] = {key: {} for key in TAGGING_ORDER}
+    for number, row in enumerate(rows, start=2):
+        tag_by = str(row.get('Tag_By') or '').lower()
+        container_name = row.get('Container_Name')
+        tag_value = row.get('Tag_Value')
+        if tag_by not in tagging_rules:
+            warnings.append(f"Tagging_map row {number}: unknown Tag_By value '{row.get('Tag_By')}', skipping it")
+            continue
+        if container_name is None or tag_value is None:
+            errors.append(f"Tagging_map row {number}: {', '.join(c for c in TAGGING_MAP_COLUMNS if row.get(c) is None)} missing")
+            continue
+        container_name, tag_value = str(container_name), str(tag_value)
+        previous = tagging_rules[tag_by].get(container_name)
+        if previous is not None and previous != tag_value:
+            warnings.append(f"Tagging_map row {number}: {tag_by} {container_name} is tagged {previous} by an "
+                            f"earlier row, using {tag_value}")
+        tagging_rules[tag_by][container_name] = tag_value
+    if errors:
+        raise ConfigError(f"{source} is not valid:\n  " + '\n  '.join(errors))
+    return StaasConfig(settings, tagging_rules, warnings)
+
+
+def config_cache_path(path: str) -> str:
+    """
+    Default location of the compiled form of a configuration file: a hidden file next to it.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, f".{name}.compiled.json")
+
+
+def checkpoint_path(path: str, script: str) -> str:
+    """
+    Default location of a script's checkpoint journal: a hidden file next to its configuration,
+    so that every script resumes from the same place whatever its other options.
+    Args:
+        path: Configuration file
+        script: Script the journal belongs to, e.g. 'reporting' or 'tag_vols'
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, f".{name}.{script}.journal")
+
+
+def load_config(path: str, cache_path: Optional[str] = None) -> StaasConfig:
+    """
+    Load and validate a configuration workbook (.xlsx) or an equivalent YAML, TOML or JSON file.
+    The compiled configuration is saved as JSON keyed on the file's path, mtime and SHA-256, so later
+    runs load it without parsing the file again; a file that was touched but not changed is
+    recognised by its hash.
+    Args:
+        path: Configuration file
+        cache_path: Compiled configuration file (default: config_cache_path(path), '' to disable)
+    Returns:
+        StaasConfig
+    Raises:
+        ConfigError: if the file is missing or not valid
+    """
+    if not os.path.exists(path):
+        raise ConfigError(f"Configuration file not found: {path}")
+    if cache_path is None:
+        cache_path = config_cache_path(path)
+    stat = os.stat(path)
+    key = {'version': CONFIG_CACHE_VERSION, 'path': os.path.abspath(path), 'mtime_ns': stat.st_mtime_ns,
+           'size': stat.st_size}
+
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug("Ignoring unreadable config cache %s: %s", cache_path, e)
+    if cached and all(cached.get('key', {}).get(k) == v for k, v in key.items()):
+        return StaasConfig(**cached['config'])
+
+    with open(path, 'rb') as f:
+        key['sha256'] = hashlib.sha256(f.read()).hexdigest()
+    if cached and {k: v for k, v in cached.get('key', {}).items() if k != 'mtime_ns'} == \
+            {k: v for k, v in key.items() if k != 'mtime_ns'}:
+        config = StaasConfig(**cached['config'])
+    else:
+        try:
+            if os.path.splitext(path)[1].lower() in ('.xlsx', '.xlsm'):
+                settings, rows = _read_config_workbook(path)
+            else:
+                settings, rows = _read_config_document(path)
+        except ConfigError:
+            raise
+        except Exception as e:
+            raise ConfigError(f"Cannot read configuration file {path}: {e}") from e
+        config = compile_config(settings, rows, path)
+
+    if cache_path:
+        try:
+            _write_atomic(cache_path, json.dumps({'key': key, 'config': asdict(config)}, default=str))
+        except OSError as e:
+            logger.debug("Cannot write config cache %s: %s", cache_path, e)
+    return config
+
+
+def context_name(kwargs: Dict[str, Any]) -> str:
+    """
+    The fleet member an API call is addressed to, from its context_names argument ('' if none).
+    """
+    context = kwargs.get('context_names')
+    if isinstance(context, (list, tuple)):
+        return ','.join(str(name) for name in context)
+    return str(context) if context else ''
+
+
+class AsyncFusionClient:
+    """
+    Asyncio facade over the blocking Fusion client. Calls run on a thread pool and are
+    limited by a global semaphore and a per-array semaphore, so a single event loop can
+    fan out across many requests without overloading any one fleet member. Semaphores are
+    kept per event loop, so the facade can be used by successive asyncio.run() calls.
+    Blocking callers hand coroutines to submit(), which runs them on the facade's own loop.
+    """
+
+    def __init__(self, client: "Client", max_concurrency: int = 32, per_array_concurrency: int = 4):
+        """
+        Args:
+            client: Fusion API client
+            max_concurrency: Maximum number of requests in flight in total
+            per_array_concurrency: Maximum number of requests in flight per fleet member
+        """
+        self.client = client
+        self.max_concurrency = max(1, max_concurrency)
+        self.per_array_concurrency = max(1, per_array_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='staas-async')
+        # Global semaphore and per-array semaphores of each running event loop
+        self._loop_semaphores: "weakref.WeakKeyDictionary[Any, Tuple[asyncio.Semaphore, Dict[str, asyncio.Semaphore]]]" = \
+            weakref.WeakKeyDictionary()
+        self._loop: Optional["asyncio.AbstractEventLoop"] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _semaphores(self, array: str) -> Tuple["asyncio.Semaphore", "asyncio.Semaphore"]:
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            semaphores = self._loop_semaphores.get(loop)
+            if semaphores is None:
+                semaphores = self._loop_semaphores[loop] = (asyncio.Semaphore(self.max_concurrency), {})
+            global_semaphore, array_semaphores = semaphores
+            if array not in array_semaphores:
+                array_semaphores[array] = asyncio.Semaphore(self.per_array_concurrency)
+            return global_semaphore, array_semaphores[array]
+
+    async def call(self, method: str, **kwargs: Any) -> Any:
+        """
+        Await a client method, e.g. await call('get_volumes', context_names=['array1']).
+        """
+        import asyncio
+
+        global_semaphore, array_semaphore = self._semaphores(context_name(kwargs))
+        async with array_semaphore:
+            async with global_semaphore:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self._executor, functools.partial(getattr(self.client, method), **kwargs))
+
+    async def get_volumes(self, **kwargs: Any) -> Any:
+        return await self.call('get_volumes', **kwargs)
+
+    async def get_volumes_space(self, **kwargs: Any) -> Any:
+        return await self.call('get_volumes_space', **kwargs)
+
+    async def get_volumes_tags(self, **kwargs: Any) -> Any:
+        return await self.call('get_volumes_tags', **kwargs)
+
+    async def get_directories(self, **kwargs: Any) -> Any:
+        return await self.call('get_directories', **kwargs)
+
+    async def get_arrays_space(self, **kwargs: Any) -> Any:
+        return await self.call('get_arrays_space', **kwargs)
+
+    async def get_realms_space(self, **kwargs: Any) -> Any:
+        return await self.call('get_realms_space', **kwargs)
+
+    async def get_connections(self, **kwargs: Any) -> Any:
+        return await self.call('get_connections', **kwargs)
+
+    async def put_volumes_tags_batch(self, **kwargs: Any) -> Any:
+        return await self.call('put_volumes_tags_batch', **kwargs)
+
+    async def paginate(self, method: str, limit: Optional[int] = None,
+                       continuation_token: Optional[str] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        """
+        Async counterpart of paginate(): yields each page response of a list endpoint,
+        following continuation tokens. A failed response is yielded and ends the iteration.
+        """
+        while True:
+            response = await self.call(method, limit=limit, continuation_token=continuation_token, **kwargs)
+            yield response
+            if response.status_code != 200:
+                return
+            continuation_token = getattr(response, 'continuation_token', None)
+            if not continuation_token:
+                return
+
+    def submit(self, coroutine: Any) -> "Future[Any]":
+        """
+        Run a coroutine on the facade's event loop, started in a daemon thread on first use,
+        for callers that are not themselves async. Coroutines submitted from any number of
+        threads share the loop, and so the global and per-array limits.
+        Returns:
+            concurrent.futures.Future of the coroutine's result
+        """
+        import asyncio
+
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name='staas-async-loop', daemon=True)
+                self._loop_thread.start()
+            return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def close(self) -> None:
+        with self._lock:
+            loop, thread, self._loop, self._loop_thread = self._loop, self._loop_thread, None, None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self._executor.shutdown(wait=False)
+
+
+# Responses worth retrying: throttled, or a transient server-side failure
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Per-thread details of the API call in progress, shared by the client wrappers
+_call_context = threading.local()
+
+
+class FailedResponse:
+    """
+    Stand-in for an API error response, returned when a call could not be made or
+    raised an exception, so callers can keep checking status_code.
+    """
+
+    def __init__(self, status_code: int, error: str):
+        self.status_code = status_code
+        self.errors = [error]
+        self.items: List[Any] = []
+        self.continuation_token = None
+        self.total_item_count = 0
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Whether an exception raised by the client is a transport failure worth retrying.
+    """
+    return (isinstance(error, OSError) or is_timeout_error(error)
+            or type(error).__module__.split('.')[0] in ('urllib3', 'requests'))
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff: the delay before attempt n+1 is drawn uniformly
+    from [0, min(max_delay, base_delay * 2**n)].
+    """
+
+    def __init__(self, attempts: int = DEFAULT_RETRIES, base_delay: float = 0.5, max_delay: float = 30.0):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Per-array circuit breaker. After `threshold` consecutive failed calls an array's
+    circuit opens and calls to it fail fast; after `reset_timeout` seconds one trial
+    call is let through, and its success closes the circuit again.
+    """
+
+    def __init__(self, threshold: int = DEFAULT_BREAKER_THRESHOLD, reset_timeout: float = DEFAULT_BREAKER_RESET):
+        self.threshold = max(1, threshold)
+        self.reset_timeout = reset_timeout
+        self._failures: Dict[str, int] = {}
+        self._opened_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def allow(self, array: str) -> bool:
+        with self._lock:
+            opened_at = self._opened_at.get(array)
+            if opened_at is None:
+                return True
+            if time.monotonic() - opened_at >= self.reset_timeout:
+                # Half-open: let one trial call through and re-arm the timer
+                self._opened_at[array] = time.monotonic()
+                return True
+            return False
+
+    def record_success(self, array: str) -> None:
+        with self._lock:
+            self._failures.pop(array, None)
+            self._opened_at.pop(array, None)
+
+    def record_failure(self, array: str) -> None:
+        with self._lock:
+            self._failures[array] = self._failures.get(array, 0) + 1
+            if self._failures[array] >= self.threshold and array not in self._opened_at:
+                logger.error("Array %s failed %d calls in a row, skipping it for %ss", array, self._failures[array],
+                             self.reset_timeout, extra={'array': array})
+                self._opened_at[array] = time.monotonic()
+
+    def is_open(self, array: str) -> bool:
+        with self._lock:
+            return array in self._opened_at
+
+
+class ResilientClient:
+    """
+    Wraps a Fusion client so that every API call (get_/put_/patch_/post_/delete_ methods)
+    is retried with jittered exponential backoff on retryable statuses and transport errors,
+    and fails fast while its array's circuit breaker is open. Arrays with a call that
+    finally failed are listed in incomplete_arrays.
+    """
+
+    API_PREFIXES = ('get_', 'put_', 'patch_', 'post_', 'delete_')
+
+    def __init__(self, client: "Client", policy: Optional[RetryPolicy] = None, breaker: Optional[CircuitBreaker] = None):
+        self._client = client
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        self._incomplete: Dict[str, None] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def incomplete_arrays(self) -> List[str]:
+        """
+        Arrays (context names) for which at least one call failed after all retries.
+        """
+        with self._lock:
+            return [array for array in self._incomplete if array]
+
+    def _mark_incomplete(self, array: str) -> None:
+        with self._lock:
+            self._incomplete[array] = None
+
+    def reset_incomplete(self) -> None:
+        """
+        Forget the incomplete arrays, for a long-running process starting its next run.
+        """
+        with self._lock:
+            self._incomplete.clear()
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or not name.startswith(self.API_PREFIXES):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args: Any, **kwargs: Any) -> Any:
+            return self._call(name, attribute, args, kwargs)
+
+        return call
+
+    def _call(self, name: str, method: Callable[..., Any], args: Any, kwargs: Dict[str, Any]) -> Any:
+        array = context_name(kwargs)
+        if array and not self.breaker.allow(array):
+            self._mark_incomplete(array)
+            return FailedResponse(503, f"Circuit open for array {array}, {name} not sent")
+
+        response: Any = None
+        for attempt in range(self.policy.attempts):
+            _call_context.retries = attempt
+            if attempt:
+                time.sleep(self.policy.delay(attempt - 1))
+            try:
+                response = method(*args, **kwargs)
+            except Exception as e:
+                if not is_transient_error(e):
+                    raise
+                logger.warning("%s on %s failed (attempt %d/%d): %s", name, array or 'fusion', attempt + 1,
+                               self.policy.attempts, e, extra={'endpoint': name, 'array': array})
+                response = FailedResponse(408 if is_timeout_error(e) else 503, f"{type(e).__name__}: {e}")
+                continue
+            status_code = getattr(response, 'status_code', 200)
+            if status_code not in RETRYABLE_STATUS_CODES:
+                if array:
+                    self.breaker.record_success(array)
+                return response
+            logger.warning("%s on %s returned %s (attempt %d/%d)", name, array or 'fusion', status_code, attempt + 1,
+                           self.policy.attempts, extra={'endpoint': name, 'array': array, 'status': status_code})
+
+        if array:
+            self.breaker.record_failure(array)
+            self._mark_incomplete(array)
+        return response
+
+
+class CachedResponse:
+    """
+    A response served from the response cache, with the attributes the helpers use.
+    """
+
+    def __init__(self, status_code: int, items: List[Any], continuation_token: Optional[str] = None,
+                 total_item_count: Optional[int] = None):
+        self.status_code = status_code
+        self.items = items
+        self.errors: List[Any] = []
+        self.continuation_token = continuation_token
+        self.total_item_count = total_item_count
+
+
+def _to_plain(value: Any) -> Any:
+    """
+    Convert API models to JSON serialisable values.
+    """
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): _to_plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(v) for v in value]
+    to_dict = getattr(value, 'to_dict', None)
+    if callable(to_dict):
+        return _to_plain(to_dict())
+    if hasattr(value, '__dict__'):
+        return {k: _to_plain(v) for k, v in vars(value).items() if not k.startswith('_')}
+    return str(value)
+
+
+def _from_plain(value: Any) -> Any:
+    """
+    Rebuild attribute-style objects from values converted by _to_plain.
+    """
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _from_plain(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_from_plain(v) for v in value]
+    return value
+
+
+class CachingClient:
+    """
+    Wraps a Fusion client with an on-disk record/replay cache of read (get_) calls, keyed by
+    end-point, context and parameters. Successful responses are always recorded, and served
+    again while younger than their end-point's TTL; end-points without a TTL are recorded for
+    replay but always fetched again.
+    In replay mode only recorded responses are served, whatever their age, and nothing is
+    sent to Fusion: calls without a recording fail with status 404 and writes are refused.
+    All other attributes are passed through to the wrapped client.
+    """
+
+    def __init__(self, client: Optional["Client"], path: str, ttls: Optional[Dict[str, float]] = None,
+                 mode: str = 'record'):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode}, expected one of {', '.join(CACHE_MODES)}")
+        self._client = client
+        self.path = path
+        self.mode = mode
+        self.ttls = dict(DEFAULT_CACHE_TTLS)
+        self.ttls.update(ttls or {})
+        self.hits = 0
+        self.misses = 0
+        self._missing: Dict[str, None] = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, endpoint TEXT NOT NULL, "
+                           "recorded_at REAL NOT NULL, body TEXT NOT NULL)")
+        self._conn.commit()
+
+    @property
+    def incomplete_arrays(self) -> List[str]:
+        """
+        Arrays incomplete in the wrapped client, plus arrays with calls missing from a replay.
+        """
+        arrays = list(getattr(self._client, 'incomplete_arrays', []))
+        with self._lock:
+            arrays.extend(array for array in self._missing if array and array not in arrays)
+        return arrays
+
+    def close(self) -> None:
+        logger.info(f"Response cache {self.path}: {self.hits} hits, {self.misses} misses")
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def key(name: str, args: Sequence[Any], kwargs: Dict[str, Any]) -> str:
+        """
+        Cache key of a call: the end-point name and its JSON encoded parameters.
+        """
+        return json.dumps([name, _to_plain(list(args)), _to_plain(kwargs)], sort_keys=True)
+
+    def __getattr__(self, name: str) -> Any:
+        if self.mode == 'replay':
+            if name.startswith(ResilientClient.API_PREFIXES) and not name.startswith('get_'):
+                def refuse(*args: Any, **kwargs: Any) -> Any:
+                    return FailedResponse(503, f"{name} not sent, the response cache is in replay mode")
+                return refuse
+            if name.startswith('get_'):
+                def replay(*args: Any, **kwargs: Any) -> Any:
+                    return self._call(name, None, args, kwargs)
+                return replay
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or not name.startswith('get_'):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args: Any, **kwargs: Any) -> Any:
+            return self._call(name, attribute, args, kwargs)
+
+        return call
+
+    def _lookup(self, key: str, ttl: Optional[float]) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute('SELECT recorded_at, body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None or (ttl is not None and time.time() - row[0] > ttl):
+            return None
+        body = json.loads(row[1])
+        if 'value' in body:
+            return body['value']
+        return CachedResponse(body['status_code'], _from_plain(body['items']),
+                              body.get('continuation_token'), body.get('total_item_count'))
+
+    def _record(self, key: str, name: str, result: Any) -> None:
+        if hasattr(result, 'status_code'):
+            if result.status_code != 200:
+                return
+            body = {'status_code': result.status_code, 'items': _to_plain(list(getattr(result, 'items', []) or [])),
+                    'continuation_token': getattr(result, 'continuation_token', None),
+                    'total_item_count': getattr(result, 'total_item_count', None)}
+        else:
+            body = {'value': _to_plain(result)}
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, endpoint, recorded_at, body) VALUES (?, ?, ?, ?)',
+                               (key, name, time.time(), json.dumps(body)))
+            self._conn.commit()
+
+    def _call(self, name: str, method: Optional[Callable[..., Any]], args: Any, kwargs: Dict[str, Any]) -> Any:
+        ttl = self.ttls.get(name, 0)
+        key = self.key(name, args, kwargs)
+        if self.mode == 'replay':
+            cached = self._lookup(key, None)
+            with self._lock:
+                if cached is None:
+                    self.misses += 1
+                    self._missing[context_name(kwargs)] = None
+                else:
+                    self.hits += 1
+            if cached is None:
+                return FailedResponse(404, f"No recorded response for {name} on {context_name(kwargs) or 'fusion'}")
+            return cached
+
+        # End-points without a TTL are still recorded, so that a replay can serve them
+        if self.mode == 'record' and ttl > 0:
+            cached = self._lookup(key, ttl)
+            if cached is not None:
+                with self._lock:
+                    self.hits += 1
+                return cached
+        with self._lock:
+            self.misses += 1
+        result = method(*args, **kwargs)
+        self._record(key, name, result)
+        return result
+
+
+class Telemetry:
+    """
+    Run metrics: every API call aggregated by end-point, array and status (calls, latency,
+    items, response bytes and retries), and the time spent in each phase of the run per array.
+    Thread-safe; exported as a JSON run summary and as a Prometheus textfile.
+    """
+
+    def __init__(self, script: str = ''):
+        self.script = script
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self._calls: Dict[Tuple[str, str, int], Dict[str, float]] = {}
+        self._phases: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record_call(self, endpoint: str, array: str, status_code: int, seconds: float,
+                    items: int = 0, size: int = 0, retries: int = 0) -> None:
+        """
+        Add one API call to the run metrics.
+        Args:
+            endpoint: API method name, e.g. 'get_volumes'
+            array: Context the call was addressed to ('' for Fusion itself)
+            status_code: Final status code
+            seconds: Latency, including retries
+            items: Number of items returned
+            size: Approximate size of the returned items in bytes
+            retries: Attempts made after the first
+        """
+        with self._lock:
+            stats = self._calls.setdefault((endpoint, array, status_code),
+                                           {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                                            'items': 0, 'bytes': 0, 'retries': 0})
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['items'] += items
+            stats['bytes'] += size
+            stats['retries'] += retries
+
+    def record_phase(self, phase: str, array: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._phases.setdefault((phase, array), {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+    @contextlib.contextmanager
+    def phase(self, phase: str, array: str = '') -> Iterator[None]:
+        """
+        Time a block of work as part of a phase, e.g. with telemetry.phase('space', array).
+        Phases running on several threads at once add up, so they can exceed the run time.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, array, time.monotonic() - start)
+
+    def iterate(self, phase: str, array: str, iterable: Iterable[Any]) -> Iterator[Any]:
+        """
+        Yield from an iterable, timing only the time spent producing each item as the phase.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record_phase(phase, array, time.monotonic() - start)
+                return
+            self.record_phase(phase, array, time.monotonic() - start)
+            yield item
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        The run metrics as a JSON serialisable dict, with calls and phases totalled per array.
+        """
+        with self._lock:
+            calls = [dict(endpoint=endpoint, array=array, status=status, **stats)
+                     for (endpoint, array, status), stats in sorted(self._calls.items())]
+            phases = [dict(phase=phase, array=array, **stats) for (phase, array), stats in sorted(self._phases.items())]
+        arrays: Dict[str, Dict[str, float]] = {}
+        for call in calls:
+            totals = arrays.setdefault(call['array'], {'calls': 0, 'seconds': 0.0, 'errors': 0, 'retries': 0})
+            totals['calls'] += call['calls']
+            totals['seconds'] += call['seconds']
+            totals['retries'] += call['retries']
+            if call['status'] != 200:
+                totals['errors'] += call['calls']
+        return {
+            'script': self.script,
+            'started_at': self.started_at,
+            'duration_seconds': time.monotonic() - self._started,
+            'arrays': arrays,
+            'calls': calls,
+            'phases': phases,
+        }
+
+    def slowest_arrays(self, count: int = 5) -> List[Tuple[str, float]]:
+        """
+        The arrays with the most time spent in API calls, slowest first.
+        """
+        arrays = self.summary()['arrays']
+        ranked = sorted(((array, totals['seconds']) for array, totals in arrays.items() if array),
+                        key=lambda item: item[1], reverse=True)
+        return ranked[:count]
+
+    def write_json(self, path: str) -> None:
+        _write_atomic(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        Write the run metrics in the Prometheus text format, for the node exporter textfile collector.
+        """
+        summary = self.summary()
+        script = _prometheus_label(summary['script'])
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help_text: str, samples: Iterable[Tuple[str, float]]) -> None:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{{script=\"{script}\"{labels}}} {value}")
+
+        def call_labels(call: Dict[str, Any]) -> str:
+            return (f",endpoint=\"{_prometheus_label(call['endpoint'])}\",array=\"{_prometheus_label(call['array'])}\""
+                    f",status=\"{call['status']}\"")
+
+        def phase_labels(phase: Dict[str, Any]) -> str:
+            return f",phase=\"{_prometheus_label(phase['phase'])}\",array=\"{_prometheus_label(phase['array'])}\""
+
+        calls = summary['calls']
+        phases = summary['phases']
+        metric('staas_api_calls_total', 'counter', 'Fusion API calls',
+               [(call_labels(c), c['calls']) for c in calls])
+        metric('staas_api_call_seconds_total', 'counter', 'Time spent in Fusion API calls, including retries',
+               [(call_labels(c), round(c['seconds'], 6)) for c in calls])
+        metric('staas_api_call_seconds_max', 'gauge', 'Slowest Fusion API call',
+               [(call_labels(c), round(c['max_seconds'], 6)) for c in calls])
+        metric('staas_api_items_total', 'counter', 'Items returned by Fusion API calls',
+               [(call_labels(c), c['items']) for c in calls])
+        metric('staas_api_response_bytes_total', 'counter', 'Approximate size of the items returned',
+               [(call_labels(c), c['bytes']) for c in calls])
+        metric('staas_api_retries_total', 'counter', 'Fusion API call attempts after the first',
+               [(call_labels(c), c['retries']) for c in calls])
+        metric('staas_phase_seconds_total', 'counter', 'Time spent in each phase of the run',
+               [(phase_labels(p), round(p['seconds'], 6)) for p in phases])
+        metric('staas_phase_count', 'counter', 'Timed blocks of work in each phase of the run',
+               [(phase_labels(p), p['count']) for p in phases])
+        metric('staas_run_duration_seconds', 'gauge', 'Duration of the run', [('', round(summary['duration_seconds'], 3))])
+        metric('staas_run_started_timestamp_seconds', 'gauge', 'Start of the run', [('', round(summary['started_at'], 3))])
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+
+def _prometheus_label(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path: str, data: str) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _page_items(response: Any) -> Sequence[Any]:
+    """
+    The items of a single response page. The client's item iterator fetches further pages
+    when iterated past the end of its page, so its page is read without iterating it.
+    """
+    items = getattr(response, 'items', None)
+    if isinstance(items, (list, tuple)):
+        return items
+    page = getattr(items, '_items', None)
+    return page if isinstance(page, (list, tuple)) else []
+
+
+class InstrumentedClient:
+    """
+    Wraps a Fusion client so that every API call (get_/put_/patch_/post_/delete_ methods) is
+    recorded in a Telemetry: end-point, array, latency, item count, retries and status, and
+    the response size when measure_size is set. Measuring the size serializes every page once
+    more, so it is off by default. All other attributes are passed through to the wrapped client.
+    """
+
+    def __init__(self, client: Any, telemetry: Telemetry, measure_size: bool = False):
+        self._client = client
+        self.telemetry = telemetry
+        self.measure_size = measure_size
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or not name.startswith(ResilientClient.API_PREFIXES):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args: Any, **kwargs: Any) -> Any:
+            _call_context.retries = 0
+            start = time.monotonic()
+            try:
+                response = attribute(*args, **kwargs)
+            except Exception:
+                self.telemetry.record_call(name, context_name(kwargs), 0, time.monotonic() - start,
+                                           retries=getattr(_call_context, 'retries', 0))
+                raise
+            seconds = time.monotonic() - start
+            items = _page_items(response)
+            size = len(json.dumps(_to_plain(items))) if self.measure_size and items else 0
+            self.telemetry.record_call(name, context_name(kwargs), getattr(response, 'status_code', 200), seconds,
+                                       len(items), size, getattr(_call_context, 'retries', 0))
+            return response
+
+        return call
+
+
+class WorkAbandoned(Exception):
+    """
+    Raised instead of sending an API call for work that has been abandoned.
+    """
+
+
+class CancellableClient:
+    """
+    Wraps a Fusion client for one unit of work that may be abandoned, e.g. a fleet member
+    that timed out. Once `abandoned` is set, every API call raises WorkAbandoned instead of
+    being sent, so the worker stops before its next request rather than finishing the work.
+    All other attributes are passed through to the wrapped client.
+    """
+
+    def __init__(self, client: Any, abandoned: threading.Event):
+        self._client = client
+        self.abandoned = abandoned
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or not name.startswith(ResilientClient.API_PREFIXES):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args: Any, **kwargs: Any) -> Any:
+            if self.abandoned.is_set():
+                raise WorkAbandoned(f"{name} not sent to {context_name(kwargs) or 'fusion'}, the work was abandoned")
+            return attribute(*args, **kwargs)
+
+        return call
+
+
+class SessionClient:
+    """
+    Keeps one authenticated Fusion client for a long-running process. The client is created
+    again by `factory` once its session is older than max_age, and when a call is refused
+    with 401 because the session has expired, in which case the call is repeated once.
+    All other attributes are passed through to the current client.
+    """
+
+    def __init__(self, factory: Callable[[], Optional["Client"]], max_age: float = DEFAULT_SESSION_MAX_AGE):
+        """
+        Args:
+            factory: Creates and authenticates a client, returning None on failure (e.g. initialise_client)
+            max_age: Seconds a session is used before it is authenticated again
+        Raises:
+            ConnectionError: if the first client cannot be created
+        """
+        self._factory = factory
+        self.max_age = max_age
+        self.renewals = 0
+        self._lock = threading.Lock()
+        self._client = factory()
+        if self._client is None:
+            raise ConnectionError("Failed to initialise the Fusion client")
+        self._created_at = time.monotonic()
+
+    def renew(self, stale: Any = None) -> Any:
+        """
+        Authenticate a new client, unless another thread already replaced `stale`. A failed
+        renewal keeps the current client, so its calls report their own errors.
+        """
+        with self._lock:
+            if stale is None or self._client is stale:
+                client = self._factory()
+                if client is None:
+                    logger.error("Failed to renew the Fusion session, keeping the current one")
+                    self._created_at = time.monotonic()
+                else:
+                    self._client = client
+                    self._created_at = time.monotonic()
+                    self.renewals += 1
+                    logger.info("Renewed the Fusion session")
+            return self._client
+
+    def _current(self) -> Any:
+        client = self._client
+        if self.max_age and time.monotonic() - self._created_at > self.max_age:
+            client = self.renew(client)
+        return client
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self._current(), name)
+        if not callable(attribute) or not name.startswith(ResilientClient.API_PREFIXES):
+            return attribute
+
+        @functools.wraps(attribute)
+        def call(*args: Any, **kwargs: Any) -> Any:
+            client = self._current()
+            response = getattr(client, name)(*args, **kwargs)
+            if getattr(response, 'status_code', 200) == 401:
+                response = getattr(self.renew(client), name)(*args, **kwargs)
+            return response
+
+        return call
+
+
+class JobSchedule:
+    """
+    When a job of a long-running service is due: every `interval` seconds, starting at once,
+    or daily at a local time of day.
+    """
+
+    def __init__(self, interval: Optional[float] = None, at: Optional[str] = None):
+        """
+        Args:
+            interval: Seconds between runs (None or 0 for no interval)
+            at: Daily run time as HH:MM (None or '' for no daily run)
+        """
+        self.interval = interval or None
+        self.at = datetime.strptime(at, '%H:%M').time() if at else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval is not None or self.at is not None
+
+    def first_run(self, now: float) -> Optional[float]:
+        """
+        Epoch time of the first run of a service started at `now` (None if never scheduled).
+        """
+        return now if self.interval is not None else self.next_run(now)
+
+    def next_run(self, after: float) -> Optional[float]:
+        """
+        Epoch time of the next run after `after` (None if never scheduled).
+        """
+        if self.interval is not None:
+            return after + self.interval
+        if self.at is None:
+            return None
+        after_time = datetime.fromtimestamp(after)
+        run = datetime.combine(after_time.date(), self.at)
+        if run <= after_time:
+            run = datetime.combine(after_time.date() + timedelta(days=1), self.at)
+        return run.timestamp()
+
@@ -0,0 +1,278 @@
+"""
+fake_fusion.py
+--------------
+In-process stand-in for flasharray.Client that serves a synthetic Fusion fleet, for tests
+and benchmarks. Volumes, directories, hosts, connections and tags are generated from
+their index on demand, so a fleet of millions of volumes costs no memory until it is listed.
+Latency and errors can be injected, and every request is counted per end-point.
+
+Usage:
+    client = FakeFusionClient(arrays=4, volumes_per_array=250000, latency=0.002)
+"""
+
+import random
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+
+DEFAULT_LIMIT = 1000
+SPACE_METRICS = ('data_reduction', 'shared', 'snapshots', 'thin_provisioning', 'total_physical',
+                 'total_provisioned', 'total_reduction', 'unique', 'virtual', 'used_provisioned')
+
+
+class FakeResponse:
+    """
+    A list response with the attributes the API helpers use.
+    """
+
+    def __init__(self, status_code, items=(), continuation_token=None, total_item_count=None, errors=()):
+        self.status_code = status_code
+        self.items = list(items)
+        self.continuation_token = continuation_token
+        self.total_item_count = total_item_count
+        self.errors = list(errors)
+
+
+def _space(seed):
+    # Plain attributes, so that space.__dict__ gives the metrics as it does for the real models
+    return SimpleNamespace(**{metric: (seed * 7919 + i * 104729) % 1_000_000_007
+                              for i, metric in enumerate(SPACE_METRICS)})
+
+
+class FakeFusionClient:
+    """
+    Synthetic fleet of `arrays` arrays named array0..arrayN-1. Volume i on an array is named
+    realm::pod::vol, pod::vol or vol, with every 100th volume a protocol endpoint; it is
+    connected to host (i % hosts) in host group (host % host_groups), and a `tagged_fraction`
+    of the volumes carry a chargeback tag in `namespace`.
+    Args:
+        arrays: Number of fleet members
+        volumes_per_array: Volumes on each array
+        directories_per_array: Directories on each array
+        hosts_per_array: Hosts on each array
+        host_groups_per_array: Host groups on each array
+        realms: Number of realms volumes are spread over
+        pods: Number of pods volumes are spread over
+        tagged_fraction: Fraction of volumes with an existing chargeback tag
+        latency: Seconds each request takes
+        array_latency: dict of array name to seconds added to each request on that array
+        error_rate: Fraction of requests that fail with error_status
+        error_status: Status code of injected failures
+        fail_endpoints: End-points that always fail with error_status
+        max_names: Largest names/resource_names list accepted before 414 (None for no limit)
+        namespace: Tag namespace
+        tag_key: Tag key
+        seed: Seed for the injected errors
+    """
+
+    def __init__(self, arrays=2, volumes_per_array=1000, directories_per_array=100, hosts_per_array=20,
+                 host_groups_per_array=5, realms=4, pods=20, tagged_fraction=0.5, latency=0.0, array_latency=None,
+                 error_rate=0.0, error_status=503, fail_endpoints=(), max_names=None, fleet='fleet1', namespace='default',
+                 tag_key='chargeback', seed=1):
+        self.fleet = fleet
+        self.array_names = [f"array{n}" for n in range(arrays)]
+        self.volumes_per_array = volumes_per_array
+        self.directories_per_array = directories_per_array
+        self.realms = [f"realm{n}" for n in range(realms)]
+        self.pods = [f"pod{n}" for n in range(pods)]
+        self.hosts = [f"host{n}" for n in range(hosts_per_array)]
+        self.host_groups = [f"hg{n}" for n in range(host_groups_per_array)]
+        self.tagged_fraction = tagged_fraction
+        self.latency = latency
+        self.array_latency = dict(array_latency or {})
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_endpoints = set(fail_endpoints)
+        self.max_names = max_names
+        self.namespace = namespace
+        self.tag_key = tag_key
+        self.requests = Counter()
+        self.written_tags = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    # Synthetic inventory
+
+    def volume_name(self, i):
+        pod = self.pods[i % len(self.pods)]
+        if i % 3 == 0:
+            return f"{self.realms[i % len(self.realms)]}::{pod}::vol{i}"
+        if i % 3 == 1:
+            return f"{pod}::vol{i}"
+        return f"vol{i}"
+
+    def volume_subtype(self, i):
+        return 'protocol_endpoint' if i % 100 == 99 else 'regular'
+
+    def volume_host(self, i):
+        return self.hosts[i % len(self.hosts)] if self.hosts else None
+
+    def volume_host_group(self, i):
+        if not self.hosts or not self.host_groups:
+            return None
+        return self.host_groups[(i % len(self.hosts)) % len(self.host_groups)]
+
+    def volume_tag(self, array, i):
+        written = self.written_tags.get(array, {}).get(self.volume_name(i))
+        if written is not None:
+            return written
+        if (i * 2654435761) % 1000 < self.tagged_fraction * 1000:
+            return f"TAG{i % 7}"
+        return None
+
+    @staticmethod
+    def _index_of(name):
+        # Names are generated from the index, so the index can be read back from the name
+        digits = name.rsplit('vol', 1)[-1]
+        return int(digits) if digits.isdigit() else -1
+
+    # Request plumbing
+
+    def _request(self, endpoint, kwargs, names=None):
+        with self._lock:
+            self.requests[endpoint] += 1
+            failed = endpoint in self.fail_endpoints or (self.error_rate and self._rng.random() < self.error_rate)
+        context = self._array(kwargs)
+        latency = self.latency + self.array_latency.get(context, 0.0)
+        if latency:
+            time.sleep(latency)
+        if failed:
+            return FakeResponse(self.error_status, errors=[f"Injected {self.error_status} on {endpoint}"])
+        if context is not None and context not in self.array_names:
+            return FakeResponse(400, errors=[f"Unknown context {context}"])
+        if self.max_names is not None and names is not None and len(names) > self.max_names:
+            return FakeResponse(414, errors=['Request-URI Too Long'])
+        return None
+
+    @staticmethod
+    def _page(count, make_item, limit=None, continuation_token=None):
+        offset = int(continuation_token) if continuation_token else 0
+        end = min(count, offset + (limit or DEFAULT_LIMIT))
+        items = [make_item(i) for i in range(offset, end)]
+        return FakeResponse(200, items, str(end) if end < count else None, count)
+
+    @staticmethod
+    def _array(kwargs):
+        context = kwargs.get('context_names')
+        if isinstance(context, (list, tuple)):
+            return context[0] if context else None
+        return context
+
+    # Fleet end-points
+
+    def get_rest_version(self):
+        with self._lock:
+            self.requests['get_rest_version'] += 1
+        return '2.45'
+
+    def get_fleets(self, **kwargs):
+        return self._request('get_fleets', kwargs) or FakeResponse(200, [SimpleNamespace(name=self.fleet)])
+
+    def get_fleets_members(self, **kwargs):
+        error = self._request('get_fleets_members', kwargs)
+        if error:
+            return error
+        return FakeResponse(200, [SimpleNamespace(member=SimpleNamespace(name=name, is_local=n == 0),
+                                                  fleet=SimpleNamespace(name=self.fleet))
+                                  for n, name in enumerate(self.array_names)])
+
+    def get_hosts(self, limit=None, continuation_token=None, **kwargs):
+        return self._request('get_hosts', kwargs) or self._page(
+            len(self.hosts), lambda i: SimpleNamespace(name=self.hosts[i]), limit, continuation_token)
+
+    def get_host_groups(self, limit=None, continuation_token=None, **kwargs):
+        return self._request('get_host_groups', kwargs) or self._page(
+            len(self.host_groups), lambda i: SimpleNamespace(name=self.host_groups[i]), limit, continuation_token)
+
+    def get_connections(self, limit=None, continuation_token=None, **kwargs):
+        def connection(i):
+            host_group = self.volume_host_group(i)
+            return SimpleNamespace(volume=SimpleNamespace(name=self.volume_name(i)),
+                                   host=SimpleNamespace(name=self.volume_host(i)),
+                                   host_group=SimpleNamespace(name=host_group) if host_group else None)
+        count = self.volumes_per_array if self.hosts else 0
+        return self._request('get_connections', kwargs) or self._page(count, connection, limit, continuation_token)
+
+    # Volume end-points
+
+    def get_volumes(self, limit=None, continuation_token=None, filter=None, **kwargs):
+        def volume(i):
+            return SimpleNamespace(name=self.volume_name(i), subtype=self.volume_subtype(i))
+        error = self._request('get_volumes', kwargs)
+        if error:
+            return error
+        page = self._page(self.volumes_per_array, volume, limit, continuation_token)
+        # Only the subtype filter the scripts send is understood; like the tag listing, a
+        # filtered page may hold fewer volumes than the limit
+        if filter == "subtype='regular'":
+            page.items = [item for item in page.items if item.subtype == 'regular']
+        elif filter is not None:
+            raise ValueError(f"Unsupported filter: {filter}")
+        return page
+
+    def get_volumes_space(self, names=None, limit=None, continuation_token=None, **kwargs):
+        error = self._request('get_volumes_space', kwargs, names)
+        if error:
+            return error
+        if names is None:
+            return self._page(self.volumes_per_array,
+                              lambda i: SimpleNamespace(name=self.volume_name(i), space=_space(i)),
+                              limit, continuation_token)
+        return FakeResponse(200, [SimpleNamespace(name=name, space=_space(self._index_of(name))) for name in names])
+
+    def get_volumes_tags(self, resource_names=None, namespaces=None, limit=None, continuation_token=None, filter=None,
+                         **kwargs):
+        error = self._request('get_volumes_tags', kwargs, resource_names)
+        if error:
+            return error
+        array = self._array(kwargs)
+
+        def tag(name, value):
+            return SimpleNamespace(namespace=self.namespace, key=self.tag_key, value=value,
+                                   resource=SimpleNamespace(name=name), context=SimpleNamespace(name=array))
+
+        if resource_names is not None:
+            items = []
+            for name in resource_names:
+                value = self.volume_tag(array, self._index_of(name))
+                if value is not None:
+                    items.append(tag(name, value))
+            return FakeResponse(200, items)
+        # Listing all tags pages over the volumes, so a page may hold fewer tags than the limit
+        page = self._page(self.volumes_per_array, lambda i: (self.volume_name(i), self.volume_tag(array, i)),
+                          limit, continuation_token)
+        page.items = [tag(name, value) for name, value in page.items if value is not None]
+        return page
+
+    def put_volumes_tags_batch(self, resource_names=None, tag=None, **kwargs):
+        error = self._request('put_volumes_tags_batch', kwargs, resource_names)
+        if error:
+            return error
+        array = self._array(kwargs)
+        value = tag[0]['value'] if tag else None
+        with self._lock:
+            written = self.written_tags.setdefault(array, {})
+            for name in resource_names or ():
+                written[name] = value
+        return FakeResponse(200)
+
+    # Space end-points
+
+    def get_arrays_space(self, **kwargs):
+        error = self._request('get_arrays_space', kwargs)
+        if error:
+            return error
+        array = self._array(kwargs)
+        return FakeResponse(200, [SimpleNamespace(name=array, space=_space(self.array_names.index(array)))])
+
+    def get_realms_space(self, **kwargs):
+        return self._request('get_realms_space', kwargs) or FakeResponse(
+            200, [SimpleNamespace(name=realm, space=_space(n)) for n, realm in enumerate(self.realms)])
+
+    def get_directories(self, limit=None, continuation_token=None, **kwargs):
+        def directory(i):
+            return SimpleNamespace(name=f"fs{i // 10}:dir{i}", space=_space(i))
+        return self._request('get_directories', kwargs) or self._page(
+            self.directories_per_array, directory, limit, continuation_token)
@@ -0,0 +1,95 @@
+import importlib.util
+import os
+import threading
+import time
+import pytest
+from tests.fake_fusion import FakeFusionClient
+from staas_common import AsyncFusionClient, ColumnarRows, ResilientClient
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@pytest.fixture
+def reporting():
+    # A fresh copy of the script per test, so that its module globals start clean
+    spec = importlib.util.spec_from_file_location('staas_reporting', os.path.join(ROOT, 'staas-reporting.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.NAMESPACE = 'default'
+    module.TAG_KEY = 'chargeback'
+    module.NOW = '2026-10-01 00:00'
+    return module
+
+def report_rows(report):
+    return {group: list(report.iter_rows(group)) for group in report.groups()}
+
+def test_collect_fleet_merge_does_not_depend_on_completion_order(reporting):
+    # array0 is the slowest, so the other members finish first when collected concurrently
+    client = ResilientClient(FakeFusionClient(arrays=3, volumes_per_array=300, directories_per_array=20,
+                                              array_latency={'array0': 0.01, 'array1': 0.002}))
+    volumes, directories, incomplete = reporting.collect_fleet(client, ['array0', 'array1', 'array2'], workers=1,
+                                                               page_size=100)
+    parallel = reporting.collect_fleet(client, ['array0', 'array1', 'array2'], workers=3, page_size=100)
+    assert incomplete == [] and parallel[2] == []
+    assert report_rows(parallel[0]) == report_rows(volumes)
+    assert report_rows(parallel[1]) == report_rows(directories)
+    assert directories.groups() == ['array0', 'array1', 'array2']
+
+def test_collect_fleet_abandons_members_that_time_out(reporting):
+    fake = FakeFusionClient(arrays=3, volumes_per_array=2000, directories_per_array=20, array_latency={'array1': 0.05})
+    client = ResilientClient(fake)
+    volumes, directories, incomplete = reporting.collect_fleet(client, ['array0', 'array1', 'array2'], workers=3,
+                                                               array_timeout=0.3, page_size=100)
+    assert incomplete == ['array1']
+    assert directories.groups() == ['array0', 'array2']
+    # The abandoned worker stops before its next API call, and is a daemon that does not block exit
+    time.sleep(0.2)
+    requests = sum(fake.requests.values())
+    time.sleep(0.3)
+    assert sum(fake.requests.values()) == requests
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith('staas-collect') and not thread.daemon]
+
+def test_overlapped_tag_and_space_fetches_match_the_sequential_path(reporting):
+    client = FakeFusionClient(arrays=1, volumes_per_array=1000, latency=0.001)
+    expected = ColumnarRows('Volume')
+    for volume_set, _ in reporting.iter_volume_pages(client, 'array0', page_size=100):
+        tags = reporting.read_volume_tags(client, 'array0', volume_set)
+        space = reporting.get_volume_space(client, 'array0', volume_set)
+        expected.extend(reporting.group_volume_rows('array0', volume_set, tags, space))
+    overlapped = reporting.report_volumes(client, 'array0', 'default', 'chargeback', page_size=100, fetch_concurrency=4)
+    assert len(overlapped) == 990
+    assert overlapped.headers == expected.headers
+    assert report_rows(overlapped) == report_rows(expected)
+    assert list(overlapped.iter_rows()) == list(expected.iter_rows())
+
+def test_async_fetch_matches_the_thread_pool_path(reporting):
+    client = FakeFusionClient(arrays=2, volumes_per_array=1000, directories_per_array=20, latency=0.001)
+    reporting.VOLUME_DETAIL_BATCH_SIZE = 30
+    expected, _ = reporting.merge_fleet_pages(reporting.iter_fleet_pages(client, client.array_names, [], workers=2,
+                                                                        page_size=100))
+    requests = client.requests['get_volumes_tags']
+    async_client = AsyncFusionClient(client, max_concurrency=8, per_array_concurrency=4)
+    try:
+        volumes, _ = reporting.merge_fleet_pages(reporting.iter_fleet_pages(client, client.array_names, [], workers=2,
+                                                                           page_size=100, async_client=async_client))
+    finally:
+        async_client.close()
+    assert len(volumes) == 1980
+    assert list(volumes.iter_rows()) == list(expected.iter_rows())
+    assert client.requests['get_volumes_tags'] > requests
+
+def test_failed_workbook_save_keeps_the_previous_file_and_no_temp_copy(reporting, tmp_path, monkeypatch):
+    path = str(tmp_path / 'report.xlsx')
+    headers = ['Date/Time', 'Array', 'Volume']
+    reporting.save_report_to_excel({'tagA': [{'Date/Time': 'd1', 'Array': 'a1', 'Volume': 'v1'}]}, headers, path, 'Tag')
+    previous = open(path, 'rb').read()
+
+    def fail(report_data, group, data):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(reporting, 'group_frame', fail)
+    with pytest.raises(OSError):
+        reporting.save_report_to_excel({'tagB': [{'Date/Time': 'd2', 'Array': 'a1', 'Volume': 'v2'}]}, headers, path,
+                                       'Tag')
+    assert open(path, 'rb').read() == previous
+    assert sorted(os.listdir(tmp_path)) == ['report.xlsx']
@@ -1,6 +1,44 @@
+import json
+import logging
 import pytest
 from unittest.mock import MagicMock
-from staas_common import list_fleets, list_members
+from tests.fake_fusion import FakeFusionClient
+from staas_common import (
+    parse_arguments,
+    list_fleets,
+    list_members,
+    FleetTopology,
+    paginate,
+    check_api_version,
+    checkpoint_path,
+    filter_expression,
+    list_query,
+    prefetch,
+    AdaptiveBatcher,
+    BatchSizeStore,
+    CheckpointJournal,
+    ReportHistory,
+    ColumnarRows,
+    StreamingExcelWriter,
+    TaggingRuleEngine,
+    load_config,
+    ConfigError,
+    parse_volume_names,
+    AsyncFusionClient,
+    TokenBucket,
+    WriteRateLimiter,
+    ResilientClient,
+    RetryPolicy,
+    CircuitBreaker,
+    CachingClient,
+    InstrumentedClient,
+    SessionClient,
+    JobSchedule,
+    Telemetry,
+    TraceSampler,
+    JsonFormatter,
+    TRACE,
+)
 
 class DummyClient:
     def get_fleets(self):
@@ -25,3 +63,531 @@ def test_list_members():
     client = DummyClient()
     members = list_members(client, ['fleet1'])
     assert members == ['array1']
+
+class FleetClient:
+    def __init__(self):
+        self.member_calls = 0
+    def get_fleets(self):
+        class Response:
+            status_code = 200
+            items = [type('Fleet', (), {'name': 'fleet1'})(), type('Fleet', (), {'name': 'fleet2'})()]
+        return Response()
+    def get_fleets_members(self):
+        self.member_calls += 1
+        def member(fleet, name, is_local):
+            return type('FleetMember', (), {
+                'fleet': type('Ref', (), {'name': fleet})(),
+                'member': type('Ref', (), {'name': name, 'is_local': is_local})(),
+            })()
+        class Response:
+            status_code = 200
+            items = [member('fleet1', 'array1', True), member('fleet1', 'array2', False), member('fleet2', 'array3', False)]
+        return Response()
+
+def test_list_members_filters_by_fleet():
+    client = FleetClient()
+    assert list_members(client, ['fleet2']) == ['array3']
+    assert list_members(client, ['fleet1', 'fleet2']) == ['array1', 'array2', 'array3']
+
+def test_fleet_topology_indexes():
+    client = FleetClient()
+    topology = FleetTopology.fetch(client)
+    assert topology.fleets == ['fleet1', 'fleet2']
+    assert topology.members_of('fleet1') == ['array1', 'array2']
+    assert topology.is_local('array1') is True
+    assert topology.member('array3').fleet == 'fleet2'
+    assert topology.member('missing') is None
+    assert client.member_calls == 1
+
+def test_fleet_topology_disk_cache(tmp_path):
+    client = FleetClient()
+    cache_path = str(tmp_path / 'topology.json')
+    FleetTopology.load(client, cache_path=cache_path, ttl=60)
+    cached = FleetTopology.load(client, cache_path=cache_path, ttl=60)
+    assert client.member_calls == 1
+    assert cached.members_of('fleet1') == ['array1', 'array2']
+    FleetTopology.load(client, cache_path=cache_path, ttl=-1)
+    assert client.member_calls == 2
+
+def test_paginate_follows_continuation_tokens():
+    pages = {None: (['a', 'b'], 'token1'), 'token1': (['c'], None)}
+    calls = []
+    def get_volumes(limit=None, continuation_token=None, context_names=None):
+        calls.append((limit, continuation_token, context_names))
+        items, token = pages[continuation_token]
+        return type('Response', (), {'status_code': 200, 'items': items, 'continuation_token': token})()
+    responses = list(paginate(get_volumes, limit=2, context_names=['array1']))
+    assert [r.items for r in responses] == [['a', 'b'], ['c']]
+    assert calls == [(2, None, ['array1']), (2, 'token1', ['array1'])]
+
+def test_paginate_stops_on_error():
+    def get_volumes(limit=None, continuation_token=None):
+        return type('Response', (), {'status_code': 500, 'items': [], 'continuation_token': 'more', 'errors': ['boom']})()
+    responses = list(paginate(get_volumes))
+    assert len(responses) == 1
+    assert responses[0].status_code == 500
+
+def make_response(status_code, items=()):
+    return type('Response', (), {'status_code': status_code, 'items': list(items), 'errors': [], 'continuation_token': None})()
+
+def test_prefetch_reads_ahead_and_reraises_errors():
+    fetched = []
+    def pages():
+        for n in range(3):
+            fetched.append(n)
+            yield n
+        raise RuntimeError('listing failed')
+    items = prefetch(pages(), depth=1)
+    assert [next(items), next(items), next(items)] == [0, 1, 2]
+    with pytest.raises(RuntimeError):
+        next(items)
+    assert fetched == [0, 1, 2]
+
+def test_adaptive_batcher_shrinks_on_uri_too_long():
+    batcher = AdaptiveBatcher(8, minimum=2)
+    sizes = []
+    def request(batch):
+        sizes.append(len(batch))
+        return make_response(414 if len(batch) > 2 else 200, batch)
+    batches = list(batcher.batches(list(range(6)), request))
+    assert [list(batch) for batch, _ in batches] == [[0, 1], [2, 3], [4, 5]]
+    assert sizes[:3] == [6, 4, 2]
+    assert all(response.status_code == 200 for _, response in batches)
+
+def test_adaptive_batcher_grows_on_flat_latency():
+    batcher = AdaptiveBatcher(10, maximum=20)
+    batcher.record_success(0.1, 10)
+    batcher.record_success(0.1, 15)
+    assert batcher.size == 20
+
+def test_batch_size_store_remembers_sizes(tmp_path):
+    path = str(tmp_path / 'batches.json')
+    store = BatchSizeStore(path)
+    batcher = store.batcher('array1', 'get_volumes_space', 100)
+    assert store.batcher('array1', 'get_volumes_space', 100) is batcher
+    batcher.record_failure()
+    store.save()
+    assert BatchSizeStore(path).batcher('array1', 'get_volumes_space', 100).size == 50
+
+def test_checkpoint_journal_resumes_and_ignores_torn_line(tmp_path):
+    path = str(tmp_path / 'run.journal')
+    journal = CheckpointJournal(path)
+    journal.record({'type': 'page', 'array': 'array1', 'token': 't1'})
+    journal.record({'type': 'array_done', 'array': 'array1'})
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"type": "pa')
+    resumed = CheckpointJournal(path, resume=True)
+    assert [entry['type'] for entry in resumed.records] == ['page', 'array_done']
+    assert resumed.of_type('page')[0]['token'] == 't1'
+    resumed.record({'type': 'array_done', 'array': 'array2'})
+    resumed.close()
+    assert len(CheckpointJournal(path, resume=True).records) == 3
+    resumed.remove()
+    assert CheckpointJournal(path).records == []
+
+def test_report_history_append_and_query(tmp_path):
+    history = ReportHistory(str(tmp_path / 'history.db'))
+    rows = {
+        'tagA': [{'Date/Time': '2026-01-05 10:00', 'Array': 'array1', 'Volume': 'vol1', 'total_physical': 10}],
+        'tagB': [{'Date/Time': '2026-01-05 10:00', 'Array': 'array1', 'Volume': 'vol2', 'total_physical': 20, 'snapshots': 1}],
+    }
+    assert history.append('volumes', rows, 'Volume') == 2
+    history.append('volumes', {'tagA': [{'Date/Time': '2026-02-01 10:00', 'Array': 'array2', 'Volume': 'vol3'}]}, 'Volume')
+    assert history.headers('volumes', 'Volume') == ['Date/Time', 'Array', 'Volume', 'total_physical', 'snapshots']
+    assert history.groups('volumes', '2026-01') == ['tagA', 'tagB']
+    assert list(history.iter_rows('volumes', '2026-01', 'tagA')) == [('2026-01-05 10:00', 'array1', 'vol1', 10, None)]
+    assert list(history.iter_rows('volumes', '2026-02', 'tagA')) == [('2026-02-01 10:00', 'array2', 'vol3', None, None)]
+    history.close()
+
+def test_streaming_excel_writer_sets_aside_truncated_workbook(tmp_path):
+    from openpyxl import load_workbook
+    path = str(tmp_path / 'report.xlsx')
+    headers = ['Date/Time', 'Array', 'Volume', 'used']
+    with StreamingExcelWriter(path, 'Tag', headers) as writer:
+        writer.write_rows('tagA', [['d1', 'a1', 'v1', 1]])
+    data = open(path, 'rb').read()
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    with StreamingExcelWriter(path, 'Tag', headers) as writer:
+        writer.write_rows('tagA', [['d2', 'a1', 'v1', 2]])
+    book = load_workbook(path, read_only=True)
+    assert [list(r) for r in book['Tag tagA'].iter_rows(values_only=True)] == [headers, ['d2', 'a1', 'v1', 2]]
+    book.close()
+    assert open(path + '.corrupt', 'rb').read() == data[:len(data) // 2]
+
+def test_streaming_excel_writer_sets_aside_zip_that_is_not_a_workbook(tmp_path):
+    import zipfile
+    from openpyxl import load_workbook
+    path = str(tmp_path / 'report.xlsx')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('notes.txt', 'not a workbook')
+    with StreamingExcelWriter(path, 'Tag', ['Date/Time', 'Array', 'Volume', 'used']) as writer:
+        writer.write_rows('tagA', [['d1', 'a1', 'v1', 1]])
+    book = load_workbook(path, read_only=True)
+    assert book.sheetnames == ['Tag tagA']
+    book.close()
+    with zipfile.ZipFile(path + '.corrupt') as archive:
+        assert archive.namelist() == ['notes.txt']
+
+def test_columnar_rows_group_index_follows_appends():
+    rows = ColumnarRows('Volume', ['used'])
+    for i in range(6):
+        rows.append(f'TAG{i % 3}', 'd1', 'array1', f'vol{i}', [i])
+    assert [row[2] for row in rows.iter_rows('TAG1')] == ['vol1', 'vol4']
+    rows.append('TAG1', 'd1', 'array1', 'vol6', [6])
+    rows.append('TAG3', 'd1', 'array1', 'vol7', [7])
+    assert [row[2] for row in rows.iter_rows('TAG1')] == ['vol1', 'vol4', 'vol6']
+    assert list(rows.to_dataframe('TAG3')['used']) == [7.0]
+    assert rows.groups() == ['TAG0', 'TAG1', 'TAG2', 'TAG3']
+    assert list(rows.iter_rows('missing')) == []
+
+def test_columnar_rows_to_arrow_encodes_columns():
+    pa = pytest.importorskip('pyarrow')
+    rows = ColumnarRows('Volume', ['used'])
+    for i in range(4):
+        rows.append(f'TAG{i % 2}', 'd1', f'array{i % 2}', f'vol{i}', [i])
+    table = rows.to_arrow()
+    assert table.column_names == ['Date/Time', 'Array', 'Group', 'Volume', 'used']
+    assert pa.types.is_dictionary(table.schema.field('Array').type)
+    assert table.column('Group').to_pylist() == ['TAG0', 'TAG1', 'TAG0', 'TAG1']
+    assert table.column('used').to_pylist() == [0.0, 1.0, 2.0, 3.0]
+
+def test_report_history_imports_existing_workbook(tmp_path):
+    path = str(tmp_path / 'Space-Report-Volumes-2026-01.xlsx')
+    headers = ['Date/Time', 'Array', 'Volume', 'total_physical']
+    with StreamingExcelWriter(path, 'Tag', headers) as writer:
+        writer.write_rows('tagA', [['2026-01-05 10:00', 'array1', 'vol1', 10], ['2026-01-06 10:00', 'array1', 'vol1', 11]])
+        writer.write_rows('tagB', [['2026-01-05 10:00', 'array2', 'vol2', 20]])
+    history = ReportHistory(str(tmp_path / 'history.db'))
+    assert history.count('volumes', '2026-01') == 0
+    assert history.import_workbook('volumes', path, 'Volume', 'Tag') == 3
+    assert history.count('volumes', '2026-01') == 3
+    assert history.groups('volumes', '2026-01') == ['tagA', 'tagB']
+    assert list(history.iter_rows('volumes', '2026-01', 'tagB')) == [('2026-01-05 10:00', 'array2', 'vol2', 20)]
+    history.close()
+
+def test_columnar_rows_group_merge_and_round_trip():
+    rows = ColumnarRows('Volume', ['used', 'data_reduction'])
+    rows.append('TAG1', '2026-10-01 00:00', 'array1', 'vol1', [10, 2.5])
+    rows.append('TAG2', '2026-10-01 00:00', 'array1', 'vol2', [None])
+    other = ColumnarRows('Volume', ['used', 'snapshots'])
+    other.append('TAG1', '2026-10-01 00:00', 'array2', 'vol3', [30, 4])
+    rows.extend(other)
+    assert len(rows) == 3
+    assert rows.headers == ['Date/Time', 'Array', 'Volume', 'used', 'data_reduction', 'snapshots']
+    groups = dict(rows.items())
+    assert [len(groups['TAG1']), len(groups['TAG2'])] == [2, 1]
+    assert [row['Volume'] for row in groups['TAG1']] == ['vol1', 'vol3']
+    assert next(iter(groups['TAG2']))['used'] is None
+    restored = ColumnarRows.from_dict(json.loads(json.dumps(rows.to_dict())))
+    assert list(restored.iter_rows()) == list(rows.iter_rows())
+    frame = rows.to_dataframe('TAG1')
+    assert list(frame['Array']) == ['array1', 'array2']
+    assert list(frame['snapshots'])[1] == 4
+
+def test_streaming_excel_writer_appends_to_existing(tmp_path):
+    from openpyxl import load_workbook
+    path = str(tmp_path / 'report.xlsx')
+    headers = ['Date/Time', 'Array', 'Volume', 'total_physical']
+    with StreamingExcelWriter(path, 'Tag', headers) as writer:
+        writer.write_pages([{'tagA': [{'Date/Time': 'd1', 'Array': 'a1', 'Volume': 'v1', 'total_physical': 1}]}])
+    with StreamingExcelWriter(path, 'Tag', headers) as writer:
+        writer.write_rows('tagA', [{'Date/Time': 'd2', 'Array': 'a1', 'Volume': 'v1', 'total_physical': 2}])
+        writer.write_rows('tagB', [('d2', 'a2', 'v2', 3)])
+    book = load_workbook(path, read_only=True)
+    assert book.sheetnames == ['Tag tagA', 'Tag tagB']
+    assert [list(r) for r in book['Tag tagA'].iter_rows(values_only=True)] == [
+        headers, ['d1', 'a1', 'v1', 1], ['d2', 'a1', 'v1', 2]]
+    assert [list(r) for r in book['Tag tagB'].iter_rows(values_only=True)] == [headers, ['d2', 'a2', 'v2', 3]]
+    book.close()
+
+def test_tagging_rule_engine_precedence():
+    rules = {"realm": {"r1": "R"}, "pod": {"p1": "P"}, "workload": {}, "host_group": {"hg1": "HG"},
+             "host": {"h1": "H", "h2": ""}, "default": {"default": "D"}}
+    engine = TaggingRuleEngine(rules)
+    assert engine.resolve_batch([
+        ("r1", "p1", "hg1", "h1"),
+        (None, "p1", "hg1", "h1"),
+        (None, "p2", "hg1", "h1"),
+        (None, None, "hg2", "h1"),
+        (None, None, None, "h2"),
+        (None, None, None, None),
+    ]) == [("R", "realm"), ("P", "pod"), ("HG", "host_group"), ("H", "host"), ("D", "default"), ("D", "default")]
+    assert engine.resolve(None, "p1", None, None) == ("P", "pod")
+    assert TaggingRuleEngine({}).resolve(None, None, None, "h1") == (None, None)
+
+def test_load_config_compiles_and_validates(tmp_path):
+    from openpyxl import Workbook
+    path = str(tmp_path / 'config.xlsx')
+    workbook = Workbook()
+    workbook.active.title = 'Fleet'
+    workbook.active.append(['FUSION_SERVER', 'NAMESPACE'])
+    workbook.active.append(['fusion.example.com', 'staas'])
+    rules = workbook.create_sheet('Tagging_map')
+    for row in (['Tag_By', 'Container_Name', 'Tag_Value'], ['default', 'default', 100000.0],
+                ['Realm', 'realm1', 'R1'], ['cluster', 'c1', 'X']):
+        rules.append(row)
+    workbook.save(path)
+    config = load_config(path)
+    assert config.settings == {'FUSION_SERVER': 'fusion.example.com', 'NAMESPACE': 'staas'}
+    assert config.tagging_rules['default'] == {'default': '100000'}
+    assert config.tagging_rules['realm'] == {'realm1': 'R1'}
+    assert len(config.warnings) == 1
+    cache = tmp_path / '.config.xlsx.compiled.json'
+    assert json.loads(cache.read_text())['config'] == {'settings': config.settings,
+                                                       'tagging_rules': config.tagging_rules,
+                                                       'warnings': config.warnings}
+    assert load_config(path) == config
+    document = tmp_path / 'config.json'
+    document.write_text(json.dumps({'fleet': {'FUSION_SERVER': 'fusion.example.com'},
+                                    'tagging_rules': {'host': {'host1': None}}}))
+    with pytest.raises(ConfigError, match='NAMESPACE'):
+        load_config(str(document), '')
+
+def test_parse_volume_names():
+    parsed = parse_volume_names(['realm1::pod1::vol1', 'pod1::vol.2', 'vol3', 'dir/vol4', 'bad name'])
+    assert parsed.realms == ['realm1', None, None, None, None]
+    assert parsed.pods == ['pod1', 'pod1', None, None, None]
+    assert parsed.volumes == ['vol1', 'vol.2', 'vol3', 'dir/vol4', 'bad name']
+    assert parsed.unparsed == ['bad name']
+
+def test_async_fusion_client_limits_per_array_concurrency():
+    import asyncio
+    import threading
+    import time
+
+    class SlowClient:
+        def __init__(self):
+            self.active = {}
+            self.peak = {}
+            self.lock = threading.Lock()
+        def get_volumes_space(self, context_names=None, names=None):
+            array = context_names[0]
+            with self.lock:
+                self.active[array] = self.active.get(array, 0) + 1
+                self.peak[array] = max(self.peak.get(array, 0), self.active[array])
+            time.sleep(0.01)
+            with self.lock:
+                self.active[array] -= 1
+            return make_response(200, names)
+
+    async def run(facade):
+        calls = [facade.get_volumes_space(context_names=[array], names=[i]) for array in ('a1', 'a2') for i in range(6)]
+        return await asyncio.gather(*calls)
+
+    client = SlowClient()
+    facade = AsyncFusionClient(client, max_concurrency=8, per_array_concurrency=2)
+    responses = asyncio.run(run(facade))
+    # A second event loop gets its own semaphores
+    responses += asyncio.run(run(facade))
+    facade.close()
+    assert len(responses) == 24
+    assert max(client.peak.values()) <= 2
+
+def test_async_fusion_client_paginates():
+    import asyncio
+    pages = {None: (['a'], 't1'), 't1': (['b'], None)}
+
+    class PagedClient:
+        def get_volumes(self, limit=None, continuation_token=None, context_names=None):
+            items, token = pages[continuation_token]
+            return type('Response', (), {'status_code': 200, 'items': items, 'continuation_token': token})()
+
+    async def run(facade):
+        return [response.items async for response in facade.paginate('get_volumes', context_names=['a1'])]
+
+    facade = AsyncFusionClient(PagedClient())
+    assert asyncio.run(run(facade)) == [['a'], ['b']]
+    facade.close()
+
+def test_token_bucket_limits_rate():
+    import time
+    bucket = TokenBucket(rate=100, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.04
+    assert TokenBucket(rate=0).acquire() == 0.0
+
+def test_write_rate_limiter_uses_array_and_endpoint_buckets():
+    limiter = WriteRateLimiter(array_rate=0, endpoint_rate=0)
+    assert limiter.acquire('array1') == 0.0
+
+def test_write_rate_limiter_throttles_each_array_separately():
+    limiter = WriteRateLimiter(array_rate=50, endpoint_rate=1000)
+    # The array bucket holds a burst of 50; the next writes to that array wait for tokens
+    assert sum(limiter.acquire('array1') for _ in range(50)) == 0.0
+    assert sum(limiter.acquire('array1') for _ in range(5)) >= 0.08
+    # The end-point bucket still has tokens, so another array is not held back
+    assert limiter.acquire('array2') == 0.0
+
+class FlakyClient:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+    def get_volumes(self, context_names=None):
+        self.calls += 1
+        return make_response(self.statuses.pop(0) if self.statuses else 200)
+
+def test_resilient_client_retries_transient_errors():
+    client = ResilientClient(FlakyClient([503, 429]), RetryPolicy(attempts=3, base_delay=0))
+    assert client.get_volumes(context_names=['array1']).status_code == 200
+    assert client.incomplete_arrays == []
+
+def test_resilient_client_opens_circuit_and_reports_incomplete():
+    flaky = FlakyClient([503] * 10)
+    client = ResilientClient(flaky, RetryPolicy(attempts=2, base_delay=0), CircuitBreaker(threshold=2, reset_timeout=60))
+    assert client.get_volumes(context_names=['array1']).status_code == 503
+    assert client.get_volumes(context_names=['array1']).status_code == 503
+    calls = flaky.calls
+    response = client.get_volumes(context_names=['array1'])
+    assert flaky.calls == calls
+    assert 'Circuit open' in response.errors[0]
+    assert client.incomplete_arrays == ['array1']
+    assert client.get_volumes(context_names=['array2']).status_code == 503
+
+def test_session_client_renews_expired_sessions():
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+    class Session:
+        def __init__(self, expired):
+            self.expired = expired
+        def get_volumes(self, **kwargs):
+            return Response(401 if self.expired else 200)
+    sessions = [Session(expired=True), Session(expired=False)]
+    client = SessionClient(lambda: sessions.pop(0), max_age=0)
+    assert client.get_volumes(context_names=['array1']).status_code == 200
+    assert client.renewals == 1
+
+def test_service_send_needs_no_configuration(monkeypatch):
+    monkeypatch.setattr('sys.argv', ['staas-service.py', '--control-socket', '/tmp/staas.sock', '--send', 'status'])
+    args = parse_arguments('service')
+    assert (args.send, args.config, args.reportdir) == ('status', None, None)
+    monkeypatch.setattr('sys.argv', ['staas-reporting.py', '--reportdir', 'reports'])
+    with pytest.raises(SystemExit):
+        parse_arguments('report')
+
+def test_scripts_resume_from_the_same_default_journal_location(tmp_path):
+    config = str(tmp_path / 'STAAS_Config.xlsx')
+    assert checkpoint_path(config, 'reporting') == str(tmp_path / '.STAAS_Config.xlsx.reporting.journal')
+    assert checkpoint_path(config, 'tag_vols') == str(tmp_path / '.STAAS_Config.xlsx.tag_vols.journal')
+
+def test_job_schedule_interval_and_daily():
+    import datetime
+    interval = JobSchedule(interval=3600)
+    assert interval.first_run(1000.0) == 1000.0
+    assert interval.next_run(1000.0) == 4600.0
+    daily = JobSchedule(at='02:00')
+    start = datetime.datetime(2026, 10, 18, 1, 0).timestamp()
+    assert daily.first_run(start) == datetime.datetime(2026, 10, 18, 2, 0).timestamp()
+    assert daily.next_run(daily.first_run(start)) == datetime.datetime(2026, 10, 19, 2, 0).timestamp()
+    assert not JobSchedule(interval=0, at='').enabled
+
+def test_caching_client_records_and_replays(tmp_path):
+    path = str(tmp_path / 'responses.db')
+    volume = type('Volume', (), {})()
+    volume.name = 'vol1'
+    volume.space = type('Space', (), {})()
+    volume.space.total_physical = 10
+    inner = MagicMock()
+    inner.get_volumes.return_value = make_response(200, [volume])
+    inner.get_volumes_space.return_value = make_response(200, [volume])
+    client = CachingClient(inner, path)
+    client.get_volumes(context_names=['array1'])
+    cached = client.get_volumes(context_names=['array1'])
+    assert inner.get_volumes.call_count == 1
+    assert cached.items[0].space.__dict__ == {'total_physical': 10}
+    client.get_volumes_space(context_names=['array1'])
+    client.get_volumes_space(context_names=['array1'])
+    assert inner.get_volumes_space.call_count == 2
+    client.close()
+
+    replay = CachingClient(None, path, mode='replay')
+    assert replay.get_volumes(context_names=['array1']).items[0].name == 'vol1'
+    assert replay.get_volumes(context_names=['array2']).status_code == 404
+    # End-points that are never served from the cache are still recorded for replay
+    assert replay.get_volumes_space(context_names=['array1']).status_code == 200
+    assert replay.put_volumes_tags_batch(context_names=['array1']).status_code == 503
+    assert replay.incomplete_arrays == ['array2']
+
+def test_api_version_check_replays_the_recorded_version(tmp_path):
+    path = str(tmp_path / 'responses.db')
+    # Nothing recorded yet, the replay answers 404 and the check fails without raising
+    assert check_api_version(CachingClient(None, path, mode='replay'), 2.42) is False
+    inner = MagicMock()
+    inner.get_rest_version.return_value = '2.45'
+    recorder = CachingClient(inner, path)
+    assert check_api_version(recorder, 2.42) is True
+    recorder.close()
+    assert check_api_version(CachingClient(None, path, mode='replay'), 2.42) is True
+    inner.get_rest_version.return_value = None
+    assert check_api_version(inner, 2.42) is False
+
+def test_fake_fusion_client_serves_fleet_and_counts_requests():
+    client = FakeFusionClient(arrays=2, volumes_per_array=2500, max_names=100)
+    topology = FleetTopology.fetch(client)
+    assert topology.members_of('fleet1') == ['array0', 'array1']
+    pages = list(paginate(client.get_volumes, context_names=['array1']))
+    assert [len(page.items) for page in pages] == [1000, 1000, 500]
+    assert client.requests['get_volumes'] == 3
+    assert client.get_volumes_space(context_names='array0', names=['vol1'] * 101).status_code == 414
+    client.put_volumes_tags_batch(context_names=['array0'], resource_names=['vol2'], tag=[{'value': 'T'}])
+    tags = client.get_volumes_tags(context_names=['array0'], resource_names=['vol2'])
+    assert [tag.value for tag in tags.items] == ['T']
+
+def test_list_query_filters_where_the_endpoint_accepts_it(tmp_path):
+    assert filter_expression(subtype='regular', destroyed=False) == "subtype='regular' and destroyed=false"
+    assert filter_expression(name="it's") == "name='it\\'s'"
+    client = FakeFusionClient(arrays=1, volumes_per_array=100)
+    wrapped = InstrumentedClient(ResilientClient(client, RetryPolicy(attempts=1)), Telemetry('test'))
+    query = list_query(wrapped, 'get_volumes', fields=['name', 'subtype'], subtype='regular')
+    assert query == {'filter': "subtype='regular'"}
+    volumes = [volume for page in paginate(wrapped.get_volumes, context_names=['array0'], **query) for volume in page.items]
+    assert volumes and all(volume.subtype == 'regular' for volume in volumes)
+    assert list_query(MagicMock(), 'get_volumes', subtype='regular') == {}
+    replay = CachingClient(None, str(tmp_path / 'responses.db'), mode='replay')
+    assert list_query(replay, 'get_volumes', fields=['name'], subtype='regular') == {'filter': "subtype='regular'"}
+    replay.close()
+
+def test_instrumented_client_records_calls_and_exports(tmp_path):
+    telemetry = Telemetry('test')
+    flaky = FlakyClient([503, 200])
+    client = InstrumentedClient(ResilientClient(flaky, RetryPolicy(attempts=2, base_delay=0)), telemetry)
+    client.get_volumes(context_names=['array1'])
+    with telemetry.phase('excel'):
+        pass
+    assert list(telemetry.iterate('listing', 'array1', [1, 2])) == [1, 2]
+    summary = telemetry.summary()
+    assert summary['arrays']['array1']['calls'] == 1
+    assert summary['arrays']['array1']['retries'] == 1
+    assert {(p['phase'], p['count']) for p in summary['phases']} == {('excel', 1), ('listing', 3)}
+    path = str(tmp_path / 'staas.prom')
+    telemetry.write_prometheus(path)
+    text = open(path).read()
+    assert 'staas_api_calls_total{script="test",endpoint="get_volumes",array="array1",status="200"} 1' in text
+    assert telemetry.slowest_arrays()[0][0] == 'array1'
+
+def test_instrumented_client_measures_response_size_only_when_asked():
+    fake = FakeFusionClient(arrays=1, volumes_per_array=10)
+    for measure_size in (False, True):
+        telemetry = Telemetry('test')
+        InstrumentedClient(fake, telemetry, measure_size=measure_size).get_volumes(context_names=['array0'])
+        call = telemetry.summary()['calls'][0]
+        assert call['items'] == 10
+        assert (call['bytes'] > 0) == measure_size
+
+def test_trace_sampler_and_json_formatter():
+    sampler = TraceSampler(every=10)
+    def record(level, msg):
+        return logging.LogRecord('staas.test', level, __file__, 1, msg, ('vol1',), None)
+    passed = [sampler.filter(record(TRACE, 'Tagging volume %s')) for _ in range(25)]
+    assert passed.count(True) == 3
+    assert all(sampler.filter(record(logging.INFO, 'Array %s')) for _ in range(3))
+    info = record(logging.ERROR, 'Failed on %s')
+    info.array = 'array1'
+    entry = json.loads(JsonFormatter().format(info))
+    assert entry['message'] == 'Failed on vol1'
+    assert entry['array'] == 'array1'
+    assert entry['level'] == 'ERROR'
@@ -0,0 +1,97 @@
+import importlib.util
+import os
+import pytest
+from tests.fake_fusion import FakeFusionClient
+from staas_common import BatchSizeStore, TaggingRuleEngine, WriteRateLimiter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@pytest.fixture
+def tagging():
+    # A fresh copy of the script per test, so that its module globals start clean
+    spec = importlib.util.spec_from_file_location('staas_tag_vols', os.path.join(ROOT, 'staas-tag_vols.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.NAMESPACE = 'default'
+    module.TAG_KEY = 'chargeback'
+    module.TAGGING_RULES = {"realm": {}, "pod": {}, "workload": {}, "host_group": {}, "host": {},
+                            "default": {"default": "DEFAULT"}}
+    module.RULE_ENGINE = TaggingRuleEngine(module.TAGGING_RULES)
+    module.WRITE_LIMITER = WriteRateLimiter(0, 0)
+    module.BATCH_SIZES = BatchSizeStore()
+    return module
+
+def test_parallel_tag_writes_grow_the_batch_size(tagging):
+    client = FakeFusionClient(arrays=1, volumes_per_array=3000, tagged_fraction=0, latency=0.002)
+    tagging.TAG_BATCH_SIZE = 10
+    tagging.WRITES_IN_FLIGHT = 2
+    counts = tagging.process_volumes(client, 'array0')
+    assert counts['added'] == 2970
+    assert len(client.written_tags['array0']) == 2970
+    # Batches taken after the size grew are full at the new size, so it keeps growing
+    assert tagging.BATCH_SIZES.batcher('array0', 'put_volumes_tags_batch', 10).size > 50
+    assert client.requests['put_volumes_tags_batch'] < 2970 // 10 // 2
+
+def test_reconcile_tag_set_counts_unchanged_added_and_changed(tagging):
+    tag_set = {'A': {'pod': ['vol1', 'vol2', 'vol3']}, 'B': {'host': ['vol4']}}
+    counts = tagging.reconcile_tag_set(tag_set, {'vol1': 'A', 'vol2': 'B', 'vol4': 'B'})
+    assert counts == {'unchanged': 2, 'added': 1, 'changed': 1}
+    assert tag_set == {'A': {'pod': ['vol2', 'vol3']}, 'B': {'host': []}}
+
+def test_reconcile_writes_only_changed_tags_and_then_nothing(tagging):
+    client = FakeFusionClient(arrays=1, volumes_per_array=3000, tagged_fraction=0.5)
+    existing = tagging.read_existing_tags(client, 'array0')
+    assert existing == {client.volume_name(i): client.volume_tag('array0', i) for i in range(3000)
+                        if client.volume_tag('array0', i) is not None}
+    tagged = sum(1 for i in range(3000) if client.volume_subtype(i) == 'regular' and client.volume_tag('array0', i))
+    counts = tagging.process_volumes(client, 'array0', reconcile=True)
+    assert counts == {'unchanged': 0, 'added': 2970 - tagged, 'changed': tagged}
+    writes = client.requests['put_volumes_tags_batch']
+    # Every regular volume now carries the default tag, so a second pass writes nothing
+    assert tagging.process_volumes(client, 'array0', reconcile=True) == {'unchanged': 2970, 'added': 0, 'changed': 0}
+    assert client.requests['put_volumes_tags_batch'] == writes
+
+def test_connection_index_uses_one_sweep_and_host_groups_win_over_hosts(tagging):
+    # Volume i is connected to host (i % 20), which is in host group (i % 20) % 5
+    client = FakeFusionClient(arrays=2, volumes_per_array=900, tagged_fraction=0)
+    tagging.TAGGING_RULES.update({"host_group": {"hg1": "HG"}, "host": {"host1": "H1", "host2": "H2"}})
+    tagging.RULE_ENGINE = TaggingRuleEngine(tagging.TAGGING_RULES)
+    by_host_group, by_host = tagging.build_connection_index(client, 'array0')
+    assert client.requests['get_connections'] == 1
+    assert by_host_group == {client.volume_name(i): 'hg1' for i in range(900) if i % 20 % 5 == 1}
+    assert by_host == {client.volume_name(i): f"host{i % 20}" for i in range(900) if i % 20 in (1, 2)}
+
+    for fleet_member in client.array_names:
+        tagging.process_volumes(client, fleet_member)
+    assert client.requests['get_connections'] == 1 + len(client.array_names)
+    written = client.written_tags['array1']
+    assert written[client.volume_name(1)] == 'HG'
+    assert written[client.volume_name(6)] == 'HG'
+    assert written[client.volume_name(2)] == 'H2'
+    assert written[client.volume_name(3)] == 'DEFAULT'
+
+def test_unreadable_connections_leave_the_array_untagged(tagging):
+    client = FakeFusionClient(arrays=1, volumes_per_array=900, tagged_fraction=0, fail_endpoints=['get_connections'],
+                              error_status=400)
+    tagging.TAGGING_RULES.update({"host_group": {"hg1": "HG"}})
+    tagging.RULE_ENGINE = TaggingRuleEngine(tagging.TAGGING_RULES)
+    assert tagging.build_connection_index(client, 'array0') is None
+    assert tagging.process_volumes(client, 'array0', reconcile=True) is None
+    assert client.requests['put_volumes_tags_batch'] == 0
+    assert client.written_tags == {}
+
+def test_tag_volume_returns_a_bool_and_submit_tag_volume_futures(tagging):
+    from concurrent.futures import ThreadPoolExecutor
+    client = FakeFusionClient(arrays=1, volumes_per_array=100, tagged_fraction=0)
+    names = [client.volume_name(i) for i in range(60)]
+    tagging.TAG_BATCH_SIZE = 10
+    tagging.WRITES_IN_FLIGHT = 2
+    assert tagging.tag_volume(client, 'array0', names[:30], 'A') is True
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = tagging.submit_tag_volume(client, 'array0', names[30:], 'B', executor)
+        results = [future.result() for future in futures]
+    assert len(futures) == 2 and sum(failed for _, failed in results) == 0
+    assert client.written_tags['array0'] == {name: 'A' if i < 30 else 'B' for i, name in enumerate(names)}
+    client.fail_endpoints.add('put_volumes_tags_batch')
+    assert tagging.tag_volume(client, 'array0', names, 'C') is False